@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+
+import os, sys, json, time, argparse, platform, tempfile, statistics
+from datetime import datetime
+from pathlib import Path
+
+# Qt widgets are drawn without a display
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import numpy as np
+from image import log, stack, lut, gpuimage, tracks
+from benchmarks import synthetic
+
+# default parameters
+output_filename = None
+baseline_filename = None
+size_names = ['small', 'medium']
+spot_counts = [1000, 10000, 100000, 1000000]
+max_scene_spots = 100000
+repeat = 5
+max_seconds = 10.0
+threshold = 1.25
+log_level = 'WARNING'
+
+def time_call (func, setup = None, repeat = repeat, max_seconds = max_seconds):
+    # setup is excluded from the timing; fresh arguments for functions modifying the data
+    durations = []
+    for index in range(repeat):
+        args = () if setup is None else setup()
+        start = time.perf_counter()
+        func(*args)
+        durations.append((time.perf_counter() - start) * 1000)
+        if sum(durations) > max_seconds * 1000:
+            break
+
+    return {'repeat': len(durations),
+            'min_ms': min(durations),
+            'median_ms': statistics.median(durations),
+            'max_ms': max(durations)}
+
+class BenchmarkRunner:
+    def __init__ (self, repeat = repeat, max_seconds = max_seconds, filters = None):
+        self.repeat = repeat
+        self.max_seconds = max_seconds
+        self.filters = filters
+        self.results = {}
+        self.failures = []
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.app = None
+
+    def selected (self, name):
+        return self.filters is None or any([x in name for x in self.filters])
+
+    def run (self, name, func, setup = None, params = {}):
+        if not self.selected(name):
+            return
+        result = time_call(func, setup = setup, repeat = self.repeat, max_seconds = self.max_seconds)
+        self.results[name] = {'params': params} | result
+        print(f"{name:<60} {result['median_ms']:10.2f} ms (min {result['min_ms']:.2f}, n = {result['repeat']})", flush = True)
+
+    def check (self, name, passed):
+        # consistency checks between fast and reference paths; failures are reported at the end
+        if self.selected(name) and passed == False:
+            self.failures.append(name)
+            print(f"{name:<60} FAILED", flush = True)
+
+    def temp_filename (self, name):
+        return str(Path(self.temp_dir.name).joinpath(name))
+
+    def init_qt (self):
+        if self.app is None:
+            from PySide6.QtWidgets import QApplication
+            self.app = QApplication.instance() or QApplication(sys.argv[:1])
+        return self.app
+
+    def stack_variants (self, size_names):
+        for size_name in size_names:
+            shape = synthetic.stack_shapes[size_name]
+            for dtype in synthetic.stack_dtypes:
+                yield f"{size_name}/{dtype}", shape, dtype, 0
+            yield f"{size_name}/uint8-rgb", shape, 'uint8', 3
+
+    def bench_stack_io (self, size_names):
+        for label, shape, dtype, s_count in self.stack_variants(size_names):
+            if not self.selected(f"stack_io/{label}"):
+                continue
+            image_stack = synthetic.create_stack(shape, dtype, s_count = s_count)
+            filename = self.temp_filename(f"{label.replace('/', '_')}.ome.tif")
+            params = {'shape': list(image_stack.image_array.shape), 'dtype': dtype}
+
+            self.run(f"stack_io/{label}/save_ome_tiff", lambda: image_stack.save_ome_tiff(filename), params = params)
+            self.run(f"stack_io/{label}/read_image", \
+                     lambda: stack.Stack().read_image(filename, keep_s_axis = s_count > 0), params = params)
+            Path(filename).unlink()
+
+    def bench_transforms (self, size_names):
+        transforms = {
+            'apply_all_identity': lambda x: x.apply_all(lambda image, t_index, c_index: image),
+            'scale_by_ratio_0.5': lambda x: x.scale_by_ratio(0.5),
+            'rotate_15': lambda x: x.rotate(15.0, axis = 0),
+            'shift': lambda x: x.shift((0.0, 2.5, -3.5)),
+            'scale_by_ratio_0.5_cpu_parallel': lambda x: x.scale_by_ratio(0.5, gpu_id = gpuimage.cpu_parallel),
+            'rotate_15_cpu_parallel': lambda x: x.rotate(15.0, axis = 0, gpu_id = gpuimage.cpu_parallel),
+            'shift_cpu_parallel': lambda x: x.shift((0.0, 2.5, -3.5), gpu_id = gpuimage.cpu_parallel),
+            'fit_to_uint8': lambda x: x.fit_to_uint8(fit_always = True),
+            'clip_all_1': lambda x: x.clip_all(1.0),
+            'scale_rotate_shift': lambda x: [x.scale_by_ratio(0.5), x.rotate(15.0, axis = 0), x.shift((0.0, 2.5, -3.5))],
+            'scale_rotate_shift_fused': lambda x: x.transform_pipeline().scale_by_ratio(0.5).rotate(15.0, axis = 0) \
+                                                   .shift((0.0, 2.5, -3.5)).apply(),
+        }
+
+        for label, shape, dtype, s_count in self.stack_variants(size_names):
+            if dtype != 'uint16' and s_count == 0:
+                continue
+            if not self.selected(f"transform/{label}"):
+                continue
+            image_stack = synthetic.create_stack(shape, dtype, s_count = s_count)
+            params = {'shape': list(image_stack.image_array.shape), 'dtype': dtype}
+
+            def setup ():
+                copied_stack = stack.Stack()
+                copied_stack.update_array(image_stack.image_array.copy())
+                copied_stack.voxel_um = list(image_stack.voxel_um)
+                return (copied_stack,)
+
+            for name, func in transforms.items():
+                self.run(f"transform/{label}/{name}", func, setup = setup, params = params)
+
+    def bench_rendering (self, size_names):
+        self.init_qt()
+        from ui import mainwindow
+
+        for label, shape, dtype, s_count in self.stack_variants(size_names):
+            if s_count > 0 or not self.selected(f"render/{label}"):
+                continue
+            image_stack = synthetic.create_stack(shape, dtype)
+            image = image_stack.image_array[0, 0, 0]
+            params = {'shape': list(image_stack.image_array.shape), 'dtype': dtype}
+
+            image_lut = lut.LUT(lut_name = 'Green', pixel_values = image)
+            self.run(f"render/{label}/apply_lut_rgb", lambda: image_lut.apply_lut_rgb(image), params = params)
+            output = np.empty(image.shape + (3,), dtype = np.uint8)
+            scratch = np.empty(image.shape, dtype = np.float32)
+            self.run(f"render/{label}/apply_lut_rgb_into", \
+                     lambda: image_lut.apply_lut_rgb_into(image, output, scratch), params = params)
+
+            # the frame buffer path must match the reference path, also for pixels below lut_lower
+            check_lut = lut.LUT(lut_name = 'Green', pixel_values = image)
+            # (the GUI sets integer bounds for integer images)
+            lower, upper = np.percentile(image, 50), np.percentile(image, 90)
+            if np.issubdtype(image.dtype, np.integer):
+                lower, upper = int(lower), int(upper)
+            check_lut.lut_lower, check_lut.lut_upper = lower, upper
+            gray = np.empty(image.shape, dtype = np.uint8)
+            # (float32 and float64 may round one level apart)
+            def matches (fast, reference):
+                return np.max(np.abs(fast.astype(np.int16) - reference.astype(np.int16))) <= 1
+            self.check(f"render/{label}/apply_lut_gray_into_matches", \
+                       matches(check_lut.apply_lut_gray_into(image, gray, scratch), check_lut.apply_lut_gray(image)))
+            self.check(f"render/{label}/apply_lut_rgb_into_matches", \
+                       matches(check_lut.apply_lut_rgb_into(image, output, scratch), np.stack(check_lut.apply_lut_rgb(image), axis = -1)))
+
+            # ranges of the whole stack, computed once and answered from the statistics
+            def invalidate_statistics ():
+                image_stack.statistics.invalidate()
+                return ()
+            self.run(f"render/{label}/create_lut_list", lambda: lut.create_lut_list(image_stack), \
+                     setup = invalidate_statistics, params = params)
+            self.run(f"render/{label}/create_lut_list_sampled", \
+                     lambda: lut.create_lut_list(image_stack, max_planes = lut.default_sample_planes), \
+                     setup = invalidate_statistics, params = params)
+            self.run(f"render/{label}/create_lut_list_cached", lambda: lut.create_lut_list(image_stack), params = params)
+
+            # LUT sliders of the GUI accept only integer values
+            if np.issubdtype(image_stack.image_array.dtype, np.integer) == False:
+                continue
+
+            # the same path as MainWindow.load_image
+            window = mainwindow.MainWindow()
+            window.resize(1024, 768)
+            window.image_panel.image_stack = image_stack
+            window.init_widgets()
+            image_panel, lut_panel = window.image_panel, window.lut_panel
+
+            self.run(f"render/{label}/update_image_scene", \
+                     lambda: image_panel.update_image_scene(lut_list = lut_panel.lut_list), params = params)
+            self.run(f"render/{label}/update_lut_view", \
+                     lambda: lut_panel.update_lut_view(image_panel.current_image()), params = params)
+            self.run(f"render/{label}/update_lut_view_cached", \
+                     lambda: lut_panel.update_lut_view(image_panel.current_pixel_values()), params = params)
+            window.close()
+            window.deleteLater()
+            self.app.processEvents()
+
+    def bench_spt (self, spot_counts, max_scene_spots = max_scene_spots):
+        self.init_qt()
+        from PySide6.QtWidgets import QVBoxLayout
+        from plugin import particle
+
+        for spot_count in spot_counts:
+            if not self.selected(f"spt/{spot_count}"):
+                continue
+            spot_list = synthetic.create_spot_list(spot_count)
+            params = {'spot_count': spot_count}
+
+            spt = particle.SPT()
+            spt.init_widgets(QVBoxLayout())
+            spt.spot_list = spot_list
+
+            spot = spot_list[len(spot_list) // 2]
+            tcz_index = (spot['time'], spot['channel'], spot['z'])
+            position = (spot['x'], spot['y'], *tcz_index)
+
+            # list_scene_items is slow on many spots; skipped above the limit
+            if spot_count <= max_scene_spots:
+                spt.current_spot = None
+                self.run(f"spt/{spot_count}/list_scene_items", lambda: spt.list_scene_items(None, tcz_index), params = params)
+                spt.current_spot = spot
+                self.run(f"spt/{spot_count}/list_scene_items_selected", \
+                         lambda: spt.list_scene_items(None, tcz_index), params = params)
+                spt.current_spot = None
+                spt.ghost_z_range = 100
+                self.run(f"spt/{spot_count}/list_scene_items_ghost_100", \
+                         lambda: spt.list_scene_items(None, tcz_index), params = params)
+                spt.ghost_z_range = 5
+
+            self.run(f"spt/{spot_count}/find_spots_by_position", \
+                     lambda: spt.find_spots_by_position(*position), params = params)
+
+            track_arrays = tracks.TrackArrays(spot_list)
+            self.run(f"spt/{spot_count}/track_arrays", lambda: tracks.TrackArrays(spot_list), params = params)
+            self.run(f"spt/{spot_count}/track_table", track_arrays.track_table, params = params)
+            self.run(f"spt/{spot_count}/msd_table", track_arrays.msd_table, params = params)
+
+            filename = self.temp_filename(f"spots_{spot_count}_track.json")
+            self.run(f"spt/{spot_count}/save_records", lambda: spt.save_records(filename), params = params)
+            self.run(f"spt/{spot_count}/load_records", lambda: spt.load_records(filename), params = params)
+            Path(filename).unlink()
+
+    def environment (self):
+        return {'date': datetime.now().astimezone().isoformat(),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'platform': platform.platform(),
+                'machine': platform.machine(),
+                'cpu_count': os.cpu_count(),
+                'repeat': self.repeat}
+
+def compare_results (results, baseline, threshold = threshold):
+    # ratio of the medians; > threshold is a regression, < 1 / threshold an improvement
+    comparison = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['median_ms'] / max(baseline[name]['median_ms'], 1.0e-6)
+        if ratio > threshold:
+            status = 'regression'
+        elif ratio < 1 / threshold:
+            status = 'improvement'
+        else:
+            status = 'unchanged'
+        comparison[name] = {'baseline_ms': baseline[name]['median_ms'],
+                            'current_ms': result['median_ms'],
+                            'ratio': ratio, 'status': status}
+    return comparison
+
+if __name__ == '__main__':
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Benchmarks of stack I/O, rendering and particle tracking.', \
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-o', '--output', default = output_filename, \
+                        help='JSON file to save the results')
+
+    parser.add_argument('-b', '--baseline', default = baseline_filename, \
+                        help='JSON file of previous results to compare with')
+
+    parser.add_argument('-s', '--sizes', nargs = '+', default = size_names, \
+                        choices = list(synthetic.stack_shapes.keys()), help='Sizes of synthetic stacks')
+
+    parser.add_argument('-n', '--spot-counts', nargs = '+', type = int, default = spot_counts, \
+                        help='Numbers of synthetic spots')
+
+    parser.add_argument('-m', '--max-scene-spots', type = int, default = max_scene_spots, \
+                        help='Skip list_scene_items above this number of spots')
+
+    parser.add_argument('-r', '--repeat', type = int, default = repeat, \
+                        help='Repeats of each benchmark')
+
+    parser.add_argument('-t', '--max-seconds', type = float, default = max_seconds, \
+                        help='Stop repeating a benchmark after this time')
+
+    parser.add_argument('-k', '--filter', nargs = '+', default = None, \
+                        help='Run benchmarks whose names contain any of these strings')
+
+    parser.add_argument('--threshold', type = float, default = threshold, \
+                        help='Ratio to the baseline reported as a regression')
+
+    parser.add_argument('--fail-on-regression', action = 'store_true', \
+                        help='Exit with status 1 if any regression is found')
+
+    log.add_argument(parser, default_level = log_level)
+    args = parser.parse_args()
+
+    # logging
+    logger = log.get_logger(__file__, level = args.log_level)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+    # run benchmarks
+    runner = BenchmarkRunner(repeat = args.repeat, max_seconds = args.max_seconds, filters = args.filter)
+    runner.bench_stack_io(args.sizes)
+    runner.bench_transforms(args.sizes)
+    runner.bench_rendering(args.sizes)
+    runner.bench_spt(args.spot_counts, max_scene_spots = args.max_scene_spots)
+
+    output = {'environment': runner.environment(), 'results': runner.results}
+
+    exit_status = 0
+    if len(runner.failures) > 0:
+        print(f"{len(runner.failures)} check(s) failed: {', '.join(runner.failures)}")
+        exit_status = 1
+
+    if baseline is not None:
+        comparison = compare_results(runner.results, baseline.get('results', {}), threshold = args.threshold)
+        output['comparison'] = comparison
+
+        print("Comparison with the baseline (ratio of medians):")
+        for name, item in comparison.items():
+            if item['status'] != 'unchanged':
+                print(f"  {item['status']:<12} {item['ratio']:6.2f}  {name}")
+        regressions = [x for x in comparison.values() if x['status'] == 'regression']
+        print(f"  {len(regressions)} regression(s) in {len(comparison)} benchmark(s).")
+        if args.fail_on_regression and len(regressions) > 0:
+            exit_status = 1
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent = 4)
+        print(f"Results saved: {args.output}")
+
+    sys.exit(exit_status)
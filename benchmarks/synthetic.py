@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+import numpy as np
+from image import stack, records
+
+default_seed = 0
+
+# (T, C, Z, Y, X)
+stack_shapes = {
+    'small': (4, 1, 8, 256, 256),
+    'medium': (8, 1, 16, 512, 512),
+    'large': (4, 2, 32, 1024, 1024),
+    'mosaic': (1, 1, 2, 8192, 8192),
+}
+
+stack_dtypes = ['uint8', 'uint16', 'float32']
+
+def create_stack (shape, dtype = 'uint16', s_count = 0, seed = default_seed):
+    rng = np.random.default_rng(seed)
+    if s_count > 0:
+        shape = tuple(shape) + (s_count,)
+
+    # noisy background with a few bright blobs, so that LUTs and histograms are not trivial
+    dtype = np.dtype(dtype)
+    upper = 255 if dtype == np.uint8 else 4095
+    blobs = [(rng.integers(0, shape[3]), rng.integers(0, shape[4])) for _ in range(16)]
+    image_array = np.empty(shape, dtype = dtype)
+    for t_index in range(shape[0]):
+        image = rng.normal(upper * 0.1, upper * 0.02, size = shape[1:])
+        for y, x in blobs:
+            image[:, :, max(0, y - 4):y + 4, max(0, x - 4):x + 4] += upper * 0.5
+        image_array[t_index] = image.clip(0, upper)
+
+    image_stack = stack.Stack()
+    image_stack.update_array(image_array)
+    image_stack.voxel_um = list(stack.default_voxel)
+    image_stack.finterval_sec = stack.default_finterval_sec
+    return image_stack
+
+def create_spot_list (spot_count, shape = (100, 1, 20, 512, 512), track_length = 20, seed = default_seed):
+    # tracks of random walks; each spot refers to the previous one as its parent
+    rng = np.random.default_rng(seed)
+    t_count, c_count, z_count, height, width = shape
+
+    spot_list = []
+    while len(spot_list) < spot_count:
+        length = min(track_length, spot_count - len(spot_list))
+        t_start = int(rng.integers(0, max(1, t_count - length)))
+        channel = int(rng.integers(0, c_count))
+        x, y = rng.uniform(0, width), rng.uniform(0, height)
+        z = int(rng.integers(0, z_count))
+        parent = None
+        for t_index in range(t_start, t_start + length):
+            spot = records.create_spot(index = len(spot_list), time = t_index % t_count, channel = channel, \
+                                       x = float(x), y = float(y), z = z, parent = parent)
+            spot_list.append(spot)
+            parent = spot['index']
+            x = float(np.clip(x + rng.normal(0, 2), 0, width - 1))
+            y = float(np.clip(y + rng.normal(0, 2), 0, height - 1))
+            z = int(np.clip(z + rng.integers(-1, 2), 0, z_count - 1))
+
+    return spot_list
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+import weakref
+from pathlib import Path
+from logging import getLogger
+from . import perf
+
+logger = getLogger(__name__)
+
+def file_key (filename):
+    # the same file opened again is recognized unless modified
+    file = Path(filename).resolve()
+    stat = file.stat()
+    return (str(file), stat.st_mtime_ns, stat.st_size)
+
+class StackCache:
+    def __init__ (self):
+        # stacks are released when no window refers to them
+        self.stack_dict = weakref.WeakValueDictionary()
+
+    def get (self, filename):
+        try:
+            image_stack = self.stack_dict.get(file_key(filename), None)
+        except OSError:
+            return None
+
+        if image_stack is not None:
+            logger.debug(f"Stack cache hit: {filename}")
+            perf.count("stack_cache_hit")
+        else:
+            perf.count("stack_cache_miss")
+        return image_stack
+
+    def put (self, filename, image_stack):
+        try:
+            self.stack_dict[file_key(filename)] = image_stack
+        except OSError:
+            logger.warning(f"Stack not cached: {filename}")
+
+    def clear (self):
+        self.stack_dict.clear()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+import itertools
+import numpy as np
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+# temporaries are bounded by blocks of this size (a few times larger as intp or float64)
+default_block_bytes = 16 * 1024 * 1024
+float_bins = 65536
+
+def block_keys (shape, itemsize, block_bytes = default_block_bytes):
+    # keys of blocks along the leading axes; a block is at least one row of the last axis
+    shape = tuple(shape)
+    if len(shape) == 0:
+        yield ()
+        return
+
+    axis = next((index for index in range(len(shape)) \
+                 if int(np.prod(shape[index + 1:])) * itemsize <= block_bytes), len(shape) - 1)
+    step = max(1, block_bytes // max(1, int(np.prod(shape[axis + 1:])) * itemsize))
+    for leading in itertools.product(*[range(length) for length in shape[0:axis]]):
+        for start in range(0, shape[axis], step):
+            yield leading + (slice(start, min(start + step, shape[axis])),)
+
+def blocks (image_array, block_bytes = default_block_bytes):
+    for key in block_keys(image_array.shape, np.dtype(image_array.dtype).itemsize, block_bytes):
+        yield key, np.asarray(image_array[key])
+
+def value_range (image_array, block_bytes = default_block_bytes):
+    lower, upper = None, None
+    for _, block in blocks(image_array, block_bytes):
+        block_lower, block_upper = block.min(), block.max()
+        lower = block_lower if lower is None else min(lower, block_lower)
+        upper = block_upper if upper is None else max(upper, block_upper)
+    return lower, upper
+
+def integer_histogram (image_array, block_bytes = default_block_bytes):
+    # counts of every value of 8 or 16 bit integers; counts[0] is the count of iinfo.min
+    offset = int(np.iinfo(image_array.dtype).min)
+    length = int(np.iinfo(image_array.dtype).max) - offset + 1
+    counts = np.zeros(length, dtype = np.int64)
+    for _, block in blocks(image_array, block_bytes):
+        values = block.reshape(-1).astype(np.intp)
+        if offset != 0:
+            values -= offset
+        counts += np.bincount(values, minlength = length)
+    return counts, offset
+
+def float_histogram (image_array, lower, upper, block_bytes = default_block_bytes):
+    counts = np.zeros(float_bins, dtype = np.int64)
+    for _, block in blocks(image_array, block_bytes):
+        counts += np.histogram(block, bins = float_bins, range = (lower, upper))[0]
+    return counts
+
+def percentiles (image_array, percentile_list, block_bytes = default_block_bytes):
+    # same as np.percentile (linear) for 8 and 16 bit integers, approximated by fine bins for large float arrays
+    dtype = np.dtype(image_array.dtype)
+    if dtype.kind in 'ui' and dtype.itemsize <= 2:
+        counts, offset = integer_histogram(image_array, block_bytes)
+        return histogram_percentiles(counts, offset, 1, percentile_list, integer = True)
+    elif image_array.size * dtype.itemsize <= block_bytes:
+        return [float(value) for value in np.percentile(np.asarray(image_array), percentile_list)]
+    else:
+        lower, upper = value_range(image_array, block_bytes)
+        if lower == upper:
+            return [float(lower)] * len(percentile_list)
+        counts = float_histogram(image_array, lower, upper, block_bytes)
+        return histogram_percentiles(counts, float(lower), (float(upper) - float(lower)) / float_bins, percentile_list)
+
+def histogram_percentiles (counts, lower, bin_width, percentile_list, integer = False):
+    # bin i covers lower + bin_width * i to lower + bin_width * (i + 1) (integers up to the next bin).
+    # values are spread evenly in each bin, so integer bins of width 1 give the same as np.percentile.
+    cumsum = np.cumsum(counts)
+    spread = bin_width - 1 if integer else bin_width
+    def rank_value (rank):
+        index = np.searchsorted(cumsum, rank, side = 'right')
+        previous = cumsum[index - 1] if index > 0 else 0
+        return lower + bin_width * index + spread * (rank - previous + 0.5) / max(1, counts[index])
+
+    # interpolation between the neighboring ranks like np.percentile
+    output = []
+    for percentile in percentile_list:
+        position = percentile / 100 * (int(cumsum[-1]) - 1)
+        rank = int(np.floor(position))
+        value = float(rank_value(rank))
+        if position > rank:
+            value = value + (float(rank_value(rank + 1)) - value) * (position - rank)
+        output.append(value)
+    return output
+
+def dtype_bounds (lower, upper, dtype):
+    # bounds rounded and limited to the range of integer dtypes
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'ui':
+        info = np.iinfo(dtype)
+        lower = min(max(np.rint(lower), info.min), info.max)
+        upper = min(max(np.rint(upper), info.min), info.max)
+    return dtype.type(lower), dtype.type(upper)
+
+def clip (image_array, lower, upper, out = None, block_bytes = default_block_bytes):
+    # out may be image_array (in place); the dtype is kept
+    out = np.empty(image_array.shape, dtype = image_array.dtype) if out is None else out
+    lower, upper = dtype_bounds(lower, upper, out.dtype)
+    for key, block in blocks(image_array, block_bytes):
+        np.clip(block, lower, upper, out = out[key])
+    return out
+
+def rescale (image_array, lower, upper, dtype = np.uint8, out = None, block_bytes = default_block_bytes):
+    # (value - lower) / (upper - lower) is mapped to the range of dtype (truncated like astype)
+    out = np.empty(image_array.shape, dtype = dtype) if out is None else out
+    if upper == lower:
+        out[...] = 0
+        return out
+
+    max_value = float(np.iinfo(out.dtype).max) if out.dtype.kind in 'ui' else 1.0
+    for key, block in blocks(image_array, block_bytes):
+        scratch = np.subtract(block, lower, dtype = np.float64)
+        np.multiply(scratch, max_value, out = scratch)
+        np.divide(scratch, float(upper) - float(lower), out = scratch)
+        np.clip(scratch, 0, max_value, out = scratch)
+        np.copyto(out[key], scratch, casting = 'unsafe')
+    return out
+
+def astype (image_array, dtype, out = None, block_bytes = default_block_bytes):
+    # also converts lazy arrays block by block
+    out = np.empty(image_array.shape, dtype = dtype) if out is None else out
+    for key, block in blocks(image_array, block_bytes):
+        np.copyto(out[key], block, casting = 'unsafe')
+    return out
+
+def invert (image_array, max_value, out = None, block_bytes = default_block_bytes):
+    # max_value - values; None negates the values
+    out = np.empty(image_array.shape, dtype = image_array.dtype) if out is None else out
+    for key, block in blocks(image_array, block_bytes):
+        if max_value is None:
+            np.negative(block, out = out[key])
+        else:
+            np.subtract(out.dtype.type(max_value), block, out = out[key])
+    return out
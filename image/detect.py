@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+import numpy as np
+from scipy import ndimage
+from logging import getLogger
+from . import records
+
+logger = getLogger(__name__)
+
+default_sigma = 1.5
+default_threshold = 3.0
+default_min_distance = 2
+
+def detect_spots (image, sigma = default_sigma, threshold = default_threshold, min_distance = default_min_distance):
+    # image is shaped as ZYX, sigma as a scalar or (z, y, x)
+    float_image = image.astype(np.float32)
+    response = - ndimage.gaussian_laplace(float_image, sigma)
+
+    cutoff = response.mean() + threshold * response.std()
+    size = [2 * min_distance + 1] * response.ndim
+    local_max = (response == ndimage.maximum_filter(response, size = size)) & (response > cutoff)
+
+    coords = np.argwhere(local_max)
+    intensity = image[tuple(coords.T)]
+    logger.debug("Detected {0} spots. Cutoff: {1}".format(len(coords), cutoff))
+
+    return coords, intensity
+
+def detect_stack (stack, channel = 0, sigma = default_sigma, threshold = default_threshold, \
+                  min_distance = default_min_distance):
+    if stack.z_count > 1:
+        z_sigma = sigma * stack.voxel_um[2] / stack.voxel_um[0]
+        sigma_zyx = (z_sigma, sigma, sigma)
+    else:
+        sigma_zyx = (0, sigma, sigma)
+
+    spot_list = []
+    for t_index in range(stack.t_count):
+        coords, _ = detect_spots(stack.image_array[t_index, channel], sigma = sigma_zyx, \
+                                 threshold = threshold, min_distance = min_distance)
+        for z, y, x in coords:
+            spot = records.create_spot(index = len(spot_list), time = t_index, channel = channel, \
+                                       x = float(x), y = float(y), z = int(z))
+            spot_list.append(spot)
+
+    return spot_list
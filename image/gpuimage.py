@@ -1,17 +1,33 @@
 #!/usr/bin/env python
 
+import os
 import numpy as np
-from scipy import ndimage
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
-try:
-    import cupy as cp
-    from cupyx.scipy import ndimage as cpimage
-except ImportError:
-    pass
+from . import lazy
+
+# scipy and cupy are loaded on first use
+ndimage = lazy.lazy_import('scipy.ndimage')
+cp = None
+cpimage = None
 
 logger = getLogger(__name__)
 
+# gpu_id selecting the thread-parallel CPU path (render nodes without GPUs)
+cpu_parallel = 'cpu-parallel'
+cpu_workers = None
+slab_overlap = 16
+
+def import_cupy ():
+    global cp, cpimage
+    if cp is None:
+        import cupy
+        from cupyx.scipy import ndimage as cupy_ndimage
+        cp, cpimage = cupy, cupy_ndimage
+    return cp, cpimage
+
 def turn_on_gpu (gpu_id):
+    import_cupy()
     device = cp.cuda.Device(gpu_id)
     device.use()
     logger.info("Turning on GPU: {0}, PCI-bus ID: {1}".format(gpu_id, device.pci_bus_id))
@@ -65,6 +81,7 @@ def zoom (input_image, ratio = 1.0, gpu_id = None):
     if gpu_id is None:
         output_image = ndimage.zoom(input_image, ratio)
     else:
+        import_cupy()
         output_image = cpimage.zoom(cp.array(input_image), ratio)
         output_image = cp.asnumpy(output_image)
 
@@ -80,11 +97,97 @@ def z_zoom (input_image, ratio = 1.0, gpu_id = None):
     
     return output_image
 
+def parallel_workers ():
+    return (os.cpu_count() or 1) if cpu_workers is None else cpu_workers
+
+def slab_ranges (length, slab_count):
+    bounds = np.linspace(0, length, min(slab_count, length) + 1).astype(int)
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+def slab_axis (output_shape, slab_count):
+    # z-slabs; y-slabs for images with a few planes
+    if len(output_shape) > 1 and output_shape[0] < slab_count:
+        return 1
+    return 0
+
+def affine_parts (matrix, ndim):
+    # ndimage.affine_transform accepts a diagonal, a square or a homogeneous matrix
+    matrix = np.asarray(matrix, dtype = np.float64)
+    if matrix.ndim == 1:
+        return np.diag(matrix), np.zeros(ndim)
+    if matrix.shape[1] == ndim + 1:
+        return matrix[0:ndim, 0:ndim], matrix[0:ndim, ndim]
+    return matrix, np.zeros(ndim)
+
+def parallel_affine (input_image, matrix, offset, output_shape, mode = 'constant', order = 3):
+    # output slabs are computed from input slabs with overlaps, so that the spline prefilter
+    # of each slab differs from the one of the whole volume only within the overlap.
+    # ndimage releases the GIL, so slabs are computed in threads.
+    output_image = np.zeros(output_shape, dtype = input_image.dtype)
+    workers = parallel_workers()
+    axis = slab_axis(output_shape, workers)
+
+    corners = np.array(np.meshgrid(*[[0, max(0, length - 1)] for length in output_shape], indexing = 'ij'))
+    corners = corners.reshape(len(output_shape), -1)
+
+    def slab_func (slab):
+        start, stop = slab
+        slab_corners = corners.copy()
+        slab_corners[axis] = np.where(corners[axis] == 0, start, stop - 1)
+        coords = matrix[axis] @ slab_corners + offset[axis]
+        input_start = max(0, int(np.floor(coords.min())) - slab_overlap)
+        input_stop = min(input_image.shape[axis], int(np.ceil(coords.max())) + slab_overlap + 1)
+        if input_stop <= input_start:
+            # mapped outside of the input (filled with zero)
+            return
+
+        output_origin = np.zeros(len(output_shape))
+        output_origin[axis] = start
+        input_origin = np.zeros(len(output_shape))
+        input_origin[axis] = input_start
+        slab_offset = offset + matrix @ output_origin - input_origin
+
+        input_slices = tuple([slice(input_start, input_stop) if index == axis else slice(None) \
+                              for index in range(input_image.ndim)])
+        output_slices = tuple([slice(start, stop) if index == axis else slice(None) \
+                               for index in range(input_image.ndim)])
+        output_image[output_slices] = ndimage.affine_transform(input_image[input_slices], matrix, offset = slab_offset, \
+                                                               output_shape = output_image[output_slices].shape, \
+                                                               order = order, mode = mode)
+
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        list(executor.map(slab_func, slab_ranges(output_shape[axis], workers)))
+    return output_image
+
+def parallel_zoom (input_image, ratio):
+    # same grid as ndimage.zoom (corners aligned)
+    output_shape = tuple([int(round(length * factor)) for length, factor in zip(input_image.shape, ratio)])
+    factors = [(length - 1) / (output - 1) if output > 1 else 1.0 \
+               for length, output in zip(input_image.shape, output_shape)]
+    return parallel_affine(input_image, np.diag(factors), np.zeros(input_image.ndim), output_shape)
+
+def parallel_rotate (input_image, angle, rot_tuple):
+    # planes normal to the remaining axis are rotated independently (no overlap is necessary)
+    axis = next(index for index in range(input_image.ndim) if index not in rot_tuple)
+    output_image = np.empty_like(input_image)
+
+    def slab_func (slab):
+        slices = tuple([slice(*slab) if index == axis else slice(None) for index in range(input_image.ndim)])
+        output_image[slices] = ndimage.rotate(input_image[slices], angle, axes = rot_tuple, reshape = False)
+
+    workers = parallel_workers()
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        list(executor.map(slab_func, slab_ranges(input_image.shape[axis], workers)))
+    return output_image
+
 def scale (input_image, ratio, gpu_id = None):
     if np.allclose(ratio, 1.0) == False:
         if gpu_id is None:
             output_image = ndimage.zoom(input_image, ratio)
+        elif gpu_id == cpu_parallel:
+            output_image = parallel_zoom(input_image, ratio)
         else:
+            import_cupy()
             output_image = cpimage.zoom(cp.array(input_image), ratio)
             output_image = cp.asnumpy(output_image)
     else:
@@ -108,7 +211,10 @@ def expand_ratio (ratio):
 def rotate (input_image, angle, rot_tuple, gpu_id = None):
     if gpu_id is None:
         image = ndimage.rotate(input_image, angle, axes = rot_tuple, reshape = False)
+    elif gpu_id == cpu_parallel:
+        image = parallel_rotate(input_image, angle, rot_tuple)
     else:
+        import_cupy()
         image = cp.asarray(input_image)
         image = cpimage.rotate(image, angle, axes = rot_tuple, order = 1, reshape = False)
         image = cp.asnumpy(image)
@@ -131,18 +237,28 @@ def axis_to_tuple (axis):
 
     return rotate_tuple
 
-def affine_transform (input_image, matrix, gpu_id = None):
+def affine_transform (input_image, matrix, gpu_id = None, output_shape = None, mode = 'grid-constant'):
+    output_shape = input_image.shape if output_shape is None else tuple(output_shape)
     if gpu_id is None:
-        output_image = ndimage.affine_transform(input_image, matrix, mode = 'grid-constant')
+        output_image = ndimage.affine_transform(input_image, matrix, output_shape = output_shape, mode = mode)
+    elif gpu_id == cpu_parallel:
+        matrix, offset = affine_parts(matrix, input_image.ndim)
+        output_image = parallel_affine(input_image, matrix, offset, output_shape, mode = mode)
     else:
-        output_image = cpimage.affine_transform(cp.array(input_image), cp.array(matrix), mode = 'grid-constant')
+        import_cupy()
+        output_image = cpimage.affine_transform(cp.array(input_image), cp.array(matrix), \
+                                                output_shape = output_shape, mode = mode)
         output_image = cp.asnumpy(output_image)
     return output_image
 
 def shift (input_image, offset, gpu_id = None):
     if gpu_id is None:
         output_image = ndimage.interpolation.shift(input_image, offset)
+    elif gpu_id == cpu_parallel:
+        output_image = parallel_affine(input_image, np.identity(input_image.ndim), -np.full(input_image.ndim, offset, dtype = np.float64), \
+                                       input_image.shape)
     else:
+        import_cupy()
         output_image = cpimage.interpolation.shift(cp.array(input_image), offset)
         output_image = cp.asnumpy(output_image)
     return output_image
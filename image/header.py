@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import json, sqlite3, threading
+from pathlib import Path
+from logging import getLogger
+from . import cache
+
+logger = getLogger(__name__)
+
+default_cache_filename = Path.home().joinpath('.cache', 'momotrack', 'headers.sqlite')
+
+# bumped when the fields of header_dict (see Stack) are changed; rows of other versions are not used
+header_version = 1
+
+class HeaderCache:
+    # axes, shape, dtype and metadata of image files, keyed by path, mtime, size and the header version
+    def __init__ (self, filename = default_cache_filename, version = header_version):
+        self.filename = Path(filename)
+        self.version = version
+        self.enabled = True
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect (self):
+        if self.connection is None:
+            self.filename.parent.mkdir(parents = True, exist_ok = True)
+            self.connection = sqlite3.connect(str(self.filename), timeout = 10, check_same_thread = False)
+            # tables made before the version column are dropped (entries are only a cache)
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(headers)")]
+            if len(columns) > 0 and 'version' not in columns:
+                self.connection.execute("DROP TABLE headers")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS headers (path TEXT, series INTEGER, version INTEGER, " + \
+                                    "mtime_ns INTEGER, size INTEGER, header TEXT, PRIMARY KEY (path, series, version))")
+        return self.connection
+
+    def disable (self, exception):
+        # e.g. read-only home folders on cluster nodes
+        logger.warning(f"Header cache disabled: {self.filename}. {exception}")
+        self.enabled = False
+
+    def file_key (self, filename):
+        # file objects and missing files are not cached
+        if self.enabled == False or isinstance(filename, (str, Path)) == False:
+            return None
+        try:
+            return cache.file_key(filename)
+        except OSError:
+            return None
+
+    def get (self, filename, series = 0):
+        key = self.file_key(filename)
+        if key is None:
+            return None
+        try:
+            path, mtime_ns, size = key
+            with self.lock:
+                row = self.connect().execute("SELECT header FROM headers WHERE path = ? AND series = ? AND version = ? " + \
+                                             "AND mtime_ns = ? AND size = ?", \
+                                             (path, series, self.version, mtime_ns, size)).fetchone()
+        except (OSError, sqlite3.Error) as exception:
+            self.disable(exception)
+            return None
+
+        if row is None:
+            return None
+        logger.debug(f"Header cache hit: {filename}, {series}")
+        return json.loads(row[0])
+
+    def put (self, filename, series, header_dict):
+        key = self.file_key(filename)
+        if key is None:
+            return
+        try:
+            path, mtime_ns, size = key
+            with self.lock:
+                connection = self.connect()
+                connection.execute("INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?)", \
+                                   (path, series, self.version, mtime_ns, size, json.dumps(header_dict)))
+                connection.commit()
+        except (OSError, sqlite3.Error) as exception:
+            self.disable(exception)
+
+    def clear (self):
+        try:
+            with self.lock:
+                connection = self.connect()
+                connection.execute("DELETE FROM headers")
+                connection.commit()
+        except (OSError, sqlite3.Error) as exception:
+            self.disable(exception)
+
+    def close (self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+header_cache = HeaderCache()
@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+
+import sys, importlib.util
+
+def lazy_import (name):
+    # the module is executed on the first attribute access
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named '{name}'")
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -2,6 +2,7 @@
 
 import sys
 import numpy as np
+from . import convert, perf, statistics
 
 lut_dict = {}
 lut_dict["Red"]     = [255,   0,   0]
@@ -31,6 +32,9 @@ bit_dict["INT-10"]   = [-0x400, 0x3FF]
 bit_dict["INT-8"]    = [np.iinfo(np.int8).min, np.iinfo(np.int8).max]
 bit_names = list(bit_dict.keys())
 
+# planes of each channel used for the first LUT ranges before the statistics of the stack
+default_sample_planes = 8
+
 class LUT:
     def __init__ (self, lut_name = None, pixel_values = None):
         self.load_settings()
@@ -101,12 +105,13 @@ class LUT:
     def set_range_by_image (self, pixel_values, percentile = 0):
         self.auto_lut = True
         self.auto_cutoff = percentile
+        lower, upper = value_percentiles(pixel_values, [percentile, 100 - percentile])
         if self.bit_mode == "Float":
-            self.lut_lower = np.percentile(pixel_values, percentile)
-            self.lut_upper = np.percentile(pixel_values, 100 - percentile)
+            self.lut_lower = lower
+            self.lut_upper = upper
         else:
-            self.lut_lower = int(np.percentile(pixel_values, percentile))
-            self.lut_upper = int(np.percentile(pixel_values, 100 - percentile))
+            self.lut_lower = int(lower)
+            self.lut_upper = int(upper)
 
     def apply_lut_float (self, image):
         image = image.astype(float)
@@ -122,9 +127,84 @@ class LUT:
 
         return image
 
+    @perf.timed("apply_lut_gray")
     def apply_lut_gray (self, image):
         return (self.apply_lut_float(image) * 255.0).astype(np.uint8)
 
+    @perf.timed("apply_lut_rgb")
     def apply_lut_rgb (self, image):
         max_values = lut_dict[self.lut_name]
         return [(max_value * self.apply_lut_float(image)).astype(np.uint8) for max_value in max_values]
+
+    def apply_lut_scratch (self, image, scratch):
+        # same as apply_lut_float, computed in a preallocated float32 buffer
+        if self.lut_blank or np.isclose(self.lut_lower, self.lut_upper):
+            scratch.fill(0.0)
+        else:
+            # copied first to subtract in float (integer pixels below lut_lower would wrap around)
+            np.copyto(scratch, image, casting = 'unsafe')
+            np.subtract(scratch, self.lut_lower, out = scratch)
+            np.multiply(scratch, 1.0 / (self.lut_upper - self.lut_lower), out = scratch)
+            np.clip(scratch, 0.0, 1.0, out = scratch)
+
+        if self.lut_invert:
+            np.subtract(1.0, scratch, out = scratch)
+
+        return scratch
+
+    @perf.timed("apply_lut_gray")
+    def apply_lut_gray_into (self, image, output, scratch):
+        self.apply_lut_scratch(image, scratch)
+        np.multiply(scratch, 255.0, out = output, casting = 'unsafe')
+        return output
+
+    @perf.timed("apply_lut_rgb")
+    def apply_lut_rgb_into (self, image, output, scratch, composite_buffer = None):
+        # output: (height, width, 3) uint8. with composite_buffer, the maximum with the current output is taken
+        self.apply_lut_scratch(image, scratch)
+        for index, max_value in enumerate(lut_dict[self.lut_name]):
+            if composite_buffer is None:
+                np.multiply(scratch, max_value, out = output[..., index], casting = 'unsafe')
+            elif max_value > 0:
+                np.multiply(scratch, max_value, out = composite_buffer, casting = 'unsafe')
+                np.maximum(output[..., index], composite_buffer, out = output[..., index])
+        return output
+
+def value_percentiles (pixel_values, percentile_list):
+    # pixels, or a selection of StackStatistics answered from the cached histograms
+    if isinstance(pixel_values, statistics.Selection):
+        return pixel_values.percentiles(percentile_list)
+    if pixel_values.dtype.kind in 'ui' and pixel_values.dtype.itemsize <= 2:
+        # same as np.percentile from the counts of values, without sorting
+        return convert.percentiles(pixel_values, percentile_list)
+    return [np.percentile(pixel_values, percentile) for percentile in percentile_list]
+
+def value_histogram (pixel_values, bins, range):
+    if isinstance(pixel_values, statistics.Selection):
+        return pixel_values.histogram(bins, range)
+    return np.histogram(pixel_values, bins = bins, range = range)
+
+def sample_planes (image_stack, channel, max_planes = default_sample_planes):
+    # evenly spaced (t, z) planes of the channel including the first and the last
+    image_array = image_stack.image_array
+    t_count, z_count = image_array.shape[0], image_array.shape[2]
+    plane_list = np.unique(np.linspace(0, t_count * z_count - 1, min(t_count * z_count, max_planes)).round().astype(int))
+    return np.stack([np.asarray(image_array[plane // z_count, channel, plane % z_count]) for plane in plane_list])
+
+def create_lut (image_stack, channel, tz_index = None, max_planes = None):
+    # the range is set by all planes of the channel (from the statistics), or by the plane at tz_index.
+    # with max_planes, sampled planes are used unless the statistics are computed or cached.
+    lut_name = "Gray" if image_stack.c_count == 1 else lut_names[channel % len(lut_names)]
+    if tz_index is not None:
+        pixel_values = image_stack.image_array[tz_index[0], channel, tz_index[1]]
+    elif max_planes is not None and image_stack.statistics.load_cached() == False:
+        pixel_values = sample_planes(image_stack, channel, max_planes)
+    else:
+        pixel_values = image_stack.statistics.selection(channel = channel)
+    return LUT(lut_name = lut_name, pixel_values = pixel_values)
+
+def create_lut_list (image_stack, tz_index = None, max_planes = None):
+    if image_stack is None:
+        return [LUT()]
+    with perf.timer("create_lut_list"):
+        return [create_lut(image_stack, channel, tz_index, max_planes) for channel in range(image_stack.c_count)]
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+import numpy as np
+from logging import getLogger
+from ome_types import to_xml, from_xml, OME
+from ome_types.model import Image, Pixels, TiffData, Channel
+from ome_types.model.simple_types import PixelType, ChannelID, UnitsLength, UnitsTime, Color
+
+# imported only when OME metadata is read or written (ome_types is slow to import)
+logger = getLogger(__name__)
+
+dtype_to_ometype = {
+    np.dtype(np.int8): PixelType.INT8,
+    np.dtype(np.int16): PixelType.INT16,
+    np.dtype(np.int32): PixelType.INT32,
+    np.dtype(np.uint8): PixelType.UINT8,
+    np.dtype(np.uint16): PixelType.UINT16,
+    np.dtype(np.uint32): PixelType.UINT32,
+    np.dtype(np.float32): PixelType.FLOAT,
+    np.dtype(np.float64): PixelType.DOUBLE,
+    np.dtype(np.complex64): PixelType.COMPLEXFLOAT,
+    np.dtype(np.complex128): PixelType.COMPLEXDOUBLE,
+}
+
+ome_ratio_to_um = {
+    UnitsLength.METER: 1.0e-6,
+    UnitsLength.MILLIMETER: 1.0e-3,
+    UnitsLength.MICROMETER: 1.0,
+    UnitsLength.NANOMETER: 1.0e3,
+    UnitsLength.PICOMETER: 1.0e6,
+    UnitsLength.ANGSTROM: 1.0e-1,
+    UnitsLength.INCH: 25.4e4,
+}
+
+ome_ratio_to_sec = {
+    UnitsTime.HOUR: 3600.0,
+    UnitsTime.MINUTE: 60.0,
+    UnitsTime.SECOND: 1.0,
+    UnitsTime.MILLISECOND: 1.0e-3,
+    UnitsTime.MICROSECOND: 1.0e-6,
+    UnitsTime.NANOSECOND: 1.0e-9,
+    UnitsTime.PICOSECOND: 1.0e-12,
+}
+
+ome_grayscale = Color(0xFFFFFF00)
+
+ome_rgb_colors = [
+    Color(0xFF000000), # Red
+    Color(0x00FF0000), # Green
+    Color(0x0000FF00), # Blue
+    ] #
+
+ome_multi_colors = [
+    Color(0xFF000000), # Red
+    Color(0x00FF0000), # Green
+    Color(0x0000FF00), # Blue
+    Color(0x00FFFF00), # Cyan
+    Color(0xFF00FF00), # Magenta
+    Color(0xFFFF0000), # Yellow
+    Color(0xFFFFFF00), # Gray
+    ]
+
+def read_metadata (ome_metadata, series = 0, default_voxel = None, default_finterval_sec = 1):
+    z_step_um, y_pixel_um, x_pixel_um = default_voxel
+    ome = from_xml(ome_metadata)
+    logger.debug('Reading ome metadata: {0}'.format(ome.images[series]))
+
+    metadata = {}
+    pixels = ome.images[series].pixels
+    if hasattr(pixels, "physical_size_x"):
+        ratio = ome_ratio_to_um.get(pixels.physical_size_x_unit, 1.0)
+        metadata['x_pixel_um'] = pixels.physical_size_x * ratio
+    else:
+        metadata['x_pixel_um'] = x_pixel_um
+
+    if hasattr(pixels, "physical_size_y"):
+        ratio = ome_ratio_to_um.get(pixels.physical_size_y_unit, 1.0)
+        metadata['y_pixel_um'] = pixels.physical_size_y * ratio
+    else:
+        metadata['y_pixel_um'] = y_pixel_um
+
+    if hasattr(pixels, "physical_size_z"):
+        ratio = ome_ratio_to_um.get(pixels.physical_size_z_unit, 1.0)
+        metadata['z_step_um'] = pixels.physical_size_z * ratio
+    else:
+        metadata['z_step_um'] = z_step_um
+
+    if hasattr(pixels, "time_increment"):
+        ratio = ome_ratio_to_sec.get(pixels.time_increment_unit, 1.0)
+        metadata['finterval_sec'] = pixels.time_increment * ratio
+    else:
+        metadata['finterval_sec'] = default_finterval_sec
+
+    return metadata
+
+def create_xml (name, dtype, shape, c_count, voxel_um, finterval_sec, has_s_axis = False):
+    t_count, _, z_count, height, width = shape[0:5]
+    samples_per_pixel = has_s_axis if has_s_axis else 1
+
+    ome_pixels = Pixels(id = "Pixels:0", dimension_order = 'XYZCT', \
+                       type = dtype_to_ometype[np.dtype(dtype)], \
+                       size_t = t_count, size_c = c_count, \
+                       size_z = z_count, size_y = height, size_x = width, \
+                       interleaved = True if has_s_axis else None)
+
+    ome_pixels.physical_size_x = voxel_um[2]
+    ome_pixels.physical_size_y = voxel_um[1]
+    ome_pixels.physical_size_z = voxel_um[0]
+    ome_pixels.physical_size_x_unit = UnitsLength.MICROMETER
+    ome_pixels.physical_size_y_unit = UnitsLength.MICROMETER
+    ome_pixels.physical_size_z_unit = UnitsLength.MICROMETER
+    ome_pixels.time_increment = finterval_sec
+    ome_pixels.time_increment_unit = UnitsTime.SECOND
+
+    ome_pixels.tiff_data_blocks = [TiffData(plane_count = t_count * c_count * z_count, ifd = 0)]
+    ome_pixels.channels = [Channel(samples_per_pixel = samples_per_pixel, \
+                                   id = ChannelID("Channel:0:{0}".format(index))) \
+                           for index in range(c_count)]
+
+    if c_count > 1:
+        if has_s_axis:
+            for index in range(c_count):
+                ome_pixels.channels[index].color = ome_rgb_colors[index % len(ome_rgb_colors)]
+        else:
+            for index in range(c_count):
+                ome_pixels.channels[index].color = ome_multi_colors[index % len(ome_multi_colors)]
+    else:
+        ome_pixels.channels[0].color = ome_grayscale
+
+    logger.debug("OME pixel data: {0}".format(ome_pixels))
+
+    ome_image = Image(name = name, id = "Image:0", pixels = ome_pixels)
+    return to_xml(OME(images = [ome_image])).encode()
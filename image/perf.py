@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+import os, sys, time, json, builtins, functools, threading
+from collections import deque
+from contextlib import contextmanager
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+default_startup_budget_ms = 3000
+
+class StartupProfiler:
+    def __init__ (self, start_time = None, budget_ms = default_startup_budget_ms):
+        self.start_time = time.perf_counter() if start_time is None else start_time
+        self.budget_ms = budget_ms
+        self.phase_list = []
+        self.import_list = []
+        self.original_import = None
+        self.import_stack = []
+
+    def elapsed_ms (self):
+        return (time.perf_counter() - self.start_time) * 1000
+
+    @contextmanager
+    def phase (self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phase_list.append((name, (time.perf_counter() - start) * 1000))
+
+    def mark (self, name):
+        self.phase_list.append((name, None, self.elapsed_ms()))
+
+    def install_import_hook (self):
+        # similar to python -X importtime: cumulative and self time of each first import
+        self.original_import = builtins.__import__
+
+        def timed_import (name, globals = None, locals = None, fromlist = (), level = 0):
+            module_names = self.target_modules(name, globals, fromlist, level)
+            if all([x in sys.modules for x in module_names]):
+                return self.original_import(name, globals, locals, fromlist, level)
+
+            loaded = [x for x in module_names if x in sys.modules]
+            self.import_stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                return self.original_import(name, globals, locals, fromlist, level)
+            finally:
+                total_ms = (time.perf_counter() - start) * 1000
+                child_ms = self.import_stack.pop()
+                if len(self.import_stack) > 0:
+                    self.import_stack[-1] += total_ms
+                # fromlist may contain attributes, which are not modules
+                new_names = [x for x in module_names if x in sys.modules and x not in loaded]
+                if len(new_names) > 0:
+                    label = new_names[0] if len(new_names) == 1 else f"{new_names[0]} (+{len(new_names) - 1})"
+                    self.import_list.append((label, total_ms, total_ms - child_ms, len(self.import_stack)))
+
+        builtins.__import__ = timed_import
+
+    def target_modules (self, name, globals, fromlist, level):
+        if level > 0:
+            package = '' if globals is None else (globals.get('__package__', None) or '')
+            base = package.rsplit('.', level - 1)[0] if level > 1 else package
+            name = f"{base}.{name}" if len(name) > 0 else base
+        return [name] + [f"{name}.{item}" for item in (fromlist or []) if item != '*']
+
+    def remove_import_hook (self):
+        if self.original_import is not None:
+            builtins.__import__ = self.original_import
+            self.original_import = None
+
+    def report (self, top_count = 20):
+        self.remove_import_hook()
+
+        lines = ["Startup profile:"]
+        lines.append("  Imports (cumulative ms / self ms):")
+        for name, total_ms, self_ms, depth in sorted(self.import_list, key = lambda x: -x[1])[:top_count]:
+            lines.append(f"    {total_ms:9.1f} {self_ms:9.1f}  {'  ' * depth}{name}")
+
+        lines.append("  Phases (ms):")
+        for item in self.phase_list:
+            if item[1] is None:
+                lines.append(f"    {item[2]:9.1f}  {item[0]} (since start)")
+            else:
+                lines.append(f"    {item[1]:9.1f}  {item[0]}")
+
+        logger.info("\n".join(lines))
+
+    def check_budget (self, name = "Time to first window"):
+        elapsed_ms = self.elapsed_ms()
+        if self.budget_ms is not None and elapsed_ms > self.budget_ms:
+            logger.warning(f"{name}: {elapsed_ms:.1f} ms exceeds the budget of {self.budget_ms} ms.")
+        else:
+            logger.info(f"{name}: {elapsed_ms:.1f} ms (budget {self.budget_ms} ms).")
+        return elapsed_ms
+
+default_rolling_size = 200
+
+class Instrument:
+    def __init__ (self, rolling_size = default_rolling_size):
+        self.enabled = False
+        self.tracing = False
+        self.rolling_size = rolling_size
+        self.origin = time.perf_counter()
+        self.reset()
+
+    def reset (self):
+        self.duration_dict = {}
+        self.counter_dict = {}
+        self.trace_list = []
+
+    def enable (self, enabled = True, tracing = None):
+        self.enabled = enabled
+        if tracing is not None:
+            self.tracing = tracing
+
+    def record (self, name, start, end):
+        durations = self.duration_dict.setdefault(name, deque(maxlen = self.rolling_size))
+        durations.append((end - start) * 1000)
+        if self.tracing:
+            self.trace_list.append({'name': name, 'cat': 'momotrack', 'ph': 'X',
+                                    'ts': (start - self.origin) * 1.0e6, 'dur': (end - start) * 1.0e6,
+                                    'pid': os.getpid(), 'tid': threading.get_ident()})
+
+    @contextmanager
+    def timer (self, name):
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter())
+
+    def timed (self, name):
+        def decorator (func):
+            @functools.wraps(func)
+            def wrapper (*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(name, start, time.perf_counter())
+            return wrapper
+        return decorator
+
+    def count (self, name, value = 1):
+        if not self.enabled:
+            return
+        self.counter_dict[name] = self.counter_dict.get(name, 0) + value
+        if self.tracing:
+            self.trace_list.append({'name': name, 'cat': 'momotrack', 'ph': 'C',
+                                    'ts': (time.perf_counter() - self.origin) * 1.0e6,
+                                    'pid': os.getpid(), 'args': {name: self.counter_dict[name]}})
+
+    def statistics (self):
+        stats_dict = {}
+        for name, durations in self.duration_dict.items():
+            values = sorted(durations)
+            stats_dict[name] = {'count': len(values),
+                                'p50': values[int(0.50 * (len(values) - 1))],
+                                'p95': values[int(0.95 * (len(values) - 1))],
+                                'max': values[-1]}
+        return stats_dict
+
+    def summary_text (self):
+        lines = ["{0:<20} {1:>7} {2:>7} {3:>7}".format("ms", "p50", "p95", "max")]
+        for name, stats in self.statistics().items():
+            lines.append(f"{name[:20]:<20} {stats['p50']:7.1f} {stats['p95']:7.1f} {stats['max']:7.1f}")
+        for name, value in self.counter_dict.items():
+            lines.append(f"{name[:20]:<20} {value:7d}")
+        return "\n".join(lines)
+
+    def export_trace (self, filename):
+        # readable by chrome://tracing and https://ui.perfetto.dev
+        trace = {'traceEvents': self.trace_list, 'displayTimeUnit': 'ms',
+                 'otherData': {'statistics': self.statistics(), 'counters': self.counter_dict}}
+        with open(filename, 'w') as f:
+            json.dump(trace, f)
+        logger.info(f"Trace exported: {filename}. Events: {len(self.trace_list)}")
+
+# shared by all modules (disabled unless requested)
+instrument = Instrument()
+timer = instrument.timer
+timed = instrument.timed
+count = instrument.count
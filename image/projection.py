@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+mode_names = {
+    'none': 'Z-slice',
+    'max': 'Maximum projection',
+    'mean': 'Mean projection',
+    'xz': 'XZ slice at cursor',
+    'yz': 'YZ slice at cursor',
+}
+
+cached_modes = ['max', 'mean']
+orthogonal_modes = ['xz', 'yz']
+
+def project (image, mode):
+    # image: ZYX
+    if mode == 'max':
+        return image.max(axis = 0)
+    elif mode == 'mean':
+        return image.mean(axis = 0, dtype = np.float32)
+    else:
+        raise ValueError(f"Unknown projection: {mode}")
+
+def orthogonal_slice (image, mode, x, y):
+    # XZ: Z rows and X columns, YZ: Y rows and Z columns (same orientation as the XY plane)
+    if mode == 'xz':
+        return image[:, min(max(y, 0), image.shape[1] - 1), :]
+    elif mode == 'yz':
+        return image[:, :, min(max(x, 0), image.shape[2] - 1)].T
+    else:
+        raise ValueError(f"Unknown orthogonal slice: {mode}")
+
+class ProjectionCache:
+    def __init__ (self, image_stack, max_workers = 1):
+        self.image_array = image_stack.image_array
+        self.projection_dict = {}
+        self.future_dict = {}
+        self.executor = ThreadPoolExecutor(max_workers = max_workers)
+
+    def is_built_for (self, image_stack):
+        return self.image_array is image_stack.image_array
+
+    def compute (self, key):
+        mode, t_index, c_index = key
+        projection = project(self.image_array[t_index, c_index], mode)
+        self.projection_dict[key] = projection
+        return projection
+
+    def projection (self, mode, t_index, c_index):
+        key = (mode, t_index, c_index)
+        if key in self.projection_dict:
+            return self.projection_dict[key]
+
+        # the frame on screen is not queued behind the background work
+        future = self.future_dict.pop(key, None)
+        if future is not None and future.cancel() == False:
+            return future.result()
+        return self.compute(key)
+
+    def precompute (self, mode, t_index, c_list):
+        # frames near the current one first
+        t_count = self.image_array.shape[0]
+        for t_next in sorted(range(t_count), key = lambda x: abs(x - t_index)):
+            for c_index in c_list:
+                key = (mode, t_next, c_index)
+                if key not in self.projection_dict and key not in self.future_dict:
+                    self.future_dict[key] = self.executor.submit(self.compute, key)
+        logger.debug(f"Projections queued: {mode}, {len(self.future_dict)}")
+
+    def shutdown (self):
+        self.executor.shutdown(wait = False, cancel_futures = True)
+        self.future_dict = {}
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+import numpy as np
+from collections import OrderedDict
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+default_tile_size = 512
+default_cache_planes = 32
+
+# planes smaller than this are drawn at once without tiles
+tiled_size_limit = 2048
+
+def downsample (image):
+    # 2x2 mean; the last row or column is dropped for odd sizes
+    height, width = (image.shape[0] // 2) * 2, (image.shape[1] // 2) * 2
+    image = image[:height, :width].astype(np.float32)
+    image = (image[0::2, 0::2] + image[1::2, 0::2] + image[0::2, 1::2] + image[1::2, 1::2]) / 4
+    return image
+
+def level_for_zoom (zoom_ratio, level_count):
+    # the coarsest level that still has at least one pixel per screen pixel
+    if zoom_ratio >= 100 or level_count <= 1:
+        return 0
+    level = int(np.floor(np.log2(100 / zoom_ratio)))
+    return max(0, min(level, level_count - 1))
+
+class Pyramid:
+    def __init__ (self, image_stack, tile_size = default_tile_size, cache_planes = default_cache_planes):
+        self.image_array = image_stack.image_array
+        self.tile_size = tile_size
+        self.cache_planes = cache_planes
+        self.plane_dict = OrderedDict()
+
+        # sub-resolutions stored in pyramidal OME-TIFF files are used if available
+        self.stored_levels = []
+        for array in image_stack.stored_pyramid_levels():
+            if array.shape[0:3] != self.image_array.shape[0:3]:
+                break
+            self.stored_levels.append(array)
+
+        height, width = self.image_array.shape[3:5]
+        self.level_count = 1
+        while max(height, width) > tile_size:
+            height, width = height // 2, width // 2
+            self.level_count += 1
+
+    def is_built_for (self, image_stack):
+        return self.image_array is image_stack.image_array
+
+    def plane (self, t_index, c_index, z_index, level = 0):
+        if level == 0:
+            return self.image_array[t_index, c_index, z_index]
+
+        if level <= len(self.stored_levels):
+            return self.stored_levels[level - 1][t_index, c_index, z_index]
+
+        key = (t_index, c_index, z_index, level)
+        if key in self.plane_dict:
+            self.plane_dict.move_to_end(key)
+            return self.plane_dict[key]
+
+        plane = downsample(self.plane(t_index, c_index, z_index, level - 1))
+        self.plane_dict[key] = plane
+        if len(self.plane_dict) > self.cache_planes:
+            self.plane_dict.popitem(last = False)
+        logger.debug(f"Pyramid plane created: {key}, {plane.shape}")
+        return plane
+
+    def level_shape (self, level):
+        if level == 0 or level > len(self.stored_levels):
+            height, width = self.image_array.shape[3:5]
+            return (height >> level, width >> level)
+        return self.stored_levels[level - 1].shape[3:5]
+
+    def visible_tiles (self, level, rect):
+        # rect (x0, y0, x1, y1) in pixels of level 0; returns (tile_y, tile_x) of the level
+        height, width = self.level_shape(level)
+        ratio = 2 ** level
+        x0, y0, x1, y1 = [value / ratio for value in rect]
+        x_range = range(max(0, int(x0 // self.tile_size)), min((width - 1) // self.tile_size, int(x1 // self.tile_size)) + 1)
+        y_range = range(max(0, int(y0 // self.tile_size)), min((height - 1) // self.tile_size, int(y1 // self.tile_size)) + 1)
+        return [(tile_y, tile_x) for tile_y in y_range for tile_x in x_range]
+
+    def tile_slices (self, tile_y, tile_x):
+        return (slice(tile_y * self.tile_size, (tile_y + 1) * self.tile_size),
+                slice(tile_x * self.tile_size, (tile_x + 1) * self.tile_size))
+
+    def clear (self):
+        self.plane_dict.clear()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+import csv, json
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from pathlib import Path
+from logging import getLogger
+from numpyencoder import NumpyEncoder
+
+logger = getLogger(__name__)
+
+spt_plugin_name = 'Particle Tracking'
+spt_records_suffix = '_track.json'
+
+spot_columns = ['index', 'time', 'channel', 'x', 'y', 'z', 'parent', 'label']
+
+def suggest_filename (image_filename, suffix = spt_records_suffix):
+    name = Path(image_filename).with_suffix('')
+    if name.suffix.lower() == '.ome':
+        name = name.with_suffix('')
+    return str(name) + suffix
+
+def load_records (records_filename):
+    with open(records_filename, 'r') as f:
+        records_dict = json.load(f)
+    logger.debug(f"Records loaded: {records_filename}")
+    return records_dict
+
+def save_records (records_filename, records_dict, plugin_name = spt_plugin_name):
+    summary = {'plugin_name': plugin_name, \
+               'last_update': datetime.now().astimezone().isoformat()}
+    records_dict = {'summary': summary} | records_dict
+
+    with open(records_filename, 'w') as f:
+        json.dump(records_dict, f, ensure_ascii = False, indent = 4, sort_keys = False, \
+                  separators = (',', ': '), cls = NumpyEncoder)
+    logger.debug(f"Records saved: {records_filename}")
+
+def create_spot (index = None, time = None, channel = None, x = None, y = None, z = None, parent = None):
+    spot = {'index': index, 'time': time, 'channel': channel, \
+            'x': x, 'y': y, 'z': z, 'parent': parent, 'label': None, \
+            'delete': False, \
+            'create': datetime.now().astimezone().isoformat(), \
+            'update': datetime.now().astimezone().isoformat()}
+    return spot
+
+def active_spots (records_dict):
+    return [spot for spot in records_dict.get('spot_list', []) if spot.get('delete', False) == False]
+
+class SpotIndex:
+    # spots that are not deleted, looked up by index, by parent and by (time, channel) sorted by z.
+    # spots added, moved between planes or deleted are updated in place (see SPT in plugin/particle.py);
+    # a list replaced or appended elsewhere is detected by is_built_for and indexed again.
+    def __init__ (self, spot_list):
+        self.spot_list = spot_list
+        self.length = len(spot_list)
+        self.index_dict = {}
+        self.children_dict = {}
+        self.plane_dict = {}
+        for spot in spot_list:
+            if spot.get('delete', False):
+                continue
+            if spot['index'] in self.index_dict:
+                logger.error(f"Multiple spots have the same index: {spot['index']}")
+            self.index_dict.setdefault(spot['index'], spot)
+            if spot['parent'] is not None:
+                self.children_dict.setdefault(spot['parent'], []).append(spot)
+            self.plane_dict.setdefault((spot['time'], spot['channel']), []).append(spot)
+
+        # sorting is stable; spots at the same z are in the order of the list
+        self.z_dict = {}
+        for key, plane_spots in self.plane_dict.items():
+            plane_spots.sort(key = lambda spot: spot['z'])
+            self.z_dict[key] = [spot['z'] for spot in plane_spots]
+
+    def is_built_for (self, spot_list):
+        return self.spot_list is spot_list and self.length == len(spot_list)
+
+    def find_spot (self, index):
+        return self.index_dict.get(index, None)
+
+    def find_children (self, spot):
+        return self.children_dict.get(spot['index'], [])
+
+    def spots_in_z_range (self, t_index, channel, z_lower, z_upper):
+        # spots with z_lower <= z <= z_upper, sorted by z
+        z_list = self.z_dict.get((t_index, channel), [])
+        start, stop = bisect_left(z_list, z_lower), bisect_right(z_list, z_upper)
+        return self.plane_dict[(t_index, channel)][start:stop] if start < stop else []
+
+    def add (self, spot):
+        # the spot has been appended to the list
+        self.length += 1
+        if spot.get('delete', False):
+            return
+        self.index_dict.setdefault(spot['index'], spot)
+        if spot['parent'] is not None:
+            self.children_dict.setdefault(spot['parent'], []).append(spot)
+        self.add_to_plane(spot)
+
+    def remove (self, spot):
+        # the spot is deleted; its children become roots
+        if self.index_dict.get(spot['index'], None) is spot:
+            del self.index_dict[spot['index']]
+        self.children_dict.pop(spot['index'], None)
+        if spot['parent'] in self.children_dict:
+            self.children_dict[spot['parent']] = [child for child in self.children_dict[spot['parent']] if child is not spot]
+        self.remove_from_plane(spot)
+
+    def add_to_plane (self, spot):
+        # after the spots at the same z
+        if spot.get('delete', False):
+            return
+        key = (spot['time'], spot['channel'])
+        plane_spots, z_list = self.plane_dict.setdefault(key, []), self.z_dict.setdefault(key, [])
+        position = bisect_right(z_list, spot['z'])
+        plane_spots.insert(position, spot)
+        z_list.insert(position, spot['z'])
+
+    def remove_from_plane (self, spot):
+        # called before time, channel or z of the spot is changed
+        key = (spot['time'], spot['channel'])
+        plane_spots, z_list = self.plane_dict.get(key, []), self.z_dict.get(key, [])
+        for position in range(bisect_left(z_list, spot['z']), bisect_right(z_list, spot['z'])):
+            if plane_spots[position] is spot:
+                del plane_spots[position]
+                del z_list[position]
+                return
+
+def export_spots_csv (records_dict, csv_filename, voxel_um = None):
+    columns = list(spot_columns)
+    if voxel_um is not None:
+        columns.extend(['x_um', 'y_um', 'z_um'])
+
+    with open(csv_filename, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for spot in active_spots(records_dict):
+            row = [spot.get(key, None) for key in spot_columns]
+            if voxel_um is not None:
+                row.extend([spot['x'] * voxel_um[2], spot['y'] * voxel_um[1], spot['z'] * voxel_um[0]])
+            writer.writerow(row)
+    logger.debug(f"Spots exported: {csv_filename}")
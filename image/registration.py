@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from . import gpuimage, lazy
+
+ndimage = lazy.lazy_import('scipy.ndimage')
+
+logger = getLogger(__name__)
+
+# projections are binned until the longer side is at most this size
+default_max_size = 512
+reference_modes = ['first', 'previous']
+log_polar_angles = 360
+
+# drift tables have a row per frame: dy, dx (pixels) and the angle (degrees, clockwise on screen).
+# frame t is the reference rotated by the angle around the center of the plane and shifted by (dy, dx).
+def rotation_matrix (angle):
+    # YX coordinates; a positive angle turns the X axis toward the Y axis (clockwise with Y down)
+    radian = np.deg2rad(angle)
+    return np.array([[np.cos(radian), np.sin(radian)], [-np.sin(radian), np.cos(radian)]])
+
+def plane_center (shape):
+    return (np.array(shape[-2:], dtype = np.float64) - 1) / 2
+
+def frame_matrix (drift, shape):
+    # matrix and offset mapping YX in the reference to YX in the frame (the ndimage convention)
+    matrix = rotation_matrix(drift[2])
+    center = plane_center(shape)
+    return matrix, center - matrix @ center + drift[0:2]
+
+def default_binning (shape, max_size = default_max_size):
+    return max(1, int(np.ceil(max(shape[-2:]) / max_size)))
+
+def bin_plane (plane, binning):
+    if binning <= 1:
+        return plane.astype(np.float32)
+    height, width = (plane.shape[0] // binning) * binning, (plane.shape[1] // binning) * binning
+    plane = plane[0:height, 0:width].reshape(height // binning, binning, width // binning, binning)
+    return plane.mean(axis = (1, 3), dtype = np.float32)
+
+def frame_projection (image_array, t_index, channel, binning):
+    # maximum projection along Z, binned in YX
+    return bin_plane(np.asarray(image_array[t_index, channel]).max(axis = 0), binning)
+
+def hann_window (shape):
+    return np.outer(np.hanning(shape[0]), np.hanning(shape[1])).astype(np.float32)
+
+def windowed_fft (plane):
+    plane = plane - plane.mean()
+    return np.fft.fft2(plane * hann_window(plane.shape))
+
+def peak_position (correlation):
+    # the peak refined by parabolas along each axis; positions beyond the half are negative
+    index = np.unravel_index(np.argmax(correlation), correlation.shape)
+    position = []
+    for axis, length in enumerate(correlation.shape):
+        center = correlation[index]
+        lower = correlation[tuple([(index[i] - 1) % length if i == axis else index[i] for i in range(2)])]
+        upper = correlation[tuple([(index[i] + 1) % length if i == axis else index[i] for i in range(2)])]
+        denominator = lower - 2 * center + upper
+        subpixel = 0.5 * (lower - upper) / denominator if denominator != 0 else 0.0
+        value = index[axis] + subpixel
+        position.append(value - length if value > length / 2 else value)
+    return np.array(position), float(correlation[index])
+
+def phase_correlation (reference_fft, image_fft):
+    # displacement of the image content relative to the reference
+    cross_power = image_fft * np.conj(reference_fft)
+    cross_power /= np.abs(cross_power) + 1e-12
+    return peak_position(np.fft.ifft2(cross_power).real)
+
+def log_polar_magnitude (image_fft):
+    # the magnitude does not depend on translations; rotations become shifts along the angle axis
+    magnitude = np.fft.fftshift(np.abs(image_fft))
+    height, width = magnitude.shape
+    center = plane_center(magnitude.shape)
+    radius = min(height, width) / 2
+    highpass = np.outer(1 - np.cos(np.pi * np.fft.fftshift(np.fft.fftfreq(height))) ** 2,
+                        1 - np.cos(np.pi * np.fft.fftshift(np.fft.fftfreq(width))) ** 2)
+    magnitude = magnitude * highpass
+
+    # the magnitude is symmetric, so 180 degrees are sampled
+    angles = np.deg2rad(np.arange(log_polar_angles) * 180 / log_polar_angles)
+    radii = np.exp(np.linspace(0, np.log(radius), int(radius)))
+    y = center[0] + np.sin(angles)[:, np.newaxis] * radii[np.newaxis, :]
+    x = center[1] + np.cos(angles)[:, np.newaxis] * radii[np.newaxis, :]
+    return ndimage.map_coordinates(magnitude, [y, x], order = 1)
+
+def rotation_angle (reference_polar_fft, image_polar_fft):
+    position, _ = phase_correlation(reference_polar_fft, image_polar_fft)
+    return float(position[0] * 180 / log_polar_angles)
+
+def register_pair (reference, image, rigid = False, reference_ffts = None):
+    # drift (dy, dx, angle) of the image relative to the reference in pixels of the binned planes
+    reference_fft, reference_polar_fft = reference_ffts if reference_ffts is not None \
+                                         else reference_transforms(reference, rigid)
+    angle = 0.0
+    if rigid:
+        angle = rotation_angle(reference_polar_fft, np.fft.fft2(log_polar_magnitude(windowed_fft(image))))
+        if angle != 0.0:
+            # the rotation is removed first; the remaining shift is then in the reference axes
+            matrix, offset = frame_matrix([0.0, 0.0, angle], image.shape)
+            image = ndimage.affine_transform(image, matrix, offset = offset, order = 1, mode = 'nearest')
+
+    shift, _ = phase_correlation(reference_fft, windowed_fft(image))
+    return np.concatenate([rotation_matrix(angle) @ shift, [angle]])
+
+def reference_transforms (reference, rigid = False):
+    reference_fft = windowed_fft(reference)
+    reference_polar_fft = np.fft.fft2(log_polar_magnitude(reference_fft)) if rigid else None
+    return reference_fft, reference_polar_fft
+
+def scale_drift (drift, binning, binned_shape, shape):
+    # binned pixel j is centered at binning * j + (binning - 1) / 2 in the plane
+    binned_center = binning * plane_center(binned_shape) + (binning - 1) / 2
+    matrix = rotation_matrix(drift[2])
+    shift = binning * drift[0:2] + (np.identity(2) - matrix) @ (binned_center - plane_center(shape))
+    return np.concatenate([shift, drift[2:3]])
+
+def compose_drift (previous, drift):
+    # drift of frame t relative to the reference from the one of t - 1 and the one between t - 1 and t
+    matrix = rotation_matrix(drift[2])
+    return np.concatenate([matrix @ previous[0:2] + drift[0:2], [previous[2] + drift[2]]])
+
+def estimate_drift (image_array, channel = 0, reference = 'first', binning = None, rigid = False, max_workers = None):
+    # image_array: TCZYX. frames are registered in threads (FFTs and projections release the GIL).
+    # 'previous' registers each frame to the one before and accumulates the drifts.
+    if reference not in reference_modes:
+        raise ValueError(f"Unknown reference: {reference}")
+    shape = image_array.shape
+    binning = default_binning(shape) if binning is None else binning
+    max_workers = gpuimage.parallel_workers() if max_workers is None else max_workers
+
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        projections = list(executor.map(lambda t_index: frame_projection(image_array, t_index, channel, binning), \
+                                        range(shape[0])))
+        if reference == 'first':
+            reference_ffts = reference_transforms(projections[0], rigid)
+            pair_func = lambda t_index: register_pair(projections[0], projections[t_index], rigid, reference_ffts)
+        else:
+            pair_func = lambda t_index: register_pair(projections[t_index - 1], projections[t_index], rigid)
+        drift_list = [np.zeros(3)] + list(executor.map(pair_func, range(1, shape[0])))
+
+    drift_table = np.array([scale_drift(drift, binning, projections[0].shape, shape) for drift in drift_list])
+    if reference == 'previous':
+        for t_index in range(1, shape[0]):
+            drift_table[t_index] = compose_drift(drift_table[t_index - 1], drift_table[t_index])
+
+    logger.debug(f"Drift estimated: {shape[0]} frames, binning {binning}, max shift {np.abs(drift_table[:, 0:2]).max():.1f}")
+    return drift_table
+
+def correct_frame (image, drift, gpu_id = None):
+    # image: ZYX of frame t, resampled to the reference (zero outside of the frame)
+    if drift[2] == 0.0:
+        return gpuimage.shift(image, [0.0, -drift[0], -drift[1]], gpu_id = gpu_id)
+
+    matrix, offset = frame_matrix(drift, image.shape)
+    matrix_zyx = np.identity(4)
+    matrix_zyx[1:3, 1:3] = matrix
+    matrix_zyx[1:3, 3] = offset
+    return gpuimage.affine_transform(image, matrix_zyx, gpu_id = gpu_id, mode = 'constant')
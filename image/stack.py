@@ -1,14 +1,13 @@
 #!/usr/bin/env python
 
-import io, tifffile, json
+import io, json, itertools
 import numpy as np
 from pathlib import Path
 from logging import getLogger
-from progressbar import ProgressBar
-from ome_types import to_xml, from_xml, OME
-from ome_types.model import Image, Pixels, TiffData, Channel
-from ome_types.model.simple_types import PixelType, ChannelID, UnitsLength, UnitsTime, Color
-from . import gpuimage
+from . import convert, gpuimage, header, lazy, registration, statistics, storage, transform, virtual
+
+# heavy modules are loaded on first use (see also image/ome.py)
+tifffile = lazy.lazy_import('tifffile')
 
 logger = getLogger(__name__)
 
@@ -18,6 +17,10 @@ default_finterval_sec = 1
 default_voxel = [default_z_step_um, default_pixel_um, default_pixel_um]
 default_shape = (1, 1, 1, 256, 256)
 default_dtype = np.uint16
+default_page_batch = 64
+
+# threads decoding compressed pages (None: chosen by tifffile)
+decode_workers = None
 
 def with_suffix (filename, suffix):
     filename = Path(filename).with_suffix('')
@@ -27,57 +30,6 @@ def with_suffix (filename, suffix):
 
 ome_size_limit = int(0.9 * (2 ** 31))
 
-dtype_to_ometype = {
-    np.dtype(np.int8): PixelType.INT8,
-    np.dtype(np.int16): PixelType.INT16,
-    np.dtype(np.int32): PixelType.INT32,
-    np.dtype(np.uint8): PixelType.UINT8,
-    np.dtype(np.uint16): PixelType.UINT16,
-    np.dtype(np.uint32): PixelType.UINT32,
-    np.dtype(np.float32): PixelType.FLOAT,
-    np.dtype(np.float64): PixelType.DOUBLE,
-    np.dtype(np.complex64): PixelType.COMPLEXFLOAT,
-    np.dtype(np.complex128): PixelType.COMPLEXDOUBLE,
-}
-
-ome_ratio_to_um = {
-    UnitsLength.METER: 1.0e-6,
-    UnitsLength.MILLIMETER: 1.0e-3,
-    UnitsLength.MICROMETER: 1.0,
-    UnitsLength.NANOMETER: 1.0e3,
-    UnitsLength.PICOMETER: 1.0e6,
-    UnitsLength.ANGSTROM: 1.0e-1,
-    UnitsLength.INCH: 25.4e4,
-}
-
-ome_ratio_to_sec = {
-    UnitsTime.HOUR: 3600.0,
-    UnitsTime.MINUTE: 60.0,
-    UnitsTime.SECOND: 1.0,
-    UnitsTime.MILLISECOND: 1.0e-3,
-    UnitsTime.MICROSECOND: 1.0e-6,
-    UnitsTime.NANOSECOND: 1.0e-9,
-    UnitsTime.PICOSECOND: 1.0e-12,
-}
-
-ome_grayscale = Color(0xFFFFFF00)
-
-ome_rgb_colors = [
-    Color(0xFF000000), # Red
-    Color(0x00FF0000), # Green
-    Color(0x0000FF00), # Blue
-    ] #
-
-ome_multi_colors = [
-    Color(0xFF000000), # Red
-    Color(0x00FF0000), # Green
-    Color(0x0000FF00), # Blue
-    Color(0x00FFFF00), # Cyan
-    Color(0xFF00FF00), # Magenta
-    Color(0xFFFF0000), # Yellow
-    Color(0xFFFFFF00), # Gray
-    ]
-
 imagej_ratio_to_um = {
     'm': 1.0e6,
     'mm': 1.0e3,
@@ -116,6 +68,10 @@ class Stack:
         self.axes = None
         self.has_s_axis = False
         self.image_array = None
+        self.pyramid_levels = []
+        self.pyramid_base = None
+        self.resample_count = 0
+        self.statistics = statistics.StackStatistics(self)
 
     def alloc_zero_image (self, shape = default_shape, dtype = default_dtype, \
                           voxel_um = default_voxel, finterval_sec = default_finterval_sec):
@@ -137,46 +93,266 @@ class Stack:
                     'axes': self.axes}
         return settings
 
-    def read_image (self, fileio, series = 0, keep_s_axis = False):
+    def read_image (self, fileio, series = 0, keep_s_axis = False, max_workers = None, t_range = None, z_range = None, \
+                    c_list = None, y_range = None, x_range = None):
+        for _ in self.read_image_by_page(fileio, series = series, keep_s_axis = keep_s_axis, max_workers = max_workers, \
+                                         t_range = t_range, z_range = z_range, c_list = c_list, \
+                                         y_range = y_range, x_range = x_range):
+            pass
+
+    def read_image_by_page (self, fileio, series = 0, keep_s_axis = False, max_workers = None, \
+                            t_range = None, z_range = None, c_list = None, y_range = None, x_range = None, \
+                            batch_size = default_page_batch):
+        # yields (decoded pages, total pages). image_array is allocated from the header and filled in place,
+        # the planes at T = 0 and Z = 0 first. pages in a batch are decoded by max_workers threads.
+        # ranges are (start, stop) and c_list selects channels of the file (before samples are split).
+        max_workers = decode_workers if max_workers is None else max_workers
+        range_dict = {'T': t_range, 'Z': z_range, 'Y': y_range, 'X': x_range}
+        has_region = any([item is not None for item in range_dict.values()]) or c_list is not None
+
+        backend = storage.find_backend(fileio)
+        if backend is not None:
+            self.read_image_by_backend(backend, fileio, series = series)
+            if has_region:
+                # only the chunks in the region are read
+                self.crop_by_slice([slice(*range_dict[axis]) if range_dict.get(axis, None) is not None else slice(None) \
+                                    for axis in 'TCZYX'], c_list = c_list)
+                self.pyramid_levels = []
+                self.pyramid_base = self.image_array
+            yield 1, 1
+            return
+
         try:
             self.reset_stack()
 
             with tifffile.TiffFile(fileio) as tiff:
-                axes = tiff.series[series].axes.upper()
-                image_array = tiff.asarray(series = series)
-                metadata = self.__read_metadata(tiff, series = series)
+                header_dict = self.__cached_header(tiff, fileio, series = series)
+                axes = header_dict['axes']
+                index_ranges = {axis: range(count)[slice(*range_dict[axis])] if range_dict.get(axis, None) is not None \
+                                else range(count) for axis, count in zip(axes, header_dict['shape'])}
+                if c_list is not None:
+                    c_count = dict(zip(axes, header_dict['shape'])).get('C', 1)
+                    index_ranges['C'] = [range(c_count)[index] for index in c_list]
+                shape = self.__reorder_shape([len(index_ranges[axis]) for axis in axes], axes, keep_s_axis = keep_s_axis)
+                if min(shape) == 0:
+                    raise Exception(f"Empty region: {shape}")
+
+                self.image_array = np.zeros(shape, dtype = np.dtype(header_dict['dtype']).newbyteorder('='))
+                self.update_dimensions()
+                self.__set_metadata(header_dict['metadata'])
+
+                yield from self.__decode_pages(tiff, fileio, series, index_ranges, keep_s_axis, max_workers, batch_size)
+
+                # sub-resolutions of pyramidal OME-TIFF files (used for drawing large planes)
+                if has_region == False:
+                    self.pyramid_levels = [self.__pyramid_level(tiff, fileio, series, level, keep_s_axis, max_workers) \
+                                           for level in range(1, len(tiff.series[series].levels))]
+            self.pyramid_base = self.image_array
+
+            # planes were filled after the array was allocated
+            self.statistics.invalidate()
+            if has_region == False:
+                self.statistics.set_source(fileio, series = series, keep_s_axis = keep_s_axis)
 
-            if (set(axes) <= {'T', 'C', 'Z', 'Y', 'X', 'S'}) == False:
-                raise Exception('Unknown axis format: {0}'.format(axes))
+            logger.debug("Image shaped into: {0} {1}".format(str(self.image_array.shape), self.axes))
 
-            for axis in 'ZCTYX':
-                if axis not in axes:
-                    image_array = image_array[np.newaxis]
-                    axes = axis + axes
+        except OSError:
+            self.reset_stack()
+            raise
 
-            if 'S' in axes:
-                axis_order = [axes.find(axis) for axis in 'TCZYXS']
-            else:
-                axis_order = [axes.find(axis) for axis in 'TCZYX']
+    def __pyramid_level (self, tiff, fileio, series, level, keep_s_axis, max_workers):
+        # planes are read when drawn if zarr is available (the store opens the file again after it is closed)
+        tiff_level = tiff.series[series].levels[level]
+        axes = tiff_level.axes.upper()
+        if isinstance(fileio, (str, Path)) and set(axes) <= set('TCZYX'):
+            try:
+                zarr = storage.zarr_backend.import_zarr()
+                return storage.LazyArray(zarr.open(tiff.aszarr(series = series, level = level), mode = 'r'), axes)
+            except ImportError:
+                logger.debug("Pyramid levels are read at once (no zarr).")
+        return self.__reorder_axes(tiff_level.asarray(maxworkers = max_workers), axes, keep_s_axis = keep_s_axis)
+
+    def __decode_pages (self, tiff, fileio, series, index_ranges, keep_s_axis, max_workers, batch_size):
+        tiff_series = tiff.series[series]
+        axes = tiff_series.axes.upper()
+        page_axes = [axis for axis in axes if axis not in 'YXS']
+        page_shape = [tiff_series.shape[axes.index(axis)] for axis in page_axes]
+        plane_axes = [axis for axis in axes if axis in 'YXS']
+        plane_shape = [tiff_series.shape[axes.index(axis)] for axis in plane_axes]
+        plane_order = [plane_axes.index(axis) for axis in 'YXS' if axis in plane_axes]
+
+        # YX regions are cut from each page (all samples)
+        plane_slices = tuple([slice(index_ranges[axis].start, index_ranges[axis].stop) if axis in 'YX' else slice(None) \
+                              for axis in plane_axes])
+        has_plane_region = any([len(index_ranges[axis]) < count for axis, count in zip(plane_axes, plane_shape) if axis in 'YX'])
+
+        # pages may not match the shape (for example, inconsistent OME metadata)
+        if len(tiff_series.pages) != int(np.prod(page_shape)):
+            logger.debug("Reading the series at once.")
+            image_array = tiff.asarray(series = series, maxworkers = max_workers)
+            image_array = image_array[tuple([slice(index_ranges[axis].start, index_ranges[axis].stop) \
+                                             if isinstance(index_ranges[axis], range) else index_ranges[axis] for axis in axes])]
+            self.image_array[:] = self.__reorder_axes(image_array, axes, keep_s_axis = keep_s_axis)
+            yield 1, 1
+            return
+
+        read_func = lambda batch: np.asarray(tiff.asarray(series = series, key = batch, maxworkers = max_workers)) \
+                                  .reshape([len(batch)] + plane_shape)[(slice(None),) + plane_slices]
+
+        # uncompressed contiguous pages are copied from a memory map
+        memory_mapped = False
+        if tiff_series.dataoffset is not None and isinstance(fileio, (str, Path)):
+            try:
+                pages = tifffile.memmap(fileio, series = series, mode = 'r').reshape([-1] + plane_shape)
+                read_func = lambda batch: pages[(batch,) + plane_slices]
+                memory_mapped = True
+            except ValueError:
+                pass
+
+        # strips or tiles outside of a YX region are not decoded (needs zarr)
+        zarr_store = None
+        if memory_mapped == False and has_plane_region and len(tiff_series.pages[0].dataoffsets) > 1:
+            try:
+                zarr = storage.zarr_backend.import_zarr()
+                zarr_store = tiff.aszarr(series = series, level = 0)
+                zarr_array = zarr.open(zarr_store, mode = 'r')
+                read_func = lambda batch: np.stack([zarr_array[tuple(np.unravel_index(page_index, page_shape)) + plane_slices] \
+                                                    for page_index in batch])
+            except ImportError:
+                logger.debug("Whole pages are decoded for the region (no zarr).")
+
+        # the planes at T = 0 and Z = 0 are shown while the others are loading
+        position_list = list(itertools.product(*[range(len(index_ranges[axis])) for axis in page_axes]))
+        position_list.sort(key = lambda position: any([index > 0 for axis, index in zip(page_axes, position) if axis in 'TZ']))
+        first_count = sum([1 for position in position_list \
+                           if all([index == 0 for axis, index in zip(page_axes, position) if axis in 'TZ'])])
+        batch_list = [position_list[0:first_count]] + \
+                     [position_list[start:start + batch_size] for start in range(first_count, len(position_list), batch_size)]
+
+        c_count = len(index_ranges['C']) if 'C' in axes else 1
+        decoded = 0
+        try:
+            for batch in batch_list:
+                page_indices = [int(np.ravel_multi_index([index_ranges[axis][index] for axis, index in zip(page_axes, position)], \
+                                                         page_shape)) if len(page_axes) > 0 else 0 for position in batch]
+                planes = np.asarray(read_func(page_indices))
+                for position, plane in zip(batch, planes):
+                    index_dict = dict(zip(page_axes, position))
+                    t_index, c_index, z_index = [index_dict.get(axis, 0) for axis in 'TCZ']
+                    plane = plane.transpose(plane_order)
+                    if plane.ndim > 2 and keep_s_axis == False:
+                        # samples are placed after the channels like __concat_s_channel
+                        self.image_array[t_index, c_index::c_count, z_index] = np.moveaxis(plane, -1, 0)
+                    else:
+                        self.image_array[t_index, c_index, z_index] = plane
+                decoded += len(batch)
+                yield decoded, len(position_list)
+        finally:
+            if zarr_store is not None:
+                zarr_store.close()
+
+    def read_header (self, fileio, series = 0, keep_s_axis = False):
+        # dimensions and metadata without reading pixels; image_array is left None
+        backend = storage.find_backend(fileio)
+        if backend is not None:
+            image_array, _, metadata = backend.read(fileio, series = series)
+            header_dict = {'axes': 'TCZYX', 'shape': list(image_array.shape), 'dtype': str(image_array.dtype), \
+                           'metadata': self.__backend_metadata(metadata)}
+        else:
+            header_dict = header.header_cache.get(fileio, series = series)
+            if header_dict is None:
+                with tifffile.TiffFile(fileio) as tiff:
+                    header_dict = self.__cached_header(tiff, fileio, series = series)
+
+        self.reset_stack()
+        shape = self.__reorder_shape(header_dict['shape'], header_dict['axes'], keep_s_axis = keep_s_axis)
+        self.__set_dimensions(shape)
+        self.__set_metadata(header_dict['metadata'])
+        return self.archive_properties() | {'shape': list(shape), 'dtype': header_dict['dtype']}
+
+    def __cached_header (self, tiff, fileio, series = 0):
+        # parsing OME XML is slow; files opened again reuse the metadata stored on disk
+        header_dict = header.header_cache.get(fileio, series = series)
+        if header_dict is not None:
+            return header_dict
+
+        tiff_series = tiff.series[series]
+        axes = tiff_series.axes.upper()
+        if (set(axes) <= {'T', 'C', 'Z', 'Y', 'X', 'S'}) == False:
+            raise Exception('Unknown axis format: {0}'.format(axes))
+
+        header_dict = {'axes': axes, 'shape': list(tiff_series.shape), 'dtype': str(tiff_series.dtype), \
+                       'metadata': self.__read_metadata(tiff, series = series)}
+        header.header_cache.put(fileio, series, header_dict)
+        return header_dict
+
+    def __backend_metadata (self, metadata):
+        return {'z_step_um': default_z_step_um, 'y_pixel_um': default_pixel_um, \
+                'x_pixel_um': default_pixel_um, 'finterval_sec': default_finterval_sec} | metadata
+
+    def read_image_by_backend (self, backend, filename, series = 0):
+        # image_array is a lazy array; planes are read when indexed
+        self.reset_stack()
+        image_array, level_list, metadata = backend.read(filename, series = series)
 
-            logger.debug("Current axis: {0}. Order: {1}.".format(axes, axis_order))
-            image_array = image_array.transpose(axis_order)
+        self.image_array = image_array
+        self.pyramid_levels = level_list
+        self.pyramid_base = self.image_array
+        self.update_dimensions()
+        self.__set_metadata(self.__backend_metadata(metadata))
+        logger.debug("Image opened by {0}: {1} {2}".format(backend.name, str(self.image_array.shape), self.axes))
 
-            if ('S' in axes) and (keep_s_axis == False):
-                logger.info("The S axis is converted to the C axis.")
-                image_array = self.__concat_s_channel(image_array)
+    def read_virtual (self, filenames, series = None, max_handles = virtual.default_max_handles):
+        # files (or series) are concatenated along T; planes are read when indexed
+        self.reset_stack()
+        image_array, entry_list = virtual.open_virtual(filenames, series = series, max_handles = max_handles)
 
-            self.image_array = image_array
-            self.update_dimensions()
-            self.__set_metadata(metadata)
+        with tifffile.TiffFile(entry_list[0].filename) as tiff:
+            metadata = self.__cached_header(tiff, entry_list[0].filename, series = entry_list[0].series)['metadata']
 
-            logger.debug("Image shaped into: {0} {1}".format(str(self.image_array.shape), self.axes))
+        self.image_array = image_array
+        self.update_dimensions()
+        self.__set_metadata(metadata)
+        logger.debug("Virtual stack: {0} series. Shape: {1}".format(len(entry_list), str(self.image_array.shape)))
 
-        except OSError:
-            self.reset_stack()
-            raise
+    def __reorder_axes (self, image_array, axes, keep_s_axis = False):
+        for axis in 'ZCTYX':
+            if axis not in axes:
+                image_array = image_array[np.newaxis]
+                axes = axis + axes
+
+        if 'S' in axes:
+            axis_order = [axes.find(axis) for axis in 'TCZYXS']
+        else:
+            axis_order = [axes.find(axis) for axis in 'TCZYX']
+
+        logger.debug("Current axis: {0}. Order: {1}.".format(axes, axis_order))
+        image_array = image_array.transpose(axis_order)
+
+        if ('S' in axes) and (keep_s_axis == False):
+            logger.info("The S axis is converted to the C axis.")
+            image_array = self.__concat_s_channel(image_array)
+
+        return image_array
+
+    def __reorder_shape (self, shape, axes, keep_s_axis = False):
+        # the shape __reorder_axes gives, without an array
+        shape_dict = dict(zip(axes, shape))
+        output_shape = [shape_dict.get(axis, 1) for axis in 'TCZYX']
+        if 'S' in axes:
+            if keep_s_axis:
+                output_shape.append(shape_dict['S'])
+            else:
+                output_shape[1] = output_shape[1] * shape_dict['S']
+        return tuple(output_shape)
 
     def read_image_by_chunk (self, fileio, series = 0, keep_s_axis = False, chunk_size = 1024 * 1024):
+        # chunked stores are opened lazily and need no progress
+        if storage.find_backend(fileio) is not None:
+            self.read_image(fileio, series = series, keep_s_axis = keep_s_axis)
+            yield Path(fileio).stat().st_size
+            return
+
         try:
             byte_data = bytearray()
             with open(fileio, 'rb') as file:
@@ -195,9 +371,17 @@ class Stack:
         self.update_dimensions()
 
     def __concat_s_channel (self, image_array):
-        image_list = [image_array[..., index] for index in range(image_array.shape[-1])]
-        image_array = np.concatenate(image_list, axis = 1)
-        return image_array
+        # TCZYXS to T(SC)ZYX in one copy; channel s * c_count + c is sample s of channel c
+        shape = image_array.shape
+        return np.moveaxis(image_array, -1, 1).reshape((shape[0], shape[-1] * shape[1]) + tuple(shape[2:-1]))
+
+    def __s_channel_planes (self, image_array):
+        # YX planes in the order of __concat_s_channel without copying the stack
+        t_count, c_count, z_count, s_count = image_array.shape[0], image_array.shape[1], image_array.shape[2], image_array.shape[-1]
+        for t_index in range(t_count):
+            for channel in range(s_count * c_count):
+                for z_index in range(z_count):
+                    yield image_array[t_index, channel % c_count, z_index, ..., channel // c_count]
 
     def save_imagej_tiff (self, filename, dtype = None):
         logger.debug("Saving ImageJ. Shape: {0}. Type: {1}".format(self.image_array.shape, self.image_array.dtype))
@@ -229,60 +413,55 @@ class Stack:
                 bigtiff = False
 
         if self.has_s_axis:
-            output_array = self.__concat_s_channel(output_array)
-            c_count = output_array.shape[1]
-            samples_per_pixel = self.has_s_axis
+            # samples are written as channels plane by plane
+            shape = output_array.shape
+            output_shape = (shape[0], shape[-1] * shape[1]) + tuple(shape[2:-1])
+            output_data = self.__s_channel_planes(output_array)
+            c_count = output_shape[1]
         else:
+            output_shape = output_array.shape
+            output_data = output_array
             c_count = self.c_count
-            samples_per_pixel = 1
-
-        ome_pixels = Pixels(id = "Pixels:0", dimension_order = 'XYZCT', \
-                           type = dtype_to_ometype[output_array.dtype], \
-                           size_t = self.t_count, size_c = c_count, \
-                           size_z = self.z_count, size_y = self.height, size_x = self.width, \
-                           interleaved = True if self.has_s_axis else None)
-
-        ome_pixels.physical_size_x = self.voxel_um[2]
-        ome_pixels.physical_size_y = self.voxel_um[1]
-        ome_pixels.physical_size_z = self.voxel_um[0]
-        ome_pixels.physical_size_x_unit = UnitsLength.MICROMETER
-        ome_pixels.physical_size_y_unit = UnitsLength.MICROMETER
-        ome_pixels.physical_size_z_unit = UnitsLength.MICROMETER
-        ome_pixels.time_increment = self.finterval_sec
-        ome_pixels.time_increment_unit = UnitsTime.SECOND
-
-        ome_pixels.tiff_data_blocks = [TiffData(plane_count = self.t_count * c_count * self.z_count, ifd = 0)]
-        ome_pixels.channels = [Channel(samples_per_pixel = samples_per_pixel, \
-                                       id = ChannelID("Channel:0:{0}".format(index))) \
-                               for index in range(c_count)]
-
-        if c_count > 1:
-            if self.has_s_axis:
-                for index in range(c_count):
-                    ome_pixels.channels[index].color = ome_rgb_colors[index % len(ome_rgb_colors)]
-            else:
-                for index in range(c_count):
-                    ome_pixels.channels[index].color = ome_multi_colors[index % len(ome_multi_colors)]
-        else:
-            ome_pixels.channels[0].color = ome_grayscale
-
-        logger.debug("OME pixel data: {0}".format(ome_pixels))
 
-        ome_image = Image(name = filename, id = "Image:0", pixels = ome_pixels)
-        ome_xml = to_xml(OME(images = [ome_image])).encode()
+        from . import ome
+        ome_xml = ome.create_xml(filename, output_array.dtype, output_shape, c_count, \
+                                 self.voxel_um, self.finterval_sec, has_s_axis = self.has_s_axis)
 
         with open(filename, "wb") as fileio:
             with tifffile.TiffWriter(fileio, bigtiff = bigtiff) as tiff:
-                tiff.write(output_array, description = ome_xml, metadata = None)
+                tiff.write(output_data, shape = output_shape, dtype = output_array.dtype, description = ome_xml, metadata = None)
+
+    def stored_pyramid_levels (self):
+        # invalid after the image array is replaced by transforms
+        if self.pyramid_base is self.image_array:
+            return self.pyramid_levels
+        return []
+
+    def save_ome_zarr (self, filename, dtype = None, chunks = None):
+        logger.debug("Saving OME-Zarr. Shape: {0}. Type: {1}".format(self.image_array.shape, self.image_array.dtype))
+        if dtype is None:
+            output_array = self.image_array
+        else:
+            logger.info("Changing dtype: {0}".format(dtype))
+            output_array = self.image_array.astype(dtype)
+
+        if self.has_s_axis:
+            output_array = self.__concat_s_channel(output_array)
+
+        storage.zarr_backend.write(filename, output_array, self.voxel_um, self.finterval_sec, chunks = chunks)
 
     def update_dimensions (self):
-        self.t_count = self.image_array.shape[0]
-        self.c_count = self.image_array.shape[1]
-        self.z_count = self.image_array.shape[2]
-        self.height = self.image_array.shape[3]
-        self.width = self.image_array.shape[4]
-        if len(self.image_array.shape) > 5:
-            self.s_count = self.image_array.shape[5]
+        self.statistics.invalidate()
+        self.__set_dimensions(self.image_array.shape)
+
+    def __set_dimensions (self, shape):
+        self.t_count = shape[0]
+        self.c_count = shape[1]
+        self.z_count = shape[2]
+        self.height = shape[3]
+        self.width = shape[4]
+        if len(shape) > 5:
+            self.s_count = shape[5]
             self.has_s_axis = True
             self.axes = 'TCZYXS'
         else:
@@ -315,33 +494,9 @@ class Stack:
 
         if tiff.ome_metadata is not None:
             try:
-                ome = from_xml(tiff.ome_metadata)
-                logger.debug('Reading ome metadata: {0}'.format(ome.images[series]))
-                if hasattr(ome.images[series].pixels, "physical_size_x"):
-                    ratio = ome_ratio_to_um.get(ome.images[series].pixels.physical_size_x_unit, 1.0)
-                    metadata['x_pixel_um'] = ome.images[series].pixels.physical_size_x * ratio
-                else:
-                    metadata['x_pixel_um'] = default_pixel_um
-
-                if hasattr(ome.images[series].pixels, "physical_size_y"):
-                    ratio = ome_ratio_to_um.get(ome.images[series].pixels.physical_size_y_unit, 1.0)
-                    metadata['y_pixel_um'] = ome.images[series].pixels.physical_size_y * ratio
-                else:
-                    metadata['y_pixel_um'] = default_pixel_um
-
-                if hasattr(ome.images[series].pixels, "physical_size_z"):
-                    ratio = ome_ratio_to_um.get(ome.images[series].pixels.physical_size_z_unit, 1.0)
-                    metadata['z_step_um'] = ome.images[series].pixels.physical_size_z * ratio
-                else:
-                    metadata['z_step_um'] = default_z_step_um
-
-                if hasattr(ome.images[series].pixels, "time_increment"):
-                    ratio = ome_ratio_to_sec.get(ome.images[series].pixels.time_increment_unit, 1.0)
-                    metadata['finterval_sec'] = ome.images[series].pixels.time_increment * ratio
-                else:
-                    metadata['finterval_sec'] = default_finterval_sec
-
-                return metadata
+                from . import ome
+                return ome.read_metadata(tiff.ome_metadata, series = series, default_voxel = default_voxel, \
+                                         default_finterval_sec = default_finterval_sec)
 
             except Exception as e:
                 logger.warning("Failed to load ome-tiff metadata. Try loading ImageJ metadata.")
@@ -380,48 +535,78 @@ class Stack:
         self.finterval_sec = metadata['finterval_sec']
 
     def add_s_axis (self, s_count = 1):
+        # samples are repeated; a new axis is a read-only view (copied when modified in place)
         if self.has_s_axis:
-            image_array = np.array([self.image_array[index % self.s_count] for index in range(s_count)])
+            if s_count != self.s_count:
+                self.image_array = self.image_array[..., [index % self.s_count for index in range(s_count)]]
         else:
-            image_array = np.array([self.image_array] * s_count)
-
-        self.image_array = np.moveaxis(image_array, 0, -1)
+            self.image_array = np.broadcast_to(self.image_array[..., np.newaxis], self.image_array.shape + (s_count,))
         self.update_dimensions()
 
+    def __percentiles (self, image, percentile_list, channel = None, t_index = None):
+        # from the statistics when they are exact (or only the range is needed), otherwise from the pixels
+        if image.ndim == self.image_array.ndim - 2 or image.ndim == self.image_array.ndim:
+            selection = self.statistics.selection(channel = channel, t_index = t_index)
+            if selection.is_exact() or all([percentile in (0, 100) for percentile in percentile_list]):
+                return selection.percentiles(percentile_list)
+        return convert.percentiles(image, percentile_list)
+
     def clip_each (self, percentile = 0, with_s_axis = True, progress = False):
+        # in place; percentiles are taken from histograms
+        self.__writable_array()
         def clip_func (image, t_index, c_index):
-            upper = np.percentile(image, 100 - percentile)
-            lower = np.percentile(image, percentile)
-            return image.clip(lower, upper)
-        self.apply_all(clip_func, with_s_axis = with_s_axis, progress = progress)
+            lower, upper = self.__percentiles(image, [percentile, 100 - percentile], channel = c_index, t_index = t_index)
+            convert.clip(image, lower, upper, out = image)
+        self.__run_with_progress(self.__apply_in_place(clip_func, with_s_axis = with_s_axis), progress = progress)
+        self.statistics.invalidate()
 
     def clip_all (self, percentile = 0):
-        upper = np.percentile(self.image_array, 100 - percentile)
-        lower = np.percentile(self.image_array, percentile)
-        self.image_array = self.image_array.clip(lower, upper)
+        self.__writable_array()
+        lower, upper = self.__percentiles(self.image_array, [percentile, 100 - percentile])
+        convert.clip(self.image_array, lower, upper, out = self.image_array)
+        self.statistics.invalidate()
 
     def fit_to_uint8 (self, fit_always = False, progress = False):
-        if fit_always or np.min(self.image_array) < 0 or np.max(self.image_array) > 255:
+        # converted block by block into the new array (no full-size temporaries)
+        selection = self.statistics.selection()
+        lower, upper = selection.min(), selection.max()
+        if fit_always or lower < 0 or upper > 255:
+            output_array = np.empty(self.image_array.shape, dtype = np.uint8)
             def uint8_func (image, t_index, c_index):
-                return (255.0 * (image - np.min(image)) / np.ptp(image)).astype(np.uint8)
-            self.apply_all(uint8_func, with_s_axis = True, progress = progress)
+                selection = self.statistics.selection(channel = c_index, t_index = t_index)
+                lower, upper = selection.min(), selection.max()
+                convert.rescale(image, lower, upper, dtype = np.uint8, out = output_array[t_index, c_index])
+            self.__run_with_progress(self.__apply_in_place(uint8_func, with_s_axis = True), progress = progress)
         else:
-            self.image_array = self.image_array.astype(np.uint8)
-            self.update_dimensions()
+            output_array = convert.astype(self.image_array, np.uint8)
+        self.image_array = output_array
+        self.update_dimensions()
 
     def invert_lut (self):
+        self.__writable_array()
         if self.image_array.dtype.kind == 'f':
-            logger.info()
+            logger.info("Inverting lut of float images is not supported.")
         elif self.image_array.dtype.kind == 'u':
-            self.image_array = np.iinfo(self.image_array.dtype).max - self.image_array
+            convert.invert(self.image_array, np.iinfo(self.image_array.dtype).max, out = self.image_array)
         elif self.image_array.dtype.kind == 'i':
-            if np.min(self.image_array) >= 0:
-                self.image_array = np.iinfo(self.image_array.dtype).max - self.image_array
+            if self.statistics.selection().min() >= 0:
+                convert.invert(self.image_array, np.iinfo(self.image_array.dtype).max, out = self.image_array)
             else:
                 logger.warning("Inverting lut of image with negative values. This is problematic.")
-                self.image_array = - self.image_array
+                convert.invert(self.image_array, None, out = self.image_array)
         else:
             logger.warning("Cannot invert lut. Dtype: {0}".format(self.image_array.dtype))
+        self.statistics.invalidate()
+
+    def is_lazy (self):
+        # planes are read from files when indexed (e.g. OME-Zarr and virtual stacks)
+        return isinstance(self.image_array, np.ndarray) == False
+
+    def __writable_array (self):
+        # lazy or read-only arrays are loaded before modified in place
+        if self.is_lazy() or self.image_array.flags.writeable == False:
+            self.image_array = np.array(self.image_array)
+            self.update_dimensions()
 
     def resize_image (self, shape, centering = False, offset = None):
         shape = [self.t_count, self.c_count] + list(shape)
@@ -450,36 +635,64 @@ class Stack:
         slice_list = [slice(o, s, 1) for o, s in zip(origin, shape)]
         self.crop_by_slice(slice_list)
 
-    def crop_by_slice (self, slice_list):
-        self.image_array = self.image_array[tuple(slice_list)].copy()
+    def crop_by_slice (self, slice_list, c_list = None):
+        # lazy arrays read only the chunks in the region; views of arrays in memory are copied once
+        slice_list = list(slice_list) + [slice(None)] * (len(self.image_array.shape) - len(slice_list))
+        if c_list is None:
+            image_array = self.image_array[tuple(slice_list)]
+        else:
+            image_array = np.concatenate([self.image_array[tuple(slice_list[0:1] + [slice(index, index + 1)] + slice_list[2:])] \
+                                          for index in c_list], axis = 1)
+        if isinstance(self.image_array, np.ndarray) and np.may_share_memory(image_array, self.image_array):
+            image_array = image_array.copy()
+        self.image_array = image_array
         self.update_dimensions()
 
     def __apply_all (self, image_func, with_s_axis = False):
-        output_frames = []
+        # results are written into an array allocated for the first result (no lists of frames).
+        # samples are passed as strided views and written back to the last axis.
+        split_samples = self.has_s_axis and not with_s_axis
+        output_array = None
         for t_index in range(self.t_count):
-            output_channels = []
             for c_index in range(self.c_count):
-                if self.has_s_axis and not with_s_axis:
-                    image = [image_func(self.image_array[t_index, c_index, ..., s_index], t_index, c_index) for s_index in range(self.s_count)]
-                    image = np.moveaxis(np.array(image), 0, -1)
-                else:
-                    image = image_func(self.image_array[t_index, c_index], t_index, c_index)
-                output_channels.append(image)
-            output_frames.append(output_channels)
+                for s_index in (range(self.s_count) if split_samples else [None]):
+                    key = (t_index, c_index) if s_index is None else (t_index, c_index, Ellipsis, s_index)
+                    image = np.asarray(image_func(self.image_array[key], t_index, c_index))
+                    if output_array is None:
+                        shape = (self.t_count, self.c_count) + image.shape + ((self.s_count,) if split_samples else ())
+                        output_array = np.empty(shape, dtype = image.dtype)
+                    output_array[key] = image
             yield t_index
 
-        self.image_array = np.array(output_frames)
+        # pixels moved by the function (e.g. rotated) no longer match drift tables of the viewers
+        self.image_array = output_array
+        self.resample_count += 1
         self.update_dimensions()
 
-    def apply_all (self, image_func, progress = False, with_s_axis = False):
+    def __apply_in_place (self, image_func, with_s_axis = False):
+        # image_func receives views of image_array and returns nothing
+        for t_index in range(self.t_count):
+            for c_index in range(self.c_count):
+                if self.has_s_axis and not with_s_axis:
+                    for s_index in range(self.s_count):
+                        image_func(self.image_array[t_index, c_index, ..., s_index], t_index, c_index)
+                else:
+                    image_func(self.image_array[t_index, c_index], t_index, c_index)
+            yield t_index
+
+    def __run_with_progress (self, generator, progress = False):
         if progress:
+            from progressbar import ProgressBar
             with ProgressBar(max_value = self.t_count, redirect_stdout = True) as bar:
-                for index in self.__apply_all(image_func, with_s_axis = with_s_axis):
+                for index in generator:
                     bar.update(index + 1)
         else:
-            for index in self.__apply_all(image_func, with_s_axis = with_s_axis):
+            for index in generator:
                 pass
 
+    def apply_all (self, image_func, progress = False, with_s_axis = False):
+        self.__run_with_progress(self.__apply_all(image_func, with_s_axis = with_s_axis), progress = progress)
+
     def scale_by_ratio (self, ratio = 1.0, gpu_id = None, progress = False):
         ratio = gpuimage.expand_ratio(ratio)
         def scale_func (image, t_index, c_index):
@@ -514,3 +727,26 @@ class Stack:
         def shift_func (image, t_index, c_index):
             return gpuimage.shift(image, offset, gpu_id = gpu_id)
         self.apply_all(shift_func, progress = progress)
+
+    def estimate_drift (self, channel = 0, reference = 'first', binning = None, rigid = False, max_workers = None):
+        # rows of dy, dx and angle for each frame (see registration); the data is not resampled.
+        # the table is not kept in the stack, which may be shared by windows.
+        return registration.estimate_drift(self.image_array, channel = channel, reference = reference, \
+                                           binning = binning, rigid = rigid, max_workers = max_workers)
+
+    def check_drift_table (self, drift_table):
+        drift_table = np.array(drift_table, dtype = np.float64)
+        if drift_table.shape != (self.t_count, 3):
+            raise Exception(f"Drift table does not match the stack: {drift_table.shape}")
+        return drift_table
+
+    def correct_drift (self, drift_table, gpu_id = None, progress = False):
+        # frames are resampled to the reference using the drift table
+        drift_table = self.check_drift_table(drift_table)
+        def drift_func (image, t_index, c_index):
+            return registration.correct_frame(image, drift_table[t_index], gpu_id = gpu_id)
+        self.apply_all(drift_func, progress = progress)
+
+    def transform_pipeline (self):
+        # e.g. image_stack.transform_pipeline().scale_isometric().rotate(15).shift(offset).apply()
+        return transform.TransformPipeline(self)
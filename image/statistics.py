@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+import hashlib, threading
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from . import cache, convert, gpuimage, perf
+
+logger = getLogger(__name__)
+
+default_bins = 1024
+default_cache_folder = Path.home().joinpath('.cache', 'momotrack', 'statistics')
+cache_version = 3
+
+class Selection:
+    # statistics of planes of a stack, used in place of the pixels (e.g. by LUT).
+    # the arrays are captured when created, so a selection stays valid after the statistics are invalidated.
+    def __init__ (self, statistics, key):
+        self.key = key
+        self.dtype = statistics.dtype
+        self.bins, self.lower, self.bin_width = statistics.bins, statistics.lower, statistics.bin_width
+        self.min_array = statistics.min_array[key]
+        self.max_array = statistics.max_array[key]
+        self.mean_array = statistics.mean_array[key]
+        self.counts_array = statistics.counts_array[key]
+
+    # planes without finite values are NaN and ignored; 0 if no plane has finite values
+    def min (self):
+        return self.dtype.type(np.nan_to_num(np.fmin.reduce(self.min_array, axis = None)))
+
+    def max (self):
+        return self.dtype.type(np.nan_to_num(np.fmax.reduce(self.max_array, axis = None)))
+
+    def mean (self):
+        means = np.ravel(self.mean_array)
+        means = means[np.isfinite(means)]
+        return float(means.mean()) if len(means) > 0 else np.nan
+
+    def counts (self):
+        return self.counts_array.reshape(-1, self.counts_array.shape[-1]).sum(axis = 0, dtype = np.int64)
+
+    def is_exact (self):
+        return self.dtype.kind in 'ui' and self.bin_width == 1
+
+    def percentiles (self, percentile_list):
+        # the minimum and the maximum are exact; others are exact when the bins are single integers
+        counts = self.counts()
+        if counts.sum() == 0:
+            return [float(self.min()) for percentile in percentile_list]
+        output = convert.histogram_percentiles(counts, self.lower, self.bin_width, \
+                                               percentile_list, integer = self.dtype.kind in 'ui')
+        lower, upper = float(self.min()), float(self.max())
+        return [min(max(value, lower), upper) if 0 < percentile < 100 else (lower if percentile <= 0 else upper) \
+                for value, percentile in zip(output, percentile_list)]
+
+    def percentile (self, percentile):
+        return self.percentiles([percentile])[0]
+
+    def histogram (self, bins, range):
+        # same as np.histogram of the pixels when the bins are single integers
+        spread = self.bin_width - 1 if self.dtype.kind in 'ui' else self.bin_width
+        centers = self.lower + self.bin_width * np.arange(self.bins) + spread / 2
+        return np.histogram(centers, bins = bins, range = range, weights = self.counts())
+
+class StackStatistics:
+    # min, max, mean and a histogram of each (t, c, z) plane, computed on first use in threads
+    # and kept until the pixels change. the bins are shared by all planes (lower + bin_width * i).
+    # statistics of files read as a whole are saved in cache_folder (None to disable) and reused
+    # when the same file is opened again, unless the file is modified.
+    def __init__ (self, image_stack, bins = default_bins, max_workers = None, cache_folder = default_cache_folder):
+        self.image_stack = image_stack
+        self.bins = bins
+        self.max_workers = max_workers
+        self.cache_folder = None if cache_folder is None else Path(cache_folder)
+        self.lock = threading.Lock()
+        self.source = None
+        self.generation = 0
+        self.invalidate()
+
+    def invalidate (self):
+        # called when the pixels are changed; the file no longer matches the stack
+        self.generation += 1
+        self.min_array = None
+        self.max_array = None
+        self.mean_array = None
+        self.counts_array = None
+        self.source = None
+
+    def set_source (self, filename, series = 0, keep_s_axis = False):
+        # file objects and missing files are not cached. keyed by path, mtime and size like the header cache.
+        if isinstance(filename, (str, Path)) == False:
+            return
+        try:
+            path, mtime_ns, size = cache.file_key(filename)
+            self.source = (path, series, bool(keep_s_axis), mtime_ns, size)
+        except OSError:
+            self.source = None
+
+    def is_computed (self):
+        return self.counts_array is not None
+
+    def is_exact (self):
+        return self.dtype.kind in 'ui' and self.bin_width == 1
+
+    def compute (self, cancel_event = None):
+        # computed again if the pixels are changed while computing (e.g. in another thread).
+        # the statistics are left uncomputed if cancel_event (threading.Event) is set.
+        with self.lock:
+            while self.is_computed() == False:
+                if self.load_cache_file() == False:
+                    with perf.timer("compute_statistics"):
+                        self.compute_planes(cancel_event = cancel_event)
+                    self.save_cache_file()
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+        return self
+
+    def load_cached (self):
+        # statistics already computed or saved in the cache; nothing is computed
+        with self.lock:
+            if self.is_computed() == False:
+                self.load_cache_file()
+            return self.is_computed()
+
+    def selection (self, channel = None, t_index = None, z_index = None):
+        # None selects all indices along the axis
+        self.compute()
+        return Selection(self, tuple([slice(None) if index is None else index for index in (t_index, channel, z_index)]))
+
+    def planes (self, t_index):
+        # NaN and inf are excluded from all statistics of float planes
+        image_array = self.image_stack.image_array
+        for c_index in range(image_array.shape[1]):
+            for z_index in range(image_array.shape[2]):
+                plane = np.asarray(image_array[t_index, c_index, z_index])
+                if plane.dtype.kind == 'f' and np.all(np.isfinite(plane)) == False:
+                    plane = plane[np.isfinite(plane)]
+                yield (t_index, c_index, z_index), plane
+
+    def compute_planes (self, cancel_event = None):
+        # ranges first, then histograms in the bins of the whole stack. cancel is checked between t indices.
+        image_array = self.image_stack.image_array
+        generation = self.generation
+        shape = tuple(image_array.shape[0:3])
+        self.dtype = np.dtype(image_array.dtype)
+        min_array = np.empty(shape, dtype = self.dtype)
+        max_array = np.empty(shape, dtype = self.dtype)
+        mean_array = np.empty(shape, dtype = np.float64)
+        counts_array = np.empty(shape + (self.bins,), dtype = np.uint32)
+
+        def is_canceled ():
+            return cancel_event is not None and cancel_event.is_set()
+
+        def range_func (t_index):
+            if is_canceled():
+                return
+            for key, plane in self.planes(t_index):
+                min_array[key], max_array[key] = (plane.min(), plane.max()) if plane.size > 0 else (np.nan, np.nan)
+
+        def histogram_func (t_index):
+            if is_canceled():
+                return
+            for key, plane in self.planes(t_index):
+                mean_array[key] = plane.mean(dtype = np.float64) if plane.size > 0 else np.nan
+                counts_array[key] = self.plane_counts(plane)
+
+        max_workers = gpuimage.parallel_workers() if self.max_workers is None else self.max_workers
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            list(executor.map(range_func, range(shape[0])))
+            if is_canceled() == False:
+                self.set_bins(np.fmin.reduce(min_array, axis = None), np.fmax.reduce(max_array, axis = None))
+                list(executor.map(histogram_func, range(shape[0])))
+
+        if is_canceled():
+            logger.debug("Statistics canceled")
+            return
+        if generation != self.generation:
+            logger.debug("Statistics discarded: the pixels were changed")
+            return
+        self.min_array, self.max_array, self.mean_array, self.counts_array = min_array, max_array, mean_array, counts_array
+        logger.debug(f"Statistics computed: {shape}, bin width: {self.bin_width}")
+
+    def set_bins (self, lower, upper):
+        if self.dtype.kind in 'ui':
+            self.lower = int(lower)
+            self.bin_width = max(1, int(np.ceil((int(upper) - int(lower) + 1) / self.bins)))
+        elif np.isnan(lower):
+            # no finite values; all counts are zero
+            self.lower, self.bin_width = 0.0, 1.0
+        else:
+            self.lower = float(lower)
+            self.bin_width = (float(upper) - float(lower)) / self.bins if upper > lower else 1.0
+
+    def plane_counts (self, plane):
+        # bin indices counted by bincount (faster than np.histogram); the maximum is in the last bin
+        if self.dtype.kind in 'ui':
+            values = plane.reshape(-1).astype(np.int64)
+            values -= self.lower
+            if self.bin_width > 1:
+                values //= self.bin_width
+        else:
+            values = np.subtract(plane.reshape(-1), self.lower, dtype = np.float64)
+            values *= 1 / self.bin_width
+            values = values.astype(np.intp)
+            np.minimum(values, self.bins - 1, out = values)
+        return np.bincount(values, minlength = self.bins)
+
+    def cache_filename (self):
+        # one file per image path, series and S axis option; replaced when the file is modified
+        path, series, keep_s_axis = self.source[0:3]
+        name = hashlib.sha1(f"{path}\n{series}\n{keep_s_axis}".encode('utf-8')).hexdigest()
+        return self.cache_folder.joinpath(name + '.npz')
+
+    def cache_key (self):
+        image_array = self.image_stack.image_array
+        return np.array([cache_version, self.bins, *self.source[1:], *image_array.shape], dtype = np.int64)
+
+    def load_cache_file (self):
+        if self.source is None or self.cache_folder is None:
+            return False
+        try:
+            with np.load(self.cache_filename(), allow_pickle = False) as data:
+                if str(data['path']) != self.source[0] or np.array_equal(data['key'], self.cache_key()) == False or \
+                   str(data['dtype']) != str(self.image_stack.image_array.dtype):
+                    return False
+                self.dtype = np.dtype(str(data['dtype']))
+                self.lower, self.bin_width = data['lower'].item(), data['bin_width'].item()
+                self.min_array, self.max_array = data['min'], data['max']
+                self.mean_array, self.counts_array = data['mean'], data['counts']
+        except (OSError, KeyError, ValueError):
+            return False
+        logger.debug(f"Statistics loaded: {self.cache_filename()}")
+        return True
+
+    def save_cache_file (self):
+        # e.g. read-only home folders; the statistics are computed again next time
+        if self.source is None or self.cache_folder is None or self.is_computed() == False:
+            return
+        try:
+            self.cache_folder.mkdir(parents = True, exist_ok = True)
+            with open(self.cache_filename(), 'wb') as file:
+                np.savez(file, path = self.source[0], key = self.cache_key(), dtype = str(self.dtype), lower = self.lower, \
+                         bin_width = self.bin_width, min = self.min_array, max = self.max_array, \
+                         mean = self.mean_array, counts = self.counts_array)
+        except OSError as exception:
+            logger.debug(f"Statistics not saved: {self.cache_filename()}. {exception}")
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+import os
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+default_workers = min(8, os.cpu_count() or 1)
+default_tile_size = 1024
+
+def dimension_slices (shape, axis):
+    return [tuple([slice(None)] * axis + [index]) for index in range(shape[axis])]
+
+class LazyArray:
+    # read-only TCZYX view of a chunked source; only the chunks of indexed planes are read
+    def __init__ (self, source, axes = 'TCZYX', max_workers = default_workers):
+        if (set(axes) <= set('TCZYX')) == False:
+            raise Exception('Unknown axis format: {0}'.format(axes))
+        self.source = source
+        self.stored_axes = ''.join([axis for axis in 'TCZYX' if axis in axes])
+        self.source_order = [axes.index(axis) for axis in self.stored_axes]
+        self.shape = tuple([source.shape[axes.index(axis)] if axis in axes else 1 for axis in 'TCZYX'])
+        self.dtype = np.dtype(source.dtype)
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape))
+        self.nbytes = self.size * self.dtype.itemsize
+        self.max_workers = max_workers
+
+    def __len__ (self):
+        return self.shape[0]
+
+    def normalize_key (self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        if Ellipsis in key:
+            index = key.index(Ellipsis)
+            key = key[:index] + (slice(None),) * (self.ndim - len(key) + 1) + key[index + 1:]
+        return key + (slice(None),) * (self.ndim - len(key))
+
+    def __getitem__ (self, key):
+        key = self.normalize_key(key)
+        stored_key = [key['TCZYX'.index(axis)] for axis in self.stored_axes]
+        source_key = [None] * len(self.source_order)
+        for index, order in enumerate(self.source_order):
+            source_key[order] = stored_key[index]
+        data = np.asarray(self.source[tuple(source_key)])
+
+        # the source may store the axes in a different order
+        kept = [order for order, item in zip(self.source_order, stored_key) if isinstance(item, slice)]
+        data = data.transpose(np.argsort(np.argsort(kept))) if len(kept) > 1 else data
+
+        # singleton axes not stored in the source
+        position = 0
+        for index, axis in enumerate('TCZYX'):
+            if isinstance(key[index], slice) == False:
+                continue
+            if axis not in self.stored_axes:
+                data = np.expand_dims(data, position)
+                data = data[(slice(None),) * position + (key[index],)]
+            position += 1
+        return data
+
+    def read_all (self, max_workers = None):
+        # planes are decompressed in parallel (codecs release the GIL)
+        max_workers = self.max_workers if max_workers is None else max_workers
+        axis = next((index for index, count in enumerate(self.shape[0:3]) if count > 1), 0)
+        output = np.empty(self.shape, dtype = self.dtype)
+
+        def read_func (key):
+            output[key] = self[key]
+
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            list(executor.map(read_func, dimension_slices(self.shape, axis)))
+        return output
+
+    def __array__ (self, dtype = None, copy = None):
+        output = self.read_all()
+        return output if dtype is None else output.astype(dtype)
+
+    def astype (self, dtype):
+        return self.read_all().astype(dtype)
+
+class StorageBackend:
+    # TIFF files are read by Stack with tifffile; other formats are read through backends
+    name = None
+    suffixes = []
+
+    def accepts (self, filename):
+        raise NotImplementedError()
+
+    def read (self, filename, series = 0):
+        # returns (image_array, pyramid_levels, metadata)
+        raise NotImplementedError()
+
+    def write (self, filename, image_array, voxel_um, finterval_sec, chunks = None):
+        raise NotImplementedError()
+
+# OME-NGFF (OME-Zarr) units
+ngff_ratio_to_um = {
+    'meter': 1.0e6,
+    'millimeter': 1.0e3,
+    'micrometer': 1.0,
+    'nanometer': 1.0e-3,
+    'angstrom': 1.0e-4,
+    'inch': 25.4e3,
+}
+
+ngff_ratio_to_sec = {
+    'hour': 3600.0,
+    'minute': 60.0,
+    'second': 1.0,
+    'millisecond': 1.0e-3,
+    'microsecond': 1.0e-6,
+    'nanosecond': 1.0e-9,
+}
+
+class ZarrBackend (StorageBackend):
+    name = 'OME-Zarr'
+    suffixes = ['.zarr', '.n5']
+    metadata_names = ['.zattrs', '.zgroup', 'zarr.json', 'attributes.json']
+
+    def __init__ (self, max_workers = default_workers):
+        self.max_workers = max_workers
+
+    def import_zarr (self):
+        try:
+            import zarr
+        except ImportError:
+            raise ImportError("zarr is necessary to read or write OME-Zarr files: pip install zarr")
+        return zarr
+
+    def store_path (self, filename):
+        # metadata files selected in dialogs refer to the folder
+        if isinstance(filename, (str, os.PathLike)) == False:
+            return None
+        path = Path(filename)
+        if path.name in self.metadata_names:
+            path = path.parent
+        if path.suffix.lower() in self.suffixes:
+            return path
+        if path.is_dir() and any([path.joinpath(name).exists() for name in self.metadata_names]):
+            return path
+        return None
+
+    def accepts (self, filename):
+        return self.store_path(filename) is not None
+
+    def open_group (self, path, mode = 'r'):
+        zarr = self.import_zarr()
+        if path.suffix.lower() == '.n5':
+            if hasattr(zarr, 'N5Store') == False:
+                raise Exception(f"N5 is supported only with zarr version 2: {path}")
+            return zarr.open(zarr.N5Store(str(path)), mode = mode)
+        if mode == 'w' and int(zarr.__version__.split('.')[0]) >= 3:
+            # OME-NGFF 0.4 is defined on zarr format 2
+            return zarr.open_group(str(path), mode = mode, zarr_format = 2)
+        return zarr.open(str(path), mode = mode)
+
+    def read (self, filename, series = 0):
+        path = self.store_path(filename)
+        node = self.open_group(path)
+
+        # a bare array is also accepted
+        if hasattr(node, 'shape'):
+            axes = 'TCZYX'[5 - len(node.shape):]
+            return LazyArray(node, axes, max_workers = self.max_workers), [], {}
+
+        multiscales = node.attrs.get('multiscales', None)
+        if multiscales is None:
+            raise Exception(f"No multiscales metadata: {filename}")
+        multiscale = multiscales[series]
+
+        axis_list = multiscale.get('axes', ['t', 'c', 'z', 'y', 'x'][5 - len(node[multiscale['datasets'][0]['path']].shape):])
+        axis_list = [axis if isinstance(axis, dict) else {'name': axis} for axis in axis_list]
+        axes = ''.join([axis['name'].upper() for axis in axis_list])
+
+        arrays = [LazyArray(node[dataset['path']], axes, max_workers = self.max_workers) \
+                  for dataset in multiscale['datasets']]
+        metadata = self.read_metadata(axis_list, multiscale['datasets'][0])
+        logger.debug(f"OME-Zarr opened: {filename}. Axes: {axes}. Levels: {len(arrays)}")
+        return arrays[0], arrays[1:], metadata
+
+    def read_metadata (self, axis_list, dataset):
+        scale = [1.0] * len(axis_list)
+        for transform in dataset.get('coordinateTransformations', []):
+            if transform.get('type', None) == 'scale':
+                scale = transform['scale']
+
+        metadata = {}
+        keys = {'X': 'x_pixel_um', 'Y': 'y_pixel_um', 'Z': 'z_step_um', 'T': 'finterval_sec'}
+        for axis, value in zip(axis_list, scale):
+            name = axis['name'].upper()
+            if name == 'T':
+                metadata[keys[name]] = value * ngff_ratio_to_sec.get(axis.get('unit', 'second'), 1.0)
+            elif name in keys:
+                metadata[keys[name]] = value * ngff_ratio_to_um.get(axis.get('unit', 'micrometer'), 1.0)
+        return metadata
+
+    def write (self, filename, image_array, voxel_um, finterval_sec, chunks = None):
+        path = self.store_path(filename)
+        if path is None:
+            path = Path(filename)
+        group = self.open_group(path, mode = 'w')
+
+        # one chunk per plane (or per tile of large planes) so that any plane costs one read
+        height, width = image_array.shape[3:5]
+        if chunks is None:
+            chunks = (1, 1, 1, min(height, default_tile_size), min(width, default_tile_size))
+        array = group.create_array('0', shape = image_array.shape, chunks = chunks, dtype = image_array.dtype) \
+                if hasattr(group, 'create_array') else \
+                group.create_dataset('0', shape = image_array.shape, chunks = chunks, dtype = image_array.dtype)
+
+        def write_func (key):
+            array[key] = image_array[key]
+
+        with ThreadPoolExecutor(max_workers = self.max_workers) as executor:
+            list(executor.map(write_func, dimension_slices(image_array.shape, 0)))
+
+        axis_list = [{'name': 't', 'type': 'time', 'unit': 'second'},
+                     {'name': 'c', 'type': 'channel'},
+                     {'name': 'z', 'type': 'space', 'unit': 'micrometer'},
+                     {'name': 'y', 'type': 'space', 'unit': 'micrometer'},
+                     {'name': 'x', 'type': 'space', 'unit': 'micrometer'}]
+        scale = [finterval_sec, 1.0, voxel_um[0], voxel_um[1], voxel_um[2]]
+        group.attrs['multiscales'] = [{'version': '0.4', 'name': path.stem, 'axes': axis_list,
+                                       'datasets': [{'path': '0', 'coordinateTransformations': [{'type': 'scale', 'scale': scale}]}]}]
+        logger.debug(f"OME-Zarr saved: {filename}. Chunks: {chunks}")
+
+zarr_backend = ZarrBackend()
+backend_list = [zarr_backend]
+
+def find_backend (filename):
+    for backend in backend_list:
+        if backend.accepts(filename):
+            return backend
+    return None
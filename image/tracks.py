@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+import csv
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from . import gpuimage, perf
+
+logger = getLogger(__name__)
+
+parquet_suffix = '.parquet'
+
+def chain_sums (parent_row, weights):
+    # sums of weights from each row up to the root and the root row, by pointer jumping
+    # (each round doubles the links followed). rows still linked after all rounds are in cycles.
+    head = parent_row.copy()
+    total = weights.copy()
+    root = np.arange(len(parent_row))
+    for _ in range(len(parent_row).bit_length() + 1):
+        active = np.flatnonzero(head >= 0)
+        if len(active) == 0:
+            break
+        jump = head[active]
+        total[active] += total[jump]
+        root[active] = root[jump]
+        head[active] = head[jump]
+    return total, root, head >= 0
+
+def parent_rows (index, parent):
+    # rows of parents; parents not found (e.g. deleted) are -1. the first row is used for duplicated indices.
+    order = np.argsort(index, kind = 'stable')
+    position = np.minimum(np.searchsorted(index[order], parent), max(0, len(index) - 1))
+    found = (parent >= 0) & (index[order][position] == parent) if len(index) > 0 else np.zeros(0, dtype = bool)
+    return np.where(found, order[position], -1)
+
+class TrackArrays:
+    # spots of records split into tracks, which start at roots and at children of dividing spots,
+    # and end at leaves and at dividing spots. spots are sorted by track and then along the track.
+    # coordinates are in um and times in seconds if voxel_um (ZYX) and finterval_sec are given.
+    def __init__ (self, spot_list, voxel_um = None, finterval_sec = None):
+        self.length_unit = 'px' if voxel_um is None else 'um'
+        self.time_unit = 'frame' if finterval_sec is None else 'sec'
+        self.finterval = 1.0 if finterval_sec is None else float(finterval_sec)
+        scale = np.ones(3) if voxel_um is None else np.array(voxel_um, dtype = np.float64)[::-1]
+
+        with perf.timer("track_arrays"):
+            spot_list = [spot for spot in spot_list if spot.get('delete', False) == False]
+            values = np.array([(spot['index'], -1 if spot['parent'] is None else spot['parent'], spot['time'], \
+                                spot['channel'], spot['x'], spot['y'], spot['z']) for spot in spot_list], \
+                              dtype = np.float64).reshape(-1, 7)
+            index, parent = values[:, 0].astype(np.int64), values[:, 1].astype(np.int64)
+            parent_row = parent_rows(index, parent)
+
+            # spots linked to cycles (broken records) are dropped
+            _, _, cyclic = chain_sums(parent_row, np.zeros(len(parent_row), dtype = np.int64))
+            if np.any(cyclic):
+                logger.warning(f"Spots linked to cycles of parents are ignored: {index[cyclic].tolist()}")
+                values, index, parent = values[~cyclic], index[~cyclic], parent[~cyclic]
+                parent_row = parent_rows(index, parent)
+
+            self.build(values, index, parent_row, scale)
+
+    def build (self, values, index, parent_row, scale):
+        spot_count = len(index)
+        children_count = np.bincount(parent_row[parent_row >= 0], minlength = spot_count)
+        has_parent = parent_row >= 0
+        start = ~has_parent | (children_count[np.maximum(parent_row, 0)] != 1)
+
+        # generations count the divisions above the spot
+        generation, tree_row, _ = chain_sums(parent_row, (start & has_parent).astype(np.int64))
+        position, track_row, _ = chain_sums(np.where(start, -1, parent_row), np.ones(spot_count, dtype = np.int64))
+
+        order = np.lexsort((position, track_row))
+        track_row = track_row[order]
+        first = np.flatnonzero(np.r_[True, track_row[1:] != track_row[:-1]]) if spot_count > 0 else np.zeros(0, dtype = np.int64)
+        self.track_count = len(first)
+        self.first = first
+        self.last = np.r_[first[1:], spot_count] - 1
+        self.track = np.repeat(np.arange(self.track_count), np.diff(np.r_[first, spot_count]))
+
+        # track of each row in the order of the records
+        row_track = np.empty(spot_count, dtype = np.int64)
+        row_track[order] = self.track
+
+        self.index = index[order]
+        self.time = values[order, 2].astype(np.int64)
+        self.channel = values[order, 3].astype(np.int64)
+        self.position = values[order][:, 4:7] * scale
+        self.generation = generation[order]
+        self.tree = index[tree_row[order]]
+        self.children_count = children_count[order]
+        parent_of_first = parent_row[order[first]]
+        self.parent_track = np.where(parent_of_first >= 0, row_track[np.maximum(parent_of_first, 0)], -1)
+
+    def step_arrays (self):
+        # links between successive spots of each track: track, length and time lag
+        linked = self.track[1:] == self.track[:-1]
+        length = np.linalg.norm(self.position[1:] - self.position[:-1], axis = 1)[linked]
+        lag = (self.time[1:] - self.time[:-1])[linked] * self.finterval
+        return self.track[1:][linked], length, lag
+
+    def track_table (self):
+        first, last = self.first, self.last
+        step_track, step_length, step_lag = self.step_arrays()
+        path_length = np.bincount(step_track, weights = step_length, minlength = self.track_count)
+        displacement = np.linalg.norm(self.position[last] - self.position[first], axis = 1)
+        duration = (self.time[last] - self.time[first]) * self.finterval
+
+        # links within a frame have no speed
+        max_speed = np.full(self.track_count, np.nan)
+        moving = step_lag != 0
+        np.fmax.at(max_speed, step_track[moving], step_length[moving] / np.abs(step_lag[moving]))
+
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            mean_speed = np.where(duration != 0, path_length / np.abs(duration), np.nan)
+            straightness = np.where(path_length > 0, displacement / path_length, np.nan)
+
+        speed_unit = f"{self.length_unit}_per_{self.time_unit}"
+        return {'track': np.arange(self.track_count),
+                'tree': self.tree[first],
+                'parent_track': self.parent_track,
+                'generation': self.generation[first],
+                'channel': self.channel[first],
+                'first_index': self.index[first],
+                'last_index': self.index[last],
+                'spot_count': last - first + 1,
+                't_start': self.time[first],
+                't_end': self.time[last],
+                f"duration_{self.time_unit}": duration,
+                f"path_length_{self.length_unit}": path_length,
+                f"displacement_{self.length_unit}": displacement,
+                f"mean_speed_{speed_unit}": mean_speed,
+                f"max_speed_{speed_unit}": max_speed,
+                'straightness': straightness,
+                'divides': self.children_count[last] > 1}
+
+    def tree_table (self):
+        # lineages; a tree is named by the index of its root spot
+        tree_list, tree = np.unique(self.tree, return_inverse = True)
+        tree_count = len(tree_list)
+        t_start = np.full(tree_count, np.iinfo(np.int64).max)
+        t_end = np.full(tree_count, np.iinfo(np.int64).min)
+        np.minimum.at(t_start, tree, self.time)
+        np.maximum.at(t_end, tree, self.time)
+        generation_count = np.zeros(tree_count, dtype = np.int64)
+        np.maximum.at(generation_count, tree, self.generation + 1)
+
+        return {'tree': tree_list,
+                'spot_count': np.bincount(tree, minlength = tree_count),
+                'track_count': np.bincount(tree[self.first], minlength = tree_count),
+                'division_count': np.bincount(tree, weights = self.children_count > 1, minlength = tree_count).astype(np.int64),
+                'leaf_count': np.bincount(tree, weights = self.children_count == 0, minlength = tree_count).astype(np.int64),
+                'generation_count': generation_count,
+                't_start': t_start,
+                't_end': t_end}
+
+    def msd_table (self, max_lag = None, max_workers = None):
+        # mean squared displacements of spot pairs in the same track by the time lag in frames.
+        # pairs k links apart are counted in threads for every k; pairs over max_lag frames are masked
+        # (links may not advance a frame, so k is not limited by max_lag).
+        if max_lag is None:
+            max_lag = int(self.time.max() - self.time.min()) if len(self.time) > 0 else 0
+
+        # rows sorted by the links left to the end of the track; rows with k links left or more come first
+        links_left = self.last[self.track] - np.arange(len(self.track))
+        by_links_left = np.argsort(-links_left, kind = 'stable')
+        sorted_links_left = -links_left[by_links_left]
+        max_links = int(links_left.max()) if len(links_left) > 0 else 0
+
+        def lag_func (links):
+            sums = np.zeros(max_lag + 1)
+            counts = np.zeros(max_lag + 1, dtype = np.int64)
+            for link in links:
+                rows = by_links_left[0:np.searchsorted(sorted_links_left, -link, side = 'right')]
+                lag = np.abs(self.time[rows + link] - self.time[rows])
+                squared = np.sum((self.position[rows + link] - self.position[rows]) ** 2, axis = 1)
+                kept = (lag > 0) & (lag <= max_lag)
+                sums += np.bincount(lag[kept], weights = squared[kept], minlength = max_lag + 1)
+                counts += np.bincount(lag[kept], minlength = max_lag + 1)
+            return sums, counts
+
+        max_workers = gpuimage.parallel_workers() if max_workers is None else max_workers
+        link_list = list(range(1, max_links + 1))
+        sums, counts = np.zeros(max_lag + 1), np.zeros(max_lag + 1, dtype = np.int64)
+        with perf.timer("msd_table"), ThreadPoolExecutor(max_workers = max_workers) as executor:
+            for chunk_sums, chunk_counts in executor.map(lag_func, [link_list[i::max_workers] for i in range(max_workers)]):
+                sums += chunk_sums
+                counts += chunk_counts
+
+        lag = np.flatnonzero(counts)
+        return {'lag': lag,
+                f"lag_{self.time_unit}": lag * self.finterval,
+                f"msd_{self.length_unit}2": sums[lag] / counts[lag],
+                'pair_count': counts[lag]}
+
+def save_table (table, filename):
+    # columns of the same length; Parquet if the filename ends with .parquet (needs pyarrow)
+    if Path(filename).suffix.lower() == parquet_suffix:
+        try:
+            import pyarrow, pyarrow.parquet
+        except ImportError:
+            raise ImportError("pyarrow is necessary to write Parquet files: pip install pyarrow")
+        pyarrow.parquet.write_table(pyarrow.table({key: np.asarray(value) for key, value in table.items()}), filename)
+    else:
+        with open(filename, 'w', newline = '') as f:
+            writer = csv.writer(f)
+            writer.writerow(table.keys())
+            writer.writerows(zip(*[np.asarray(value).tolist() for value in table.values()]))
+    logger.debug(f"Table saved: {filename}")
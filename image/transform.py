@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+import numpy as np
+from logging import getLogger
+from . import gpuimage
+
+logger = getLogger(__name__)
+
+def homogeneous (matrix, offset):
+    output = np.identity(len(offset) + 1)
+    output[0:-1, 0:-1] = matrix
+    output[0:-1, -1] = offset
+    return output
+
+class TransformPipeline:
+    # geometric transforms of ZYX volumes recorded as 4x4 matrices (output to input coordinates,
+    # the same convention as ndimage) and applied by one affine_transform per volume.
+    # each transform uses the same grid as the corresponding method of Stack.
+    def __init__ (self, image_stack):
+        self.image_stack = image_stack
+        self.reset()
+
+    def reset (self):
+        self.matrix = np.identity(4)
+        self.shape = list(self.image_stack.image_array.shape[2:5])
+        self.voxel_um = list(self.image_stack.voxel_um)
+        self.name_list = []
+
+    def compose (self, name, matrix, shape = None):
+        # coordinates in the new output are mapped to the current output first
+        self.matrix = self.matrix @ matrix
+        self.shape = self.shape if shape is None else list(shape)
+        self.name_list.append(name)
+        return self
+
+    def scale_by_ratio (self, ratio = 1.0):
+        ratio = gpuimage.expand_ratio(ratio)
+        if np.allclose(ratio, 1.0):
+            return self
+
+        # corners are aligned like ndimage.zoom
+        shape = [int(round(length * factor)) for length, factor in zip(self.shape, ratio)]
+        factors = [(length - 1) / (output - 1) if output > 1 else 1.0 for length, output in zip(self.shape, shape)]
+        self.voxel_um = [self.voxel_um[i] / ratio[i] for i in range(len(self.voxel_um))]
+        return self.compose('scale', homogeneous(np.diag(factors), np.zeros(3)), shape)
+
+    def scale_by_pixelsize (self, pixel_um):
+        pixel_um = gpuimage.expand_ratio(pixel_um)
+        ratio = [self.voxel_um[i] / pixel_um[i] for i in range(len(self.voxel_um))]
+        return self.scale_by_ratio(ratio)
+
+    def scale_isometric (self):
+        if np.isclose(self.voxel_um[1], self.voxel_um[2]) == False:
+            logger.warning("X and Y pixel size are different: {0}".format(self.voxel_um))
+        return self.scale_by_pixelsize(min(self.voxel_um))
+
+    def rotate (self, angle = 0.0, axis = 0):
+        # around the center of the plane like ndimage.rotate (reshape = False)
+        axis_a, axis_b = gpuimage.axis_to_tuple(axis)
+        cos, sin = np.cos(np.deg2rad(angle)), np.sin(np.deg2rad(angle))
+        matrix = np.identity(3)
+        matrix[axis_a, axis_a], matrix[axis_a, axis_b] = cos, sin
+        matrix[axis_b, axis_a], matrix[axis_b, axis_b] = -sin, cos
+
+        center = (np.array(self.shape) - 1) / 2
+        offset = np.zeros(3)
+        offset[[axis_a, axis_b]] = (center - matrix @ center)[[axis_a, axis_b]]
+        return self.compose('rotate', homogeneous(matrix, offset))
+
+    def affine_transform (self, matrix):
+        matrix, offset = gpuimage.affine_parts(matrix, 3)
+        return self.compose('affine', homogeneous(matrix, offset))
+
+    def shift (self, offset):
+        offset = np.full(3, offset, dtype = np.float64)
+        return self.compose('shift', homogeneous(np.identity(3), -offset))
+
+    def is_identity (self):
+        return np.allclose(self.matrix, np.identity(4)) and self.shape == list(self.image_stack.image_array.shape[2:5])
+
+    def apply (self, gpu_id = None, progress = False):
+        if len(self.name_list) > 0 and self.is_identity() == False:
+            logger.debug(f"Transforms applied in one pass: {', '.join(self.name_list)}. Shape: {self.shape}")
+            # edges are filled like Stack: 'constant' for scale, rotate and shift (ndimage defaults),
+            # 'grid-constant' of Stack.affine_transform if the pipeline has an affine step
+            mode = 'grid-constant' if 'affine' in self.name_list else 'constant'
+            def affine_func (image, t_index, c_index):
+                return gpuimage.affine_transform(image, self.matrix, gpu_id = gpu_id, \
+                                                 output_shape = self.shape, mode = mode)
+            self.image_stack.apply_all(affine_func, progress = progress)
+            self.image_stack.voxel_um = list(self.voxel_um)
+        self.reset()
+        return self.image_stack
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+import re, threading
+import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
+from logging import getLogger
+from . import lazy, storage
+
+tifffile = lazy.lazy_import('tifffile')
+
+logger = getLogger(__name__)
+
+default_max_handles = 16
+
+def natural_key (filename):
+    # numbers in names are compared by value (e.g. t2.tif before t10.tif)
+    return [(0, int(part), '') if part.isdigit() else (1, 0, part.lower()) for part in re.split(r'(\d+)', str(filename))]
+
+class TiffHandlePool:
+    # bounded number of open files; the least recently used file is closed first
+    def __init__ (self, max_handles = default_max_handles):
+        self.max_handles = max_handles
+        self.handle_dict = OrderedDict()
+        self.lock_dict = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def handle (self, filename):
+        with self.lock:
+            if filename not in self.lock_dict:
+                self.lock_dict[filename] = threading.Lock()
+            file_lock = self.lock_dict[filename]
+
+        # TiffFile is not thread-safe; one reader per file at a time
+        with file_lock:
+            with self.lock:
+                tiff = self.handle_dict.get(filename, None)
+                if tiff is None:
+                    tiff = tifffile.TiffFile(filename)
+                    self.handle_dict[filename] = tiff
+                    self.evict()
+                self.handle_dict.move_to_end(filename)
+            yield tiff
+
+    def evict (self):
+        for filename in list(self.handle_dict.keys()):
+            if len(self.handle_dict) <= self.max_handles:
+                break
+            # files being read are skipped
+            if self.lock_dict[filename].acquire(blocking = False):
+                try:
+                    self.handle_dict.pop(filename).close()
+                finally:
+                    self.lock_dict[filename].release()
+
+    def close (self):
+        with self.lock:
+            for tiff in self.handle_dict.values():
+                tiff.close()
+            self.handle_dict.clear()
+
+class SeriesEntry:
+    def __init__ (self, filename, series, axes, shape, dtype):
+        self.filename = filename
+        self.series = series
+        self.axes = axes
+        self.dtype = np.dtype(dtype)
+        self.page_axes = ''.join([axis for axis in axes if axis not in 'YXS'])
+        self.page_shape = [shape[axes.index(axis)] for axis in self.page_axes]
+        self.counts = {axis: (shape[axes.index(axis)] if axis in axes else 1) for axis in 'TCZYXS'}
+
+    def plane_shape (self):
+        # S samples are treated as channels like Stack.read_image
+        return (self.counts['C'] * self.counts['S'], self.counts['Z'], self.counts['Y'], self.counts['X'])
+
+    def page_index (self, t_index, c_index, z_index):
+        index_dict = {'T': t_index, 'C': c_index, 'Z': z_index}
+        if len(self.page_axes) == 0:
+            return 0
+        return int(np.ravel_multi_index([index_dict[axis] for axis in self.page_axes], self.page_shape))
+
+def scan_files (filenames, series = None):
+    # only headers are read; series None uses all series with the shape of the first one
+    entry_list = []
+    for filename in filenames:
+        with tifffile.TiffFile(filename) as tiff:
+            series_list = range(len(tiff.series)) if series is None else [series]
+            for index in series_list:
+                tiff_series = tiff.series[index]
+                axes = tiff_series.axes.upper()
+                if (set(axes) <= set('TCZYXS')) == False:
+                    raise Exception(f"Unknown axis format: {axes} in {filename}")
+                entry = SeriesEntry(filename, index, axes, tiff_series.shape, tiff_series.dtype)
+                if len(entry_list) > 0 and (entry.plane_shape() != entry_list[0].plane_shape() or \
+                                            entry.dtype != entry_list[0].dtype):
+                    if series is None:
+                        logger.info(f"Series skipped (different shape): {filename}, {index}")
+                        continue
+                    raise Exception(f"Shape or dtype differs from the first file: {filename}")
+                entry_list.append(entry)
+
+    if len(entry_list) == 0:
+        raise Exception("No series to open.")
+    logger.debug(f"Virtual stack indexed: {len(filenames)} files, {len(entry_list)} series")
+    return entry_list
+
+class VirtualSource:
+    # TCZYX array concatenating series along T; a plane is one page read
+    def __init__ (self, entry_list, max_handles = default_max_handles):
+        self.entry_list = entry_list
+        self.pool = TiffHandlePool(max_handles = max_handles)
+        self.t_list = [(entry, t_index) for entry in entry_list for t_index in range(entry.counts['T'])]
+        self.shape = (len(self.t_list),) + entry_list[0].plane_shape()
+        self.dtype = entry_list[0].dtype
+
+    def read_plane (self, t_index, c_index, z_index):
+        entry, local_t = self.t_list[t_index]
+        c_count = entry.counts['C']
+        page_index = entry.page_index(local_t, c_index % c_count, z_index)
+        with self.pool.handle(entry.filename) as tiff:
+            plane = tiff.asarray(series = entry.series, key = page_index)
+        if entry.counts['S'] > 1:
+            plane = plane[..., c_index // c_count]
+        return plane
+
+    def __getitem__ (self, key):
+        # key is normalized by storage.LazyArray (five items of int or slice)
+        ranges = [range(self.shape[axis])[key[axis]] if isinstance(key[axis], slice) \
+                  else [range(self.shape[axis])[key[axis]]] for axis in range(3)]
+        yx_shape = [len(range(self.shape[axis])[key[axis]]) for axis in (3, 4) if isinstance(key[axis], slice)]
+        output = np.empty([len(item) for item in ranges] + yx_shape, dtype = self.dtype)
+        for t_pos, t_index in enumerate(ranges[0]):
+            for c_pos, c_index in enumerate(ranges[1]):
+                for z_pos, z_index in enumerate(ranges[2]):
+                    output[t_pos, c_pos, z_pos] = self.read_plane(t_index, c_index, z_index)[key[3:5]]
+
+        return output[tuple([0 if isinstance(key[axis], slice) == False else slice(None) for axis in range(3)])]
+
+    def close (self):
+        self.pool.close()
+
+def open_virtual (filenames, series = None, max_handles = default_max_handles):
+    entry_list = scan_files(filenames, series = series)
+    source = VirtualSource(entry_list, max_handles = max_handles)
+    return storage.LazyArray(source, 'TCZYX'), entry_list
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+import sys, csv, argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from image import log, stack, storage, gpuimage, detect, records, registration, tracks
+
+# default parameters
+worker_count = 1
+output_suffix = '_batch.ome.tif'
+inspect_filename = None
+detect_channel = 0
+table_format = 'csv'
+log_level = 'INFO'
+
+# functions (workers must be importable from child processes)
+def image_region (args):
+    # keyword arguments of Stack.read_image; pixels outside are not decoded
+    region = {}
+    if args.crop is not None:
+        x, y, z, width, height, depth = args.crop
+        region = region | {'z_range': (z, z + depth), 'y_range': (y, y + height), 'x_range': (x, x + width)}
+    if args.t_range is not None:
+        region['t_range'] = tuple(args.t_range)
+    if args.channels is not None:
+        region['c_list'] = args.channels
+    return region
+
+def read_stack (image_filename, args):
+    image_stack = stack.Stack()
+    image_stack.read_image(image_filename, **image_region(args))
+    return image_stack
+
+def convert_file (image_filename, args):
+    image_stack = read_stack(image_filename, args)
+    gpu_id = gpuimage.cpu_parallel if args.cpu_parallel else None
+
+    if args.drift_channel is not None:
+        # frames are registered to the reference before other transforms
+        drift_table = image_stack.estimate_drift(channel = args.drift_channel, reference = args.drift_reference, rigid = args.rigid)
+        image_stack.correct_drift(drift_table, gpu_id = gpu_id)
+
+    # scaling and rotation are resampled once
+    pipeline = image_stack.transform_pipeline()
+    if args.isometric:
+        pipeline.scale_isometric()
+
+    if args.rotate is not None:
+        pipeline.rotate(angle = args.rotate, axis = args.rotate_axis)
+    pipeline.apply(gpu_id = gpu_id)
+
+    if args.uint8:
+        image_stack.fit_to_uint8()
+
+    output_filename = stack.with_suffix(image_filename, args.output_suffix)
+    if storage.zarr_backend.accepts(output_filename):
+        image_stack.save_ome_zarr(output_filename)
+    else:
+        image_stack.save_ome_tiff(output_filename)
+    return output_filename
+
+def detect_file (image_filename, args):
+    image_stack = read_stack(image_filename, args)
+    spot_list = detect.detect_stack(image_stack, channel = args.channel, sigma = args.sigma, \
+                                    threshold = args.threshold, min_distance = args.min_distance)
+
+    records_dict = {'spot_list': spot_list,
+                    'image_properties': {'image_filename': image_filename} | image_stack.archive_properties()}
+    if len(image_region(args)) > 0:
+        # coordinates of spots are relative to the region (same as momotrack.py)
+        records_dict['image_properties']['image_region'] = image_region(args)
+    records_filename = records.suggest_filename(image_filename)
+    records.save_records(records_filename, records_dict)
+    return records_filename
+
+def recorded_scale (records_filename, records_dict):
+    # voxel size and frame interval of the image of records
+    image_properties = records_dict.get('image_properties', {})
+    voxel_um = image_properties.get('voxel_um', None)
+    finterval_sec = image_properties.get('finterval_sec', None)
+    if (voxel_um is None or finterval_sec is None) and Path(image_properties.get('image_filename', '')).is_file():
+        # only the header of the image is read
+        header_dict = stack.Stack().read_header(image_properties['image_filename'])
+        voxel_um = header_dict['voxel_um'] if voxel_um is None else voxel_um
+        finterval_sec = header_dict['finterval_sec'] if finterval_sec is None else finterval_sec
+    if voxel_um is None:
+        raise Exception(f"No voxel size recorded in: {records_filename}")
+    return voxel_um, finterval_sec
+
+def export_file (records_filename, args):
+    records_dict = records.load_records(records_filename)
+
+    voxel_um = None
+    if args.physical:
+        voxel_um, _ = recorded_scale(records_filename, records_dict)
+
+    csv_filename = str(Path(records_filename).with_suffix('.csv'))
+    records.export_spots_csv(records_dict, csv_filename, voxel_um = voxel_um)
+    return csv_filename
+
+def tracks_file (records_filename, args):
+    records_dict = records.load_records(records_filename)
+
+    voxel_um, finterval_sec = None, None
+    if args.physical:
+        voxel_um, finterval_sec = recorded_scale(records_filename, records_dict)
+        if finterval_sec is None:
+            raise Exception(f"No frame interval recorded in: {records_filename}")
+
+    # tracks, lineages and MSD in separate tables
+    track_arrays = tracks.TrackArrays(records_dict.get('spot_list', []), voxel_um = voxel_um, finterval_sec = finterval_sec)
+    name = str(Path(records_filename).with_suffix(''))
+    output_list = []
+    for suffix, table in [('_tracks', track_arrays.track_table()), ('_trees', track_arrays.tree_table()), \
+                          ('_msd', track_arrays.msd_table(max_lag = args.max_lag, max_workers = args.threads))]:
+        output_list.append(f"{name}{suffix}.{args.format}")
+        tracks.save_table(table, output_list[-1])
+    return output_list
+
+def inspect_file (image_filename, args):
+    return stack.Stack().read_header(image_filename, series = args.series)
+
+inspect_columns = ['axes', 'shape', 'dtype', 't_count', 'c_count', 'z_count', 'height', 'width', \
+                   's_count', 'voxel_um', 'finterval_sec']
+
+def save_inspection (results, filenames, output):
+    # rows in the order of the arguments
+    file = sys.stdout if output is None else open(output, 'w', newline = '')
+    try:
+        writer = csv.writer(file)
+        writer.writerow(['image_filename'] + inspect_columns)
+        for filename in filenames:
+            if filename in results:
+                writer.writerow([filename] + [results[filename][key] for key in inspect_columns])
+    finally:
+        if output is not None:
+            file.close()
+
+def add_region_arguments (subparser):
+    # only long flags; short flags differ between subcommands (e.g. -c is the channel of detect)
+    subparser.add_argument('--crop', nargs = 6, type = int, default = None, \
+                           metavar = ('X', 'Y', 'Z', 'W', 'H', 'D'), help='Region read from files (applied first)')
+    subparser.add_argument('--t-range', nargs = 2, type = int, default = None, metavar = ('START', 'STOP'), \
+                           help='Time frames read from files (STOP is excluded)')
+    subparser.add_argument('--channels', nargs = '+', type = int, default = None, \
+                           help='Channels read from files')
+
+def run_parallel (func, filenames, args, logger, results = None):
+    failed = []
+    with ProcessPoolExecutor(max_workers = args.workers) as executor:
+        futures = {executor.submit(func, filename, args): filename for filename in filenames}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+                if results is not None:
+                    results[futures[future]] = result
+                logger.info(f"Done: {futures[future]} -> {result}")
+            except Exception as exception:
+                logger.error(f"Failed: {futures[future]}. {exception}")
+                failed.append(futures[future])
+    return failed
+
+if __name__ == '__main__':
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Headless batch processing for momotrack (no Qt).', \
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    log.add_argument(parser)
+    parser.add_argument('-w', '--workers', type = int, default = worker_count, \
+                        help='Number of files processed in parallel')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+    convert_parser = subparsers.add_parser('convert', help = 'Transform stacks and save as OME-TIFF', \
+                                           formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add_region_arguments(convert_parser)
+    convert_parser.add_argument('-i', '--isometric', action = 'store_true', \
+                                help='Scale to isometric voxels')
+    convert_parser.add_argument('-r', '--rotate', type = float, default = None, \
+                                help='Rotation angle in degrees')
+    convert_parser.add_argument('-a', '--rotate-axis', default = 'z', \
+                                help='Rotation axis: z, y or x')
+    convert_parser.add_argument('-d', '--drift-channel', type = int, default = None, \
+                                help='Correct stage drift estimated in this channel')
+    convert_parser.add_argument('--drift-reference', default = 'first', choices = registration.reference_modes, \
+                                help='Frames registered to the first frame or to the previous frame')
+    convert_parser.add_argument('--rigid', action = 'store_true', \
+                                help='Estimate rotations in addition to drift')
+    convert_parser.add_argument('-p', '--cpu-parallel', action = 'store_true', \
+                                help='Transform z-slabs of each stack in threads (useful with few workers)')
+    convert_parser.add_argument('-u', '--uint8', action = 'store_true', \
+                                help='Fit intensities to uint8')
+    convert_parser.add_argument('-o', '--output-suffix', default = output_suffix, \
+                                help='Suffix of output files (OME-Zarr if ending with .zarr)')
+    convert_parser.add_argument('image_file', nargs = '+', help='TIFF files to convert')
+
+    detect_parser = subparsers.add_parser('detect', help = 'Detect spots and save tracking records', \
+                                          formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    detect_parser.add_argument('-c', '--channel', type = int, default = detect_channel, \
+                               help='Channel used for detection')
+    detect_parser.add_argument('-s', '--sigma', type = float, default = detect.default_sigma, \
+                               help='Sigma of the Laplacian of Gaussian filter (pixels)')
+    detect_parser.add_argument('-t', '--threshold', type = float, default = detect.default_threshold, \
+                               help='Threshold in standard deviations of the filtered image')
+    detect_parser.add_argument('-m', '--min-distance', type = int, default = detect.default_min_distance, \
+                               help='Minimum distance between spots (pixels)')
+    add_region_arguments(detect_parser)
+    detect_parser.add_argument('image_file', nargs = '+', help='TIFF files to analyze')
+
+    export_parser = subparsers.add_parser('export', help = 'Export spots in records to CSV', \
+                                          formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    export_parser.add_argument('-p', '--physical', action = 'store_true', \
+                               help='Add coordinates in um using the recorded voxel size')
+    export_parser.add_argument('records_file', nargs = '+', help='JSON records to export')
+
+    tracks_parser = subparsers.add_parser('tracks', help = 'Save statistics of tracks, lineages and MSD in records', \
+                                          formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    tracks_parser.add_argument('-p', '--physical', action = 'store_true', \
+                               help='Use um and seconds from the recorded voxel size and frame interval')
+    tracks_parser.add_argument('-l', '--max-lag', type = int, default = None, \
+                               help='Maximum time lag of MSD in frames (all lags if not specified)')
+    tracks_parser.add_argument('-f', '--format', default = table_format, choices = ['csv', 'parquet'], \
+                               help='Format of tables (parquet needs pyarrow)')
+    tracks_parser.add_argument('-t', '--threads', type = int, default = None, \
+                               help='Threads computing MSD in each process (number of CPUs if not specified)')
+    tracks_parser.add_argument('records_file', nargs = '+', help='JSON records to analyze')
+
+    inspect_parser = subparsers.add_parser('inspect', help = 'List dimensions and voxel sizes without reading pixels', \
+                                           formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    inspect_parser.add_argument('-s', '--series', type = int, default = 0, \
+                                help='Series in each file')
+    inspect_parser.add_argument('-o', '--output', default = inspect_filename, \
+                                help='CSV file to save (standard output if not specified)')
+    inspect_parser.add_argument('image_file', nargs = '+', help='Image files to inspect')
+
+    args = parser.parse_args()
+
+    # logging
+    logger = log.get_logger(__file__, level = args.log_level)
+
+    # process!
+    if args.command == 'convert':
+        failed = run_parallel(convert_file, args.image_file, args, logger)
+    elif args.command == 'detect':
+        failed = run_parallel(detect_file, args.image_file, args, logger)
+    elif args.command == 'inspect':
+        results = {}
+        failed = run_parallel(inspect_file, args.image_file, args, logger, results = results)
+        save_inspection(results, args.image_file, args.output)
+    elif args.command == 'tracks':
+        failed = run_parallel(tracks_file, args.records_file, args, logger)
+    else:
+        failed = run_parallel(export_file, args.records_file, args, logger)
+
+    sys.exit(1 if len(failed) > 0 else 0)
@@ -1,11 +1,10 @@
 #!/usr/bin/env python
 
-import platform, shutil, subprocess
+import time
+startup_time = time.perf_counter()
+
 import sys, argparse
-from PySide6.QtWidgets import QApplication
-from PySide6.QtGui import QGuiApplication
-from ui import mainwindow
-from image import log
+from image import log, perf, virtual
 
 # default parameters
 image_filenames = None
@@ -14,6 +13,8 @@ plugin_names = None
 window_position = None
 window_size = None
 log_level = 'INFO'
+startup_budget_ms = perf.default_startup_budget_ms
+trace_filename = None
 
 # parse arguments
 parser = argparse.ArgumentParser(description='Object tracking system for 3D images.', \
@@ -31,6 +32,24 @@ parser.add_argument('-P', '--window-position', nargs = 2, type = int, default =
 parser.add_argument('-S', '--window-size', nargs = 2, type = int, default = window_size, \
                     metavar = ('W', 'H'), help='Size of window(s)')
 
+parser.add_argument('-V', '--virtual-stack', action = 'store_true', \
+                    help='Open all image files as one stack concatenated along T (read on demand)')
+
+parser.add_argument('-j', '--decode-threads', type = int, default = None, \
+                    help='Threads decoding compressed TIFF pages (default: automatic)')
+
+parser.add_argument('--profile-startup', action = 'store_true', \
+                    help='Report import and initialization time of each module and phase')
+
+parser.add_argument('--startup-budget', type = int, default = startup_budget_ms, \
+                    metavar = 'MS', help='Warn if the first window takes longer to appear')
+
+parser.add_argument('--perf-overlay', action = 'store_true', \
+                    help='Show timings of drawing, loading and saving on the image')
+
+parser.add_argument('--perf-trace', default = trace_filename, metavar = 'FILE', \
+                    help='Save timings in the Chrome trace format (JSON) on exit')
+
 log.add_argument(parser)
 
 parser.add_argument('image_file', nargs = '*', default = image_filenames, \
@@ -47,47 +66,44 @@ records_filenames = [] if args.records_file is None else args.records_file
 plugin_names = [] if args.plugin_name is None else args.plugin_name
 window_position = args.window_position
 window_size = args.window_size
+trace_filename = args.perf_trace
+
+# threads used when images are loaded
+if args.decode_threads is not None:
+    from image import stack
+    stack.decode_workers = args.decode_threads
+
+# profile the heavy imports below if requested
+profiler = perf.StartupProfiler(start_time = startup_time, budget_ms = args.startup_budget)
+if args.profile_startup:
+    profiler.install_import_hook()
+
+# timers are almost free while disabled
+if args.perf_overlay or trace_filename is not None:
+    perf.instrument.enable(True, tracing = trace_filename is not None)
+
+with profiler.phase("Import Qt and UI modules"):
+    from PySide6.QtWidgets import QApplication
+    from PySide6.QtCore import QTimer
+    from ui import windowmanager
 
 # start the Qt system
-app = QApplication(sys.argv[:1] + unparsed_args)
-
-# functions
-def next_window_position (x, y):
-    screen_size = QGuiApplication.primaryScreen().size()
-    delta = int(screen_size.width() * 0.02)
-    next_x = (x + delta) % (screen_size.width() // 2)
-    next_y = (y + delta) % (screen_size.height() // 2)
-    return next_x, next_y
-
-def slot_open_mainwindow (image_list):
-    if image_list is None:
-        image_list = []
-
-    window_x, window_y = next_window_position(0, 0)
-    window_x, window_y = next_window_position(window_x, window_y)
-    program = __file__
-    for index in range(max(1, len(image_list))):
-        filename = image_list[index] if len(image_list) > index else None
-        commands = []
-        if platform.system() == "Windows":
-            if shutil.which('py'):
-                commands.append("py")
-            else:
-                commands.append("python")
-
-        commands.extend([program, "--window-position", str(window_x), str(window_y)])
-
-        if filename is not None:
-            commands.append(filename)
-
-        subprocess.Popen(commands, creationflags = subprocess.CREATE_NEW_PROCESS_GROUP)
-        window_x, window_y = next_window_position(window_x, window_y)
-
-# open the main window(s)
-if window_position is None:
-    window_x, window_y = next_window_position(0, 0)
-else:
-    window_x, window_y = window_position
+with profiler.phase("Create QApplication"):
+    app = QApplication(sys.argv[:1] + unparsed_args)
+
+def slot_first_window_shown ():
+    profiler.check_budget()
+    if args.profile_startup:
+        profiler.report()
+
+# open the main window(s) in this process
+manager = windowmanager.WindowManager(window_size = window_size, perf_overlay = args.perf_overlay)
+if window_position is not None:
+    manager.set_window_position(*window_position)
+
+# all files in one window
+if args.virtual_stack and len(image_filenames) > 0:
+    image_filenames = [sorted(image_filenames, key = virtual.natural_key)]
 
 window = None
 for index in range(max(1, len(image_filenames))):
@@ -96,26 +112,16 @@ for index in range(max(1, len(image_filenames))):
     records_filename = records_filenames[index] if len(records_filenames) > index else None
 
     try:
-        window = mainwindow.MainWindow(plugin_name = plugin_name,
-                                       image_filename = image_filename,
-                                       records_filename = records_filename)
-
-        window.signal_open_new_image.connect(slot_open_mainwindow)
-        window.resize_best()
-
-        window.move(window_x, window_y)
-        window_x, window_y = next_window_position(window_x, window_y)
-
-        window.show()
-        
-        # gview_image doesn't know the actual size until the main window is shown
-        if records_filename is None:
-            window.zoom_best()
-        else:
-            window.restore_settings()
-
+        with profiler.phase(f"Open window {index}"):
+            window = manager.open_window(image_filename = image_filename,
+                                         records_filename = records_filename,
+                                         plugin_name = plugin_name)
     except Exception:
         logger.error(f"Failed or canceled to load: {image_filename} and {records_filename}")
 
 if window is not None:
+    # called after the first window is actually painted by the event loop
+    QTimer.singleShot(0, slot_first_window_shown)
+    if trace_filename is not None:
+        app.aboutToQuit.connect(lambda: perf.instrument.export_trace(trace_filename))
     sys.exit(app.exec())
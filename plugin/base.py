@@ -1,13 +1,12 @@
 #!/usr/bin/env python
 
-import re, json, textwrap
+import json, textwrap
 from datetime import datetime
 from pathlib import Path
 from logging import getLogger
-from numpyencoder import NumpyEncoder
 from PySide6.QtCore import QObject, Signal
 from PySide6.QtGui import QCursor
-from image import stack
+from image import stack, records
 
 logger = getLogger(__name__)
 
@@ -34,7 +33,7 @@ class PluginBase (QObject):
     def __init__ (self):
         super().__init__()
         self.records_modified = False
-        self.records_suffix = '_records.json'
+        self.record_suffix = '_records.json'
         self.records_filename = None
         self.default_filename_stem = 'default'
         self.file_types = {"JSON text": ["*.json"]}
@@ -63,6 +62,7 @@ class PluginBase (QObject):
 
         self.records_dict = {'summary': summary} | viewer_settings | self.records_dict
 
+        from numpyencoder import NumpyEncoder
         try:
             with open(records_filename, 'w') as f:
                 json.dump(self.records_dict, f, ensure_ascii = False, indent = 4, sort_keys = False, \
@@ -81,15 +81,15 @@ class PluginBase (QObject):
 
     def suggest_filename (self, image_filename):
         if image_filename is None:
-            return self.default_filename_stem + self.records_suffix
-
-        name = Path(image_filename).stem
-        name = re.sub(r'\.ome$', '', name, flags=re.IGNORECASE)
-        return name + self.record_suffix
+            return self.default_filename_stem + self.record_suffix
+        return Path(records.suggest_filename(image_filename, suffix = self.record_suffix)).name
 
     def is_records_modified (self):
         return self.records_modified
 
+    def has_records (self):
+        return False
+
     def help_message (self):
         message = textwrap.dedent('''\
         <b>Base class for plugins</b><br><br>
@@ -108,7 +108,7 @@ class PluginBase (QObject):
         pass
 
     def list_scene_items (self, stack, tcz_index):
-        pass
+        return []
 
     def key_pressed (self, event, stack, tcz_index):
         pass
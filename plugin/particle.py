@@ -3,7 +3,7 @@
 import textwrap
 from datetime import datetime
 from logging import getLogger
-from PySide6.QtCore import Qt
+from PySide6.QtCore import Qt, QStringListModel
 from PySide6.QtWidgets import QApplication
 from PySide6.QtWidgets import QCheckBox, QLabel, QMenu
 from PySide6.QtWidgets import QHBoxLayout, QDoubleSpinBox, QSpinBox, QLineEdit, QComboBox
@@ -11,6 +11,7 @@ from PySide6.QtWidgets import QGraphicsEllipseItem, QGraphicsLineItem
 from PySide6.QtWidgets import QGraphicsTextItem, QGraphicsPathItem
 from PySide6.QtGui import QColor, QPen, QBrush, QAction, QPainterPath, QFont, QTextDocument
 from plugin.base import PluginBase
+from image import records
 
 logger = getLogger(__name__)
 
@@ -18,11 +19,23 @@ plugin_name = 'Particle Tracking'
 class_name = 'SPT'
 priority = 10
 
+# opacity of the farthest ghosts; nearer ones are more opaque
+min_ghost_opacity = 0.2
+
+# shared by the color combo boxes of all instances
+color_name_model = None
+def get_color_name_model ():
+    global color_name_model
+    if color_name_model is None:
+        color_name_model = QStringListModel(QColor.colorNames())
+    return color_name_model
+
 class SPT (PluginBase):
     def __init__ (self):
         super().__init__()
         self.plugin_name = str(plugin_name)
         self.spot_list = []
+        self.spot_index = None
         self.current_spot = None
         self.spot_to_add = None
         self.adding_spot = False
@@ -31,7 +44,7 @@ class SPT (PluginBase):
         self.t_limits = [0, 0]
         self.c_limits = [0, 0]
         self.records_modified = False
-        self.record_suffix = '_track.json'
+        self.record_suffix = records.spt_records_suffix
         self.records_dict = {}
         self.track_start = None
         self.image_settings = {}
@@ -136,7 +149,7 @@ class SPT (PluginBase):
         label = QLabel("First:")
         hlayout.addWidget(label)
         self.combo_color_first = QComboBox()
-        self.combo_color_first.addItems(QColor.colorNames())
+        self.combo_color_first.setModel(get_color_name_model())
         self.combo_color_first.setCurrentText(self.color_first)
         hlayout.addWidget(self.combo_color_first)
         self.vlayout.addLayout(hlayout)
@@ -145,7 +158,7 @@ class SPT (PluginBase):
         label = QLabel("Cont:")
         hlayout.addWidget(label)
         self.combo_color_cont = QComboBox()
-        self.combo_color_cont.addItems(QColor.colorNames())
+        self.combo_color_cont.setModel(get_color_name_model())
         self.combo_color_cont.setCurrentText(self.color_cont)
         hlayout.addWidget(self.combo_color_cont)
         self.vlayout.addLayout(hlayout)
@@ -154,7 +167,7 @@ class SPT (PluginBase):
         label = QLabel("Last:")
         hlayout.addWidget(label)
         self.combo_color_last = QComboBox()
-        self.combo_color_last.addItems(QColor.colorNames())
+        self.combo_color_last.setModel(get_color_name_model())
         self.combo_color_last.setCurrentText(self.color_last)
         hlayout.addWidget(self.combo_color_last)
         self.vlayout.addLayout(hlayout)
@@ -163,7 +176,7 @@ class SPT (PluginBase):
         label = QLabel("Reticle:")
         hlayout.addWidget(label)
         self.combo_color_reticle = QComboBox()
-        self.combo_color_reticle.addItems(QColor.colorNames())
+        self.combo_color_reticle.setModel(get_color_name_model())
         self.combo_color_reticle.setCurrentText(self.color_reticle)
         hlayout.addWidget(self.combo_color_reticle)
         self.vlayout.addLayout(hlayout)
@@ -229,6 +242,7 @@ class SPT (PluginBase):
 
         for spot in self.spot_list:
             self.update_old_spot(spot)
+        self.spot_index = None
 
         self.clear_tracking()
         self.records_modified = False
@@ -246,9 +260,13 @@ class SPT (PluginBase):
         except:
             raise
 
+    def has_records (self):
+        return any([spot.get('delete', False) == False for spot in self.spot_list])
+
     def clear_records (self):
         super().clear_records()
         self.spot_list = []
+        self.spot_index = None
         self.clear_tracking()
         self.signal_update_image_view.emit()
         self.update_status()
@@ -294,12 +312,12 @@ class SPT (PluginBase):
 
     def slot_z_increment (self):
         if self.current_spot is not None:
-            self.current_spot['z'] = min(self.current_spot['z'] + 1, self.z_limits[1])
+            self.shift_spot_z(self.current_spot, 1)
             self.signal_update_image_view.emit()
 
     def slot_z_decrement (self):
         if self.current_spot is not None:
-            self.current_spot['z'] = max(self.current_spot['z'] - 1, self.z_limits[0])
+            self.shift_spot_z(self.current_spot, -1)
             self.signal_update_image_view.emit()
 
     def slot_remove_spot (self):
@@ -332,22 +350,21 @@ class SPT (PluginBase):
             return []
 
         scene_items = []
-        candidate_spots = [spot for spot in self.spot_list \
-                           if (spot['time'] == tcz_index[0]) and (spot['channel'] == tcz_index[1]) and
-                              (spot['delete'] == False)]
+        spot_index = self.get_spot_index()
+        t_index, channel, z_index = tcz_index
 
-        deselected_spots = [spot for spot in candidate_spots \
-                            if (spot['z'] == tcz_index[2]) and (spot != self.current_spot)]
+        deselected_spots = [spot for spot in spot_index.spots_in_z_range(t_index, channel, z_index, z_index) \
+                            if spot is not self.current_spot]
         scene_items.extend(self.list_spot_items(deselected_spots, self.spot_radius))
         scene_items.extend(self.list_node_items(deselected_spots, self.spot_radius))
         if self.check_show_labels.isChecked():
             scene_items.extend(self.list_label_items(deselected_spots, self.spot_radius))
 
-        ghost_spots = [spot for spot in candidate_spots \
-                       if (abs(spot['z'] - tcz_index[2]) <= self.ghost_z_range) and \
-                          (spot['z'] != tcz_index[2])]
-        scene_items.extend(self.list_spot_items(ghost_spots, self.ghost_radius))
-        scene_items.extend(self.list_node_items(ghost_spots, self.ghost_radius))
+        ghost_spots = [spot for spot in spot_index.spots_in_z_range(t_index, channel, z_index - self.ghost_z_range, \
+                                                                    z_index + self.ghost_z_range) \
+                       if spot['z'] != z_index]
+        scene_items.extend(self.list_ghost_items(self.list_spot_items, ghost_spots, z_index))
+        scene_items.extend(self.list_ghost_items(self.list_node_items, ghost_spots, z_index))
 
         if self.current_spot is not None:
             if (self.current_spot['time'] == tcz_index[0]) and \
@@ -363,25 +380,44 @@ class SPT (PluginBase):
                     scene_items.extend(self.list_spot_items([self.current_spot], self.selected_ghost_radius))
                     scene_items.extend(self.list_node_items([self.current_spot], self.selected_ghost_radius))
 
-            existing_ancestors = [spot for spot in self.find_ancestors(self.current_spot) if spot in deselected_spots]
-            existing_descendants = [spot for spot in self.find_descendants(self.current_spot) if spot in deselected_spots]
+            ancestors = self.find_ancestors(self.current_spot)
+            descendants = self.find_descendants(self.current_spot)
+
+            deselected_ids = {id(spot) for spot in deselected_spots}
+            existing_ancestors = [spot for spot in ancestors if id(spot) in deselected_ids]
+            existing_descendants = [spot for spot in descendants if id(spot) in deselected_ids]
             scene_items.extend(self.list_ancestor_items(existing_ancestors, self.spot_radius))
             scene_items.extend(self.list_descendant_items(existing_descendants, self.spot_radius))
 
-            ghost_ancestors = [spot for spot in self.find_ancestors(self.current_spot) if spot in ghost_spots]
-            ghots_descendants = [spot for spot in self.find_descendants(self.current_spot) if spot in ghost_spots]
-            scene_items.extend(self.list_ancestor_items(ghost_ancestors, self.ghost_radius))
-            scene_items.extend(self.list_descendant_items(ghots_descendants, self.ghost_radius))
+            ghost_ids = {id(spot) for spot in ghost_spots}
+            ghost_ancestors = [spot for spot in ancestors if id(spot) in ghost_ids]
+            ghost_descendants = [spot for spot in descendants if id(spot) in ghost_ids]
+            scene_items.extend(self.list_ghost_items(self.list_ancestor_items, ghost_ancestors, z_index))
+            scene_items.extend(self.list_ghost_items(self.list_descendant_items, ghost_descendants, z_index))
 
         if self.spot_to_add is not None:
             scene_items.extend(self.list_reticle_items(self.spot_to_add, self.selected_radius))
 
         return scene_items
 
+    def list_ghost_items (self, list_func, spot_list, z_index):
+        # ghosts fade with the distance in z; far ones are drawn first
+        spot_dict = {}
+        for spot in spot_list:
+            spot_dict.setdefault(abs(spot['z'] - z_index), []).append(spot)
+
+        item_list = []
+        for distance in sorted(spot_dict.keys(), reverse = True):
+            opacity = max(min_ghost_opacity, 1 - distance / (self.ghost_z_range + 1))
+            for item in list_func(spot_dict[distance], self.ghost_radius):
+                item.setOpacity(opacity)
+                item_list.append(item)
+        return item_list
+
     def list_spot_items (self, spot_list, radius):
         spots_first = [spot for spot in spot_list if spot['parent'] is None]
-        spots_last = [spot for spot in spot_list if (len(self.find_children(spot)) == 0) and (spot not in spots_first)]
-        spots_cont = [spot for spot in spot_list if (spot not in spots_first) and (spot not in spots_last)]
+        spots_last = [spot for spot in spot_list if (spot['parent'] is not None) and (len(self.find_children(spot)) == 0)]
+        spots_cont = [spot for spot in spot_list if (spot['parent'] is not None) and (len(self.find_children(spot)) > 0)]
 
         items_first = [self.create_spot_item(spot, radius, self.color_first) for spot in spots_first]
         items_last = [self.create_spot_item(spot, radius, self.color_last) for spot in spots_last]
@@ -437,8 +473,8 @@ class SPT (PluginBase):
         spot_list = [spot for spot in spot_list if len(self.find_children(spot)) > 1]
 
         spots_first = [spot for spot in spot_list if spot['parent'] is None]
-        spots_last = [spot for spot in spot_list if (len(self.find_children(spot)) == 0) and (spot not in spots_first)]
-        spots_cont = [spot for spot in spot_list if (spot not in spots_first) and (spot not in spots_last)]
+        spots_last = [spot for spot in spot_list if (spot['parent'] is not None) and (len(self.find_children(spot)) == 0)]
+        spots_cont = [spot for spot in spot_list if (spot['parent'] is not None) and (len(self.find_children(spot)) > 0)]
 
         items_first = [self.create_node_item(spot, radius, self.color_first) for spot in spots_first]
         items_last = [self.create_node_item(spot, radius, self.color_last) for spot in spots_last]
@@ -462,8 +498,8 @@ class SPT (PluginBase):
 
     def list_label_items (self, spot_list, radius):
         spots_first = [spot for spot in spot_list if spot['parent'] is None]
-        spots_last = [spot for spot in spot_list if (len(self.find_children(spot)) == 0) and (spot not in spots_first)]
-        spots_cont = [spot for spot in spot_list if (spot not in spots_first) and (spot not in spots_last)]
+        spots_last = [spot for spot in spot_list if (spot['parent'] is not None) and (len(self.find_children(spot)) == 0)]
+        spots_cont = [spot for spot in spot_list if (spot['parent'] is not None) and (len(self.find_children(spot)) > 0)]
 
         items_first = [self.create_label_item(spot, radius, self.color_first) for spot in spots_first]
         items_last = [self.create_label_item(spot, radius, self.color_last) for spot in spots_last]
@@ -494,8 +530,8 @@ class SPT (PluginBase):
 
     def list_ancestor_items (self, spot_list, radius):
         spots_first = [spot for spot in spot_list if spot['parent'] is None]
-        spots_last = [spot for spot in spot_list if (len(self.find_children(spot)) == 0) and (spot not in spots_first)]
-        spots_cont = [spot for spot in spot_list if (spot not in spots_first) and (spot not in spots_last)]
+        spots_last = [spot for spot in spot_list if (spot['parent'] is not None) and (len(self.find_children(spot)) == 0)]
+        spots_cont = [spot for spot in spot_list if (spot['parent'] is not None) and (len(self.find_children(spot)) > 0)]
 
         items_first = [self.create_ancestor_item(spot, radius, self.color_first) for spot in spots_first]
         items_last = [self.create_ancestor_item(spot, radius, self.color_last) for spot in spots_last]
@@ -518,8 +554,8 @@ class SPT (PluginBase):
 
     def list_descendant_items (self, spot_list, radius):
         spots_first = [spot for spot in spot_list if spot['parent'] is None]
-        spots_last = [spot for spot in spot_list if (len(self.find_children(spot)) == 0) and (spot not in spots_first)]
-        spots_cont = [spot for spot in spot_list if (spot not in spots_first) and (spot not in spots_last)]
+        spots_last = [spot for spot in spot_list if (spot['parent'] is not None) and (len(self.find_children(spot)) == 0)]
+        spots_cont = [spot for spot in spot_list if (spot['parent'] is not None) and (len(self.find_children(spot)) > 0)]
 
         items_first = [self.create_descendant_item(spot, radius, self.color_first) for spot in spots_first]
         items_last = [self.create_descendant_item(spot, radius, self.color_last) for spot in spots_last]
@@ -716,14 +752,25 @@ class SPT (PluginBase):
         self.set_spot_to_add(self.current_spot)
 
     def move_spot (self, spot, x, y, t_index, channel, z_index):
+        moved = (spot['time'], spot['channel'], spot['z']) != (t_index, channel, z_index)
+        if moved:
+            self.get_spot_index().remove_from_plane(spot)
         spot['x'] = x
         spot['y'] = y
         spot['z'] = z_index
         spot['time'] = t_index
         spot['channel'] = channel
         spot['update'] = datetime.now().astimezone().isoformat()
+        if moved:
+            self.spot_index.add_to_plane(spot)
         self.records_modified = True
 
+    def shift_spot_z (self, spot, dz):
+        spot_index = self.get_spot_index()
+        spot_index.remove_from_plane(spot)
+        spot['z'] = min(max(spot['z'] + dz, self.z_limits[0]), self.z_limits[1])
+        spot_index.add_to_plane(spot)
+
     def add_spot (self, x, y, t_index, channel, z_index, parent = None):
         if parent is None:
             parent_index = None
@@ -739,17 +786,14 @@ class SPT (PluginBase):
                                 x = x, y = y, z = z_index, parent = parent_index)
 
         logger.info("Adding a spot: {0}".format(spot))
+        spot_index = self.get_spot_index()
         self.spot_list.append(spot)
+        spot_index.add(spot)
         self.current_spot = spot
         self.records_modified = True
 
     def create_spot (self, index = None, time = None, channel = None, x = None, y = None, z = None, parent = None):
-        spot = {'index': index, 'time': time, 'channel': channel, \
-                'x': x, 'y': y, 'z': z, 'parent': parent, 'label': None, \
-                'delete': False, \
-                'create': datetime.now().astimezone().isoformat(), \
-                'update': datetime.now().astimezone().isoformat()}
-        return spot
+        return records.create_spot(index = index, time = time, channel = channel, x = x, y = y, z = z, parent = parent)
 
     def update_old_spot (self, spot):
         empty_spot = self.create_spot()
@@ -797,6 +841,7 @@ class SPT (PluginBase):
             child_spot['parent'] = None
             child_spot['update'] = datetime.now().astimezone().isoformat()
 
+        self.get_spot_index().remove(delete_spot)
         delete_spot['delete'] = True
         delete_spot['update'] = datetime.now().astimezone().isoformat()
         self.records_modified = True
@@ -809,13 +854,19 @@ class SPT (PluginBase):
             parent_spot = self.find_spot_by_index(current_spot['parent'])
         return current_spot
 
+    def get_spot_index (self):
+        # built again when the list is replaced or changed without the methods below
+        if (self.spot_index is None) or (self.spot_index.is_built_for(self.spot_list) == False):
+            self.spot_index = records.SpotIndex(self.spot_list)
+        return self.spot_index
+
     def find_children (self, spot):
+        # a copy; the index changes while children are removed
         if spot is None:
             spot_list = []
         else:
-            spot_list = [x for x in self.spot_list \
-                         if (x['parent'] == spot['index']) and (x['delete'] == False)]
-        
+            spot_list = list(self.get_spot_index().find_children(spot))
+
         return spot_list
 
     def find_ancestors(self, spot):
@@ -835,27 +886,15 @@ class SPT (PluginBase):
         return spot_list
 
     def find_spot_by_index (self, index):
-        spot_list = [spot for spot in self.spot_list \
-                     if (spot['index'] == index) and (spot['delete'] == False)]
-        if len(spot_list) > 1:
-            logger.error("Multiple spots have the same index. This is a bug.")
-
-        if len(spot_list) == 0:
-            spot = None
-        else:
-            spot = spot_list[0]
-        
-        return spot
+        return self.get_spot_index().find_spot(index)
 
     def find_spots_by_position (self, x, y, t_index, channel, z_index):
         if len(self.spot_list) == 0:
             return []
 
-        cand_spots = [spot for spot in self.spot_list \
-                      if (spot['delete'] == False) and
-                         (x - self.spot_radius <= spot['x']) and (spot['x'] <= x + self.spot_radius) and
-                         (y - self.spot_radius <= spot['y']) and (spot['y'] <= y + self.spot_radius) and
-                         (spot['z'] == z_index) and (spot['time'] == t_index) and (spot['channel'] == channel)]
+        cand_spots = [spot for spot in self.get_spot_index().spots_in_z_range(t_index, channel, z_index, z_index) \
+                      if (x - self.spot_radius <= spot['x']) and (spot['x'] <= x + self.spot_radius) and
+                         (y - self.spot_radius <= spot['y']) and (spot['y'] <= y + self.spot_radius)]
 
         return sorted(cand_spots, key = lambda x: x['index'])
 
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+import ast, json
+from pathlib import Path
+from importlib import import_module
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+plugin_package = 'plugin'
+plugin_folder = Path(__file__).parent
+manifest_file = plugin_folder.joinpath('manifest.json')
+default_module = 'base'
+metadata_keys = ['plugin_name', 'class_name', 'priority']
+
+class PluginRegistry:
+    def __init__ (self, package = plugin_package, folder = plugin_folder, manifest = manifest_file, rescan = False):
+        self.package = package
+        self.folder = Path(folder)
+        self.manifest = Path(manifest)
+
+        if self.manifest.exists() and not rescan and self.is_manifest_current():
+            self.entry_list = self.read_manifest()
+        else:
+            logger.info(f"Scanning the plugin folder: {self.folder}")
+            self.entry_list = self.scan_folder()
+
+        # the default plugin is loaded even if its priority is negative
+        default_entry = self.find_entry_by_module(default_module)
+        if default_entry is None:
+            default_entry = self.read_module_metadata(self.folder.joinpath(f"{default_module}.py"))
+        self.default_entry = default_entry | {'priority': 0}
+
+    def module_files (self):
+        return [file for file in sorted(self.folder.glob('*.py')) if file.name.startswith("_") == False]
+
+    def is_manifest_current (self):
+        # the folder is scanned again if modules are added or removed, or modified after the manifest
+        try:
+            with open(self.manifest, 'r') as f:
+                module_list = json.load(f).get('modules', None)
+            manifest_mtime = self.manifest.stat().st_mtime_ns
+            file_list = self.module_files()
+            if module_list is None or set(module_list) != set([file.stem for file in file_list]):
+                return False
+            return all([file.stat().st_mtime_ns <= manifest_mtime for file in file_list])
+        except (OSError, ValueError):
+            return False
+
+    def read_manifest (self):
+        with open(self.manifest, 'r') as f:
+            entry_list = json.load(f).get('plugins', [])
+        logger.debug(f"Plugin manifest read: {entry_list}")
+        return entry_list
+
+    def write_manifest (self):
+        with open(self.manifest, 'w') as f:
+            json.dump({'modules': [file.stem for file in self.module_files()], 'plugins': self.entry_list}, f, \
+                      ensure_ascii = False, indent = 4, sort_keys = False, separators = (',', ': '))
+            f.write('\n')
+        logger.info(f"Plugin manifest written: {self.manifest}")
+
+    def scan_folder (self):
+        entry_list = []
+        for file in self.module_files():
+            try:
+                entry = self.read_module_metadata(file)
+            except Exception as exception:
+                logger.warning(f"Failed to read plugin metadata: {file}. {exception}")
+                continue
+            if entry is not None:
+                entry_list.append(entry)
+        return entry_list
+
+    def read_module_metadata (self, file):
+        # read module-level constants without importing (executing) the plugin
+        tree = ast.parse(Path(file).read_text(encoding = 'utf-8'))
+        entry = {'module': Path(file).stem}
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and len(node.targets) == 1 and \
+               isinstance(node.targets[0], ast.Name) and node.targets[0].id in metadata_keys:
+                entry[node.targets[0].id] = ast.literal_eval(node.value)
+
+        if any([key not in entry for key in metadata_keys]):
+            return None
+        return entry
+
+    def plugin_entries (self):
+        entry_list = [entry for entry in self.entry_list if entry['priority'] >= 0]
+        if len(entry_list) == 0:
+            entry_list = [self.default_entry]
+        return sorted(entry_list, key = lambda x: x['priority'])
+
+    def plugin_names (self):
+        return [entry['plugin_name'] for entry in self.plugin_entries()]
+
+    def find_entry (self, plugin_name):
+        entry_list = [entry for entry in self.plugin_entries() if entry['plugin_name'] == plugin_name]
+        return entry_list[0] if len(entry_list) > 0 else None
+
+    def find_entry_by_module (self, module_name):
+        entry_list = [entry for entry in self.entry_list if entry['module'] == module_name]
+        return entry_list[0] if len(entry_list) > 0 else None
+
+    def create_instance (self, entry):
+        module = import_module(name = f"{self.package}.{entry['module']}")
+        instance = getattr(module, entry['class_name'])()
+        instance.priority = entry['priority']
+        instance.plugin_name = entry['plugin_name']
+        logger.debug(f"Plugin instance created: {instance}")
+        return instance
+
+registry = None
+def get_registry ():
+    # shared by all windows in the process
+    global registry
+    if registry is None:
+        registry = PluginRegistry()
+    return registry
+
+if __name__ == '__main__':
+    # regenerate the manifest after adding, removing or editing plugins (stale manifests are not used)
+    PluginRegistry(rescan = True).write_manifest()
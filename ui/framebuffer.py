@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+import numpy as np
+from collections import OrderedDict
+from PySide6.QtGui import QImage
+
+default_max_buffers = 16
+
+class FrameBuffer:
+    # a contiguous 8-bit image wrapped once by a QImage, and float buffers used by the LUTs
+    def __init__ (self, height, width, image_format):
+        samples = 3 if image_format == QImage.Format_RGB888 else 1
+
+        # scanlines of QImage are aligned to 4 bytes
+        bytes_per_line = (width * samples + 3) // 4 * 4
+        self.data = np.zeros((height, bytes_per_line), dtype = np.uint8)
+        self.array = self.data[:, 0:width * samples].reshape((height, width, samples) if samples > 1 else (height, width))
+        self.scratch = np.empty((height, width), dtype = np.float32)
+        self.composite_buffer = np.empty((height, width), dtype = np.uint8)
+        self.qimage = QImage(self.data.data, width, height, bytes_per_line, image_format)
+
+class FrameBufferPool:
+    # buffers are reused for planes and tiles of the same size (least recently used ones are released)
+    def __init__ (self, max_buffers = default_max_buffers):
+        self.max_buffers = max_buffers
+        self.buffer_dict = OrderedDict()
+
+    def buffer (self, height, width, image_format):
+        key = (height, width, image_format)
+        frame_buffer = self.buffer_dict.get(key, None)
+        if frame_buffer is None:
+            frame_buffer = FrameBuffer(height, width, image_format)
+            self.buffer_dict[key] = frame_buffer
+            if len(self.buffer_dict) > self.max_buffers:
+                self.buffer_dict.popitem(last = False)
+        self.buffer_dict.move_to_end(key)
+        return frame_buffer
+
+    def clear (self):
+        self.buffer_dict.clear()
+
+def render_frame (frame_buffers, lut_list, plane_func, channel = 0, composite = False, lut_grayscale = False):
+    # plane_func returns the plane (or a part of it) of a channel; LUTs fill a buffer of the pool in place
+    if composite:
+        plane_list = [plane_func(index) for index in range(len(lut_list))]
+        frame_buffer = frame_buffers.buffer(*plane_list[0].shape[0:2], QImage.Format_RGB888)
+        for index, plane in enumerate(plane_list):
+            composite_buffer = None if index == 0 else frame_buffer.composite_buffer
+            lut_list[index].apply_lut_rgb_into(plane, frame_buffer.array, frame_buffer.scratch, composite_buffer)
+    elif lut_grayscale:
+        plane = plane_func(channel)
+        frame_buffer = frame_buffers.buffer(*plane.shape[0:2], QImage.Format_Grayscale8)
+        lut_list[channel].apply_lut_gray_into(plane, frame_buffer.array, frame_buffer.scratch)
+    else:
+        plane = plane_func(channel)
+        frame_buffer = frame_buffers.buffer(*plane.shape[0:2], QImage.Format_RGB888)
+        lut_list[channel].apply_lut_rgb_into(plane, frame_buffer.array, frame_buffer.scratch)
+    return frame_buffer
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import threading
+from logging import getLogger
+from PySide6.QtCore import QObject, Signal
+from image import stack, lut, perf
+
+logger = getLogger(__name__)
+
+class ImageLoader (QObject):
+    # reads an image in a worker thread. the stack is passed to the window as soon as
+    # the first planes are decoded, and the rest of the stack fills in behind it.
+    signal_first_planes_loaded = Signal(object, list)
+    signal_progress = Signal(int, int)
+    signal_loaded = Signal(object, list)
+    signal_failed = Signal(str)
+    signal_canceled = Signal()
+
+    def __init__ (self, image_filename, image_region = None, parent = None):
+        super().__init__(parent)
+        self.image_filename = image_filename
+        self.image_region = image_region
+        self.cancel_event = threading.Event()
+        self.thread = None
+
+    def start (self):
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def cancel (self):
+        self.cancel_event.set()
+
+    def is_canceled (self):
+        return self.cancel_event.is_set()
+
+    def run (self):
+        try:
+            with perf.timer("load_image"):
+                image_stack = self.read_pages()
+                lut_list = None if image_stack is None else self.create_lut_list(image_stack)
+        except Exception as exception:
+            logger.error(f"Failed to open image: {self.image_filename}. {exception}")
+            self.signal_failed.emit(str(exception))
+            return
+
+        if lut_list is None:
+            logger.info(f"Loading canceled: {self.image_filename}")
+            self.signal_canceled.emit()
+        else:
+            self.signal_loaded.emit(image_stack, lut_list)
+
+    def read_pages (self):
+        image_stack = stack.Stack()
+        first_planes = True
+        image_region = {} if self.image_region is None else self.image_region
+        for decoded, total in image_stack.read_image_by_page(self.image_filename, **image_region):
+            if self.is_canceled():
+                return None
+            if first_planes:
+                logger.debug(f"First planes decoded: {self.image_filename}")
+                self.signal_first_planes_loaded.emit(image_stack, lut.create_lut_list(image_stack, tz_index = (0, 0)))
+                first_planes = False
+            self.signal_progress.emit(decoded, total)
+        return image_stack
+
+    def create_lut_list (self, image_stack):
+        # percentiles of the whole stack, checked for cancellation while the statistics are computed.
+        # lazy stacks (e.g. OME-Zarr) are not read as a whole; sampled planes are used.
+        max_planes = lut.default_sample_planes if image_stack.is_lazy() else None
+        if max_planes is None:
+            image_stack.statistics.compute(cancel_event = self.cancel_event)
+        lut_list = []
+        for channel in range(image_stack.c_count):
+            if self.is_canceled():
+                return None
+            lut_list.append(lut.create_lut(image_stack, channel, max_planes = max_planes))
+        return lut_list
@@ -1,10 +1,10 @@
 #!/usr/bin/env python
 
-import numpy as np
-from PySide6.QtCore import Qt, QObject, Signal, QTimer, QEvent
+from PySide6.QtCore import Qt, QObject, Signal, QEvent, QRectF
 from PySide6.QtWidgets import QGraphicsScene, QSlider, QGraphicsPixmapItem, QLineEdit
-from PySide6.QtGui import QImage, QPixmap, QCursor
-from image import stack
+from PySide6.QtGui import QPixmap, QCursor, QTransform
+from image import stack, perf, pyramid, projection
+from ui import framebuffer, playback
 
 class ImagePanel (QObject):
     signal_image_index_changed = Signal()
@@ -14,6 +14,7 @@ class ImagePanel (QObject):
     signal_scene_wheel_moved = Signal(QEvent)
     signal_scene_key_pressed = Signal(QEvent)
     signal_scene_key_released = Signal(QEvent)
+    signal_playback_frame_ready = Signal()
 
     def __init__ (self, ui, parent = None):
         super().__init__(parent)
@@ -28,6 +29,19 @@ class ImagePanel (QObject):
         self.image_stack = stack.Stack()
         self.image_stack.alloc_zero_image()
         self.image_filename = None
+        self.zoom_ratio = 100
+        self.lut_list = None
+        self.pyramid = None
+        self.tiled = False
+        self.tile_dict = {}
+        self.projection_mode = 'none'
+        self.projections = None
+        self.cursor_xy = None
+        self.drift_table = None
+        self.drift_key = None
+        self.frame_buffers = framebuffer.FrameBufferPool()
+        self.frame_pixmap = None
+        self.playback = playback.PlaybackEngine(self)
 
     def init_widgets (self):
         # Time slider
@@ -44,11 +58,11 @@ class ImagePanel (QObject):
         self.ui.slider_zstack.setTickInterval(1)
         self.ui.slider_zstack.setTickPosition(QSlider.TicksBelow)
 
-        # timer (cannot start a timer in the event loop. bug?)
+        # playback
+        self.playback.stop()
+        self.ui.button_play.setText("Play")
         self.ui.spin_fps.setValue(10)
-        self.play_timer = QTimer(self)
-        self.play_timer.setInterval(1000 / self.ui.spin_fps.value())
-        self.play_timer.start()
+        self.playback.set_fps(self.ui.spin_fps.value())
 
     def connect_signals_to_slots (self):
         self.ui.slider_time.valueChanged.connect(self.slot_image_index_changed)
@@ -56,6 +70,10 @@ class ImagePanel (QObject):
         self.ui.button_play.clicked.connect(self.slot_slideshow_play_toggled)
         self.ui.spin_fps.valueChanged.connect(self.slot_slideshow_fps_changed)
         self.ui.spin_fps.editingFinished.connect(self.slot_slideshow_fps_changed)
+        self.ui.gview_image.horizontalScrollBar().valueChanged.connect(self.slot_viewport_changed)
+        self.ui.gview_image.verticalScrollBar().valueChanged.connect(self.slot_viewport_changed)
+        self.ui.gview_image.horizontalScrollBar().rangeChanged.connect(self.slot_viewport_changed)
+        self.ui.gview_image.verticalScrollBar().rangeChanged.connect(self.slot_viewport_changed)
 
         self.scene.mousePressEvent = self.slot_scene_mouse_pressed
         self.scene.mouseMoveEvent = self.slot_scene_mouse_moved
@@ -66,52 +84,179 @@ class ImagePanel (QObject):
 
     def update_status (self):
         pos = self.ui.gview_image.mapToScene(self.ui.gview_image.mapFromGlobal(QCursor().pos()))
+        # the pixel of the frame drawn at the cursor
+        pos = self.drift_transform(self.ui.slider_time.value()).inverted()[0].map(pos)
         x = int(pos.x())
         y = int(pos.y())
         status = "T: {0}/{1}, C: {2}, Z: {3}/{4}".format(self.ui.slider_time.value(), self.ui.slider_time.maximum(), self.channel,
                                                          self.ui.slider_zstack.value(), self.ui.slider_zstack.maximum())
-        if 0 <= x and x < self.image_stack.width and 0 <= y and y < self.image_stack.height:
+        if self.projection_mode != 'none':
+            status = f"{status}, {projection.mode_names[self.projection_mode]}"
+        elif 0 <= x and x < self.image_stack.width and 0 <= y and y < self.image_stack.height:
             pixelvalue = self.image_stack.image_array[self.ui.slider_time.value(), self.channel, self.ui.slider_zstack.value(), y, x]
             status = f"{status}, V: {pixelvalue}"
         self.ui.label_status.setText(status)
 
-    def update_image_scene (self, lut_list, item_list = []):
+    @perf.timed("update_image_scene")
+    def update_image_scene (self, lut_list, item_list = [], pixmap = None):
         t_index = self.ui.slider_time.value()
         z_index = self.ui.slider_zstack.value()
 
-        if self.composite:
-            final_image = np.zeros((self.image_stack.height, self.image_stack.width, 3), dtype = np.uint8)
-            for channel in range(self.image_stack.c_count):
-                image = self.image_stack.image_array[t_index, channel, z_index]
-                image = np.stack(lut_list[channel].apply_lut_rgb(image), axis = -1)
-                final_image = np.maximum(final_image, image)
-            qimage = QImage(final_image.data, self.image_stack.width, self.image_stack.height, QImage.Format_RGB888)
+        self.lut_list = lut_list
+        self.scene.clear()
+        self.tile_dict = {}
+
+        # large planes are drawn only around the viewport using a pyramid
+        self.tiled = (self.projection_mode == 'none') and \
+                     (max(self.image_stack.height, self.image_stack.width) > pyramid.tiled_size_limit)
+        if self.tiled:
+            if self.pyramid is None or self.pyramid.is_built_for(self.image_stack) == False:
+                self.pyramid = pyramid.Pyramid(self.image_stack)
+            self.update_tiles()
+        else:
+            self.pyramid = None
+            pixmap_item = QGraphicsPixmapItem()
+            if pixmap is None:
+                pixmap = self.create_pixmap(lut_list, self.plane_func(t_index, z_index))
+            pixmap_item.setPixmap(pixmap)
+            pixmap_item.setTransform(self.projection_transform() * self.drift_transform(t_index))
+            self.scene.addItem(pixmap_item)
+
+        # markers are placed in the XY coordinates
+        if self.is_orthogonal_view():
+            self.scene.setSceneRect(self.scene.itemsBoundingRect())
+        else:
+            for item in item_list:
+                self.scene.addItem(item)
+            image_rect = QRectF(0, 0, self.image_stack.width, self.image_stack.height)
+            self.scene.setSceneRect(self.scene.itemsBoundingRect().united(image_rect))
+        self.update_status()
+
+    def plane_func (self, t_index, z_index):
+        if self.projection_mode in projection.cached_modes:
+            projections, mode = self.projection_cache(), self.projection_mode
+            return lambda channel: projections.projection(mode, t_index, channel)
+        elif self.projection_mode in projection.orthogonal_modes:
+            (x, y), mode = self.current_cursor_xy(), self.projection_mode
+            return lambda channel: projection.orthogonal_slice(self.image_stack.image_array[t_index, channel], mode, x, y)
         else:
-            if self.lut_grayscale:
-                image = self.image_stack.image_array[t_index, self.channel, z_index]
-                image = lut_list[self.channel].apply_lut_gray(image)
-                qimage = QImage(image.data, self.image_stack.width, self.image_stack.height, QImage.Format_Grayscale8)
+            return lambda channel: self.image_stack.image_array[t_index, channel, z_index]
+
+    def projection_transform (self):
+        # orthogonal slices are stretched along Z by the voxel aspect ratio
+        if self.is_orthogonal_view() and self.image_stack.voxel_um is not None:
+            z_ratio = self.image_stack.voxel_um[0] / self.image_stack.voxel_um[2]
+            if self.projection_mode == 'xz':
+                return QTransform.fromScale(1, z_ratio)
             else:
-                image = self.image_stack.image_array[t_index, self.channel, z_index]
-                image = np.stack(lut_list[self.channel].apply_lut_rgb(image), axis = -1)
-                qimage = QImage(image.data, self.image_stack.width, self.image_stack.height, QImage.Format_RGB888)
+                return QTransform.fromScale(z_ratio, 1)
+        return QTransform()
 
-        self.scene.clear()
-        pixmap_item = QGraphicsPixmapItem()
-        pixmap_item.setPixmap(QPixmap(qimage))
-        self.scene.addItem(pixmap_item)
+    def set_drift_table (self, drift_table):
+        # kept for this window and this stack until the pixels are resampled
+        self.drift_table = None if drift_table is None else self.image_stack.check_drift_table(drift_table)
+        self.drift_key = (self.image_stack, self.image_stack.resample_count)
 
-        for item in item_list:
-            self.scene.addItem(item)
+    def current_drift_table (self):
+        if self.drift_key != (self.image_stack, self.image_stack.resample_count) or \
+           (self.drift_table is not None and len(self.drift_table) != self.image_stack.t_count):
+            self.drift_table = None
+        return self.drift_table
 
-        self.scene.setSceneRect(self.scene.itemsBoundingRect())
-        self.update_status()
+    def drift_at (self, t_index):
+        drift_table = self.current_drift_table()
+        return None if drift_table is None else drift_table[t_index]
+
+    def drift_transform (self, t_index):
+        # frames are drawn in the coordinates of the reference frame (see registration); no resampling
+        drift = self.drift_at(t_index)
+        if drift is None or self.is_orthogonal_view():
+            return QTransform()
+        center_x, center_y = self.image_stack.width / 2, self.image_stack.height / 2
+        return QTransform().translate(center_x, center_y).rotate(-drift[2]) \
+                           .translate(-center_x - drift[1], -center_y - drift[0])
+
+    def projection_cache (self):
+        if self.projections is None or self.projections.is_built_for(self.image_stack) == False:
+            if self.projections is not None:
+                self.projections.shutdown()
+            self.projections = projection.ProjectionCache(self.image_stack)
+        return self.projections
+
+    def shutdown_projections (self):
+        if self.projections is not None:
+            self.projections.shutdown()
+            self.projections = None
+
+    def set_projection_mode (self, mode):
+        self.projection_mode = mode
+        if mode in projection.cached_modes:
+            c_list = range(self.image_stack.c_count) if self.composite else [self.channel]
+            self.projection_cache().precompute(mode, self.ui.slider_time.value(), c_list)
+
+    def is_orthogonal_view (self):
+        return self.projection_mode in projection.orthogonal_modes
+
+    def current_cursor_xy (self):
+        if self.cursor_xy is None:
+            return (self.image_stack.width // 2, self.image_stack.height // 2)
+        return self.cursor_xy
+
+    def create_pixmap (self, lut_list, plane_func):
+        # LUTs fill a reused buffer in place; only the pixmap is created for each frame
+        frame_buffer = framebuffer.render_frame(self.frame_buffers, lut_list, plane_func, channel = self.channel, \
+                                                composite = self.composite, lut_grayscale = self.lut_grayscale)
+        return QPixmap.fromImage(frame_buffer.qimage)
+
+    def present_frame (self, t_index, frame_buffer):
+        # a frame rendered by the playback engine; the slider is moved without redrawing
+        self.ui.slider_time.blockSignals(True)
+        self.ui.slider_time.setValue(t_index)
+        self.ui.slider_time.blockSignals(False)
+        self.frame_pixmap = QPixmap.fromImage(frame_buffer.qimage)
+        self.signal_playback_frame_ready.emit()
+        self.frame_pixmap = None
+
+    def update_tiles (self):
+        if self.tiled == False or self.pyramid is None or self.lut_list is None:
+            return
+
+        t_index = self.ui.slider_time.value()
+        z_index = self.ui.slider_zstack.value()
+        level = pyramid.level_for_zoom(self.zoom_ratio, self.pyramid.level_count)
+        ratio = 2 ** level
+
+        drift_transform = self.drift_transform(t_index)
+        view_rect = self.ui.gview_image.mapToScene(self.ui.gview_image.viewport().rect()).boundingRect()
+        view_rect = drift_transform.inverted()[0].mapRect(view_rect)
+        tile_keys = [(level, *tile) for tile in self.pyramid.visible_tiles(level, view_rect.getCoords())]
+
+        for key in [key for key in self.tile_dict.keys() if key not in tile_keys]:
+            self.scene.removeItem(self.tile_dict.pop(key))
+
+        for key in [key for key in tile_keys if key not in self.tile_dict]:
+            y_slice, x_slice = self.pyramid.tile_slices(*key[1:])
+            pixmap = self.create_pixmap(self.lut_list, \
+                                        lambda channel: self.pyramid.plane(t_index, channel, z_index, level)[y_slice, x_slice])
+            tile_item = QGraphicsPixmapItem(pixmap)
+            tile_item.setZValue(-1)
+            tile_item.setTransform(QTransform.fromScale(ratio, ratio) * \
+                                   QTransform.fromTranslate(x_slice.start * ratio, y_slice.start * ratio) * drift_transform)
+            self.scene.addItem(tile_item)
+            self.tile_dict[key] = tile_item
 
     def current_image (self):
         t_index = self.ui.slider_time.value()
         z_index = self.ui.slider_zstack.value()
         return self.image_stack.image_array[t_index, self.channel, z_index]
 
+    def current_pixel_values (self):
+        # statistics of the current plane once computed (after loading), otherwise the pixels
+        if self.image_stack.statistics.is_computed():
+            t_index, channel, z_index = self.current_index()
+            return self.image_stack.statistics.selection(channel = channel, t_index = t_index, z_index = z_index)
+        return self.current_image()
+
     def current_index (self):
         t_index = self.ui.slider_time.value()
         z_index = self.ui.slider_zstack.value()
@@ -121,6 +266,9 @@ class ImagePanel (QObject):
         self.signal_scene_mouse_pressed.emit(event)
 
     def slot_scene_mouse_moved (self, event):
+        if self.is_orthogonal_view() == False:
+            pos = self.drift_transform(self.ui.slider_time.value()).inverted()[0].map(event.scenePos())
+            self.cursor_xy = (int(pos.x()), int(pos.y()))
         self.update_status()
         self.signal_scene_mouse_moved.emit(event)
 
@@ -153,22 +301,26 @@ class ImagePanel (QObject):
         self.signal_image_index_changed.emit()
 
     def slot_zoom_ratio_changed (self, zoom_ratio):
+        self.zoom_ratio = zoom_ratio
         self.ui.gview_image.resetTransform()
         self.ui.gview_image.scale(zoom_ratio / 100, zoom_ratio / 100)
+        self.update_tiles()
+
+    def slot_viewport_changed (self):
+        self.update_tiles()
 
     def slot_slideshow_play_toggled (self):
-        if self.ui.button_play.text() == "Stop":
+        if self.playback.is_playing():
             self.ui.button_play.setText("Play")
-            self.play_timer.timeout.disconnect()
+            self.playback.stop()
+            # the LUT view and status skipped while playing
+            self.signal_image_index_changed.emit()
         else:
             self.ui.button_play.setText("Stop")
-            self.play_timer.timeout.connect(self.slot_slideshow_timer_timeout)
-
-    def slot_slideshow_timer_timeout (self):
-        self.ui.slider_time.setValue((self.ui.slider_time.value() + 1) % (self.ui.slider_time.maximum() + 1))
+            self.playback.start()
 
     def slot_slideshow_fps_changed (self):
-        self.play_timer.setInterval(1000 / self.ui.spin_fps.value())
+        self.playback.set_fps(self.ui.spin_fps.value())
         self.ui.spin_fps.findChild(QLineEdit).deselect()
 
 
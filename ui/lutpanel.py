@@ -1,23 +1,30 @@
 #!/usr/bin/env python
 
+import threading
 import numpy as np
+from logging import getLogger
 from PySide6.QtCore import QObject, Signal
 from PySide6.QtWidgets import QGraphicsScene
 from PySide6.QtGui import QColor
-from image import lut
+from image import lut, perf
+
+logger = getLogger(__name__)
 
 class LutPanel (QObject):
     signal_current_lut_changed = Signal()
     signal_reset_current_lut_range = Signal()
+    signal_luts_refined = Signal(object, list)
 
     def __init__ (self, ui, parent = None):
         super().__init__(parent)
         self.ui = ui
+        self.image_stack = None
+        self.signal_luts_refined.connect(self.slot_luts_refined)
         self.ui.combo_lut.addItems([item for item in lut.lut_dict])
         self.ui.combo_bits.addItems([item for item in lut.bit_dict])
 
-    def init_widgets (self, stack):
-        self.init_luts(stack)
+    def init_widgets (self, stack, lut_list = None, image_filename = None):
+        self.init_luts(stack, lut_list, image_filename)
         self.init_boxes()
         self.update_lut_panel_silently()
 
@@ -25,19 +32,47 @@ class LutPanel (QObject):
         self.scene_lut.setBackgroundBrush(QColor('white'))
         self.ui.gview_lut.setScene(self.scene_lut)
 
-    def init_luts (self, stack):
-        self.lut_list = []
-
-        if stack is None:
-            self.lut_list.append(lut.LUT())
-        elif stack.c_count == 1:
-            image_lut = lut.LUT(lut_name = "Gray", pixel_values = stack.image_array[:, 0])
-            self.lut_list.append(image_lut)
-        else:
-            for channel in range(stack.c_count):
-                lut_name = lut.lut_names[channel % len(lut.lut_names)]
-                image_lut = lut.LUT(lut_name = lut_name, pixel_values = stack.image_array[:, channel])
-                self.lut_list.append(image_lut)
+    def init_luts (self, stack, lut_list = None, image_filename = None):
+        # without LUTs (e.g. cached and virtual stacks), sampled planes set the ranges first. the ranges
+        # of the whole stack replace them when computed in a thread (lazy stacks are not read as a whole).
+        self.image_stack = stack
+        if lut_list is not None:
+            self.lut_list = lut_list
+            return
+
+        self.lut_list = lut.create_lut_list(stack, max_planes = lut.default_sample_planes)
+        if self.needs_refining(stack, image_filename):
+            threading.Thread(target = self.refine_luts, args = (stack,), daemon = True).start()
+
+    def needs_refining (self, stack, image_filename):
+        # placeholder stacks (no file) are skipped, and so are stacks whose planes were all sampled
+        if stack is None or image_filename is None or stack.is_lazy() or stack.statistics.is_computed():
+            return False
+        return stack.t_count * stack.z_count > lut.default_sample_planes
+
+    def refine_luts (self, stack):
+        try:
+            with perf.timer("refine_luts"):
+                lut_list = lut.create_lut_list(stack)
+        except Exception as exception:
+            logger.warning(f"LUT ranges of the whole stack not computed. {exception}")
+            return
+        self.signal_luts_refined.emit(stack, lut_list)
+
+    def slot_luts_refined (self, stack, lut_list):
+        # the stack may have been replaced while computing
+        if stack is self.image_stack and len(lut_list) == len(self.lut_list):
+            self.update_auto_luts(lut_list)
+            self.signal_current_lut_changed.emit()
+
+    def update_auto_luts (self, lut_list):
+        # ranges of the whole stack replace those of the first plane unless changed by the user
+        for current_lut, new_lut in zip(self.lut_list, lut_list):
+            if current_lut.auto_lut:
+                current_lut.bit_mode = new_lut.bit_mode
+                current_lut.lut_lower, current_lut.lut_upper = new_lut.lut_lower, new_lut.lut_upper
+                current_lut.lut_min, current_lut.lut_max = new_lut.lut_min, new_lut.lut_max
+        self.update_lut_panel_silently()
 
     def init_boxes (self):
         self.ui.combo_channel.blockSignals(True)
@@ -164,6 +199,7 @@ class LutPanel (QObject):
         current_lut.reset_lut_range(pixel_values)
         self.update_lut_panel_silently()
 
+    @perf.timed("update_lut_view")
     def update_lut_view (self, image):
         current_lut = self.lut_list[self.ui.combo_channel.currentIndex()]
         lut_range = current_lut.lut_range()
@@ -173,8 +209,8 @@ class LutPanel (QObject):
         self.scene_lut.clear()
         self.scene_lut.setSceneRect(0, 0, width, height)
 
-        hists, bins = np.histogram(image, bins = int(width), range = lut_range)
-        max_hist = np.max(hists)
+        hists, bins = lut.value_histogram(image, int(width), lut_range)
+        max_hist = max(np.max(hists), 1)
         for index, hist in enumerate(hists):
             x = width * (bins[index] - np.min(bins)) / np.ptp(bins)
             y_bottom = height
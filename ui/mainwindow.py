@@ -1,24 +1,34 @@
 #!/usr/bin/env python
 
-import textwrap
+import time, textwrap
 from pathlib import Path
 from logging import getLogger
 from PySide6.QtWidgets import QMainWindow, QMessageBox, QFileDialog, QProgressDialog, QApplication
+from PySide6.QtGui import QActionGroup
 from PySide6.QtCore import QFile, Qt, Signal
 from PySide6.QtUiTools import QUiLoader
-from ui import imagepanel, zoompanel, lutpanel, pluginpanel
-from image import stack
+from ui import imagepanel, zoompanel, lutpanel, pluginpanel, imageloader, regiondialog
+from image import stack, perf, virtual
 
 logger = getLogger(__name__)
 
 class MainWindow (QMainWindow):
     signal_open_new_image = Signal(list)
 
-    def __init__ (self, image_filename = None, records_filename = None, plugin_name = None):
+    def __init__ (self, image_filename = None, records_filename = None, plugin_name = None, stack_cache = None, \
+                  image_region = None):
         logger.debug("Main window created.")
         super().__init__()
         self.app_name = "MomoTrack"
-        self.image_types = {"TIFF Image": ["*.tif", "*.tiff", "*.stk"]}
+        self.stack_cache = stack_cache
+        self.perf_overlay = None
+        self.image_loader = None
+        self.load_dialog = None
+        self.image_region = None
+        self.refresh_time = 0
+        self.refresh_interval = 0.5
+        self.image_types = {"TIFF Image": ["*.tif", "*.tiff", "*.stk"],
+                            "OME-Zarr": ["*.zarr", "*.n5", ".zattrs", "zarr.json", "attributes.json"]}
 
         self.setWindowTitle(self.app_name)
         self.load_ui()
@@ -34,9 +44,12 @@ class MainWindow (QMainWindow):
         logger.debug("Other signals connected.")
 
         try:
-            if image_filename is not None and len(image_filename) > 0:
-                self.load_image(image_filename)
-                logger.debug(f"Image loaded: {image_filename}")
+            if isinstance(image_filename, list):
+                self.load_virtual_stack(image_filename)
+                logger.debug(f"Virtual stack loaded: {len(image_filename)} files")
+            elif image_filename is not None and len(image_filename) > 0:
+                self.load_image(image_filename, image_region = image_region)
+                logger.debug(f"Image loading started: {image_filename}")
             if records_filename is not None and len(records_filename) > 0:
                 self.load_plugin_records(records_filename)
                 logger.debug(f"Records loaded: {records_filename}")
@@ -71,14 +84,14 @@ class MainWindow (QMainWindow):
         height = int(screen_size.height() * 0.8)
         self.resize(width, height)
 
-    def init_widgets (self):
+    def init_widgets (self, lut_list = None):
         self.image_panel.init_widgets()
         logger.debug("Image panel widgets initialized.")
 
         self.zoom_panel.init_widgets()
         logger.debug("Zoom panel widgets initialized.")
 
-        self.lut_panel.init_widgets(self.image_panel.image_stack)
+        self.lut_panel.init_widgets(self.image_panel.image_stack, lut_list, image_filename = self.image_panel.image_filename)
         logger.debug("LUT panel widgets initialized.")
 
         self.plugin_panel.notify_plugins_stack_updated(self.image_panel.image_stack)
@@ -91,6 +104,8 @@ class MainWindow (QMainWindow):
     def connect_menubar_to_slots (self):
         self.ui.action_quit.triggered.connect(self.close)
         self.ui.action_open_image.triggered.connect(self.slot_open_image)
+        self.ui.action_open_virtual_stack.triggered.connect(self.slot_open_virtual_stack)
+        self.ui.action_open_region.triggered.connect(self.slot_open_region)
         self.ui.action_load_records.triggered.connect(self.slot_load_plugin_records)
         self.ui.action_save_records.triggered.connect(self.slot_save_plugin_records)
         self.ui.action_save_records_as.triggered.connect(self.slot_save_plugin_records_as)
@@ -98,6 +113,20 @@ class MainWindow (QMainWindow):
         self.ui.action_zoom_in.triggered.connect(self.zoom_panel.slot_zoomed_in)
         self.ui.action_zoom_out.triggered.connect(self.zoom_panel.slot_zoomed_out)
         self.ui.action_zoom_reset.triggered.connect(self.zoom_panel.slot_zoom_reset)
+        self.ui.action_perf_overlay.toggled.connect(self.slot_perf_overlay_toggled)
+
+        self.projection_actions = {'none': self.ui.action_projection_none,
+                                   'max': self.ui.action_projection_max,
+                                   'mean': self.ui.action_projection_mean,
+                                   'xz': self.ui.action_projection_xz,
+                                   'yz': self.ui.action_projection_yz}
+        self.projection_group = QActionGroup(self)
+        for mode, action in self.projection_actions.items():
+            self.projection_group.addAction(action)
+            action.triggered.connect(lambda checked, mode = mode: self.slot_projection_mode_changed(mode))
+        self.ui.action_estimate_drift.triggered.connect(lambda: self.slot_estimate_drift(rigid = False))
+        self.ui.action_estimate_drift_rigid.triggered.connect(lambda: self.slot_estimate_drift(rigid = True))
+        self.ui.action_clear_drift.triggered.connect(self.slot_clear_drift)
         self.ui.action_about_this.triggered.connect(self.slot_about_this)
         self.ui.action_about_qt.triggered.connect(self.slot_about_qt)
         self.ui.action_plugin_help.triggered.connect(self.plugin_panel.slot_plugin_help)
@@ -112,6 +141,7 @@ class MainWindow (QMainWindow):
         self.image_panel.signal_scene_key_pressed.connect(self.slot_scene_key_pressed)
         self.image_panel.signal_scene_key_released.connect(self.slot_scene_key_released)
         self.image_panel.signal_scene_wheel_moved.connect(self.slot_scene_wheel_moved)
+        self.image_panel.signal_playback_frame_ready.connect(self.slot_playback_frame_ready)
         self.image_panel.connect_signals_to_slots()
 
         # zooming
@@ -137,7 +167,7 @@ class MainWindow (QMainWindow):
         new_files = []
         for image_filename in image_filename_list:
             if any([Path(str(image_filename).lower()).match(ext) for ext in stack_exts]):
-                if self.image_panel.image_filename is None:
+                if self.image_panel.image_filename is None and self.is_loading() == False:
                     try:
                         self.load_image(image_filename)
                     except:
@@ -149,29 +179,73 @@ class MainWindow (QMainWindow):
         if len(new_files) > 0:
             self.signal_open_new_image.emit(new_files)
 
-    def load_image (self, image_filename):
+    def load_image (self, image_filename, image_region = None):
         # This function may throw an exception
-        file = Path(image_filename)
-        total_size = file.stat().st_size
+        # regions (keyword arguments of Stack.read_image) are not cached
+        image_stack = None if self.stack_cache is None or image_region is not None else self.stack_cache.get(image_filename)
+        if image_stack is not None:
+            self.set_image_stack(image_stack, image_filename)
+            return
+
+        # the image is shown when the first planes are decoded
+        self.image_loader = imageloader.ImageLoader(image_filename, image_region = image_region)
+        self.image_loader.signal_first_planes_loaded.connect(self.slot_first_planes_loaded)
+        self.image_loader.signal_progress.connect(self.slot_load_progress)
+        self.image_loader.signal_loaded.connect(self.slot_image_loaded)
+        self.image_loader.signal_failed.connect(self.slot_load_failed)
+        self.image_loader.signal_canceled.connect(self.slot_load_canceled)
+
+        self.load_dialog = QProgressDialog("Loading: {0}".format(Path(image_filename).name), "Cancel", 0, 100, self)
+        self.load_dialog.setWindowModality(Qt.NonModal)
+        self.load_dialog.setMinimumDuration(500)
+        self.load_dialog.setAutoClose(False)
+        self.load_dialog.canceled.connect(self.image_loader.cancel)
+        self.image_loader.start()
+
+    def set_image_stack (self, image_stack, image_filename, lut_list = None, image_region = None):
+        self.image_panel.image_stack = image_stack
+        self.image_panel.image_filename = image_filename
+        self.image_panel.set_drift_table(None)
+        self.image_region = image_region
+
+        self.init_widgets(lut_list)
+        self.plugin_panel.notify_plugins_stack_updated(self.image_panel.image_stack)
+        self.zoom_best()
 
-        dialog = QProgressDialog("Loading: {0}".format(file.name), "Cancel", 0, 100)
-        dialog.setWindowModality(Qt.WindowModal)
-        dialog.show()
-        QApplication.processEvents()
+    def empty_stack (self):
+        image_stack = stack.Stack()
+        image_stack.alloc_zero_image()
+        return image_stack
+
+    def is_loading (self):
+        return self.image_loader is not None
+
+    def finish_loading (self):
+        self.image_loader = None
+        if self.load_dialog is not None:
+            self.load_dialog.close()
+            self.load_dialog.deleteLater()
+            self.load_dialog = None
+
+    def refresh_loaded_planes (self):
+        # planes decoded after the last drawing; cached projections and pyramids are outdated
+        self.refresh_time = time.perf_counter()
+        self.image_panel.pyramid = None
+        self.image_panel.shutdown_projections()
+        self.update_image_view()
 
+    def load_virtual_stack (self, image_filename_list):
+        # files are concatenated along T without loading pixels
         try:
             image_stack = stack.Stack()
-            for read_size in image_stack.read_image_by_chunk(image_filename):
-                dialog.setValue(int(read_size / total_size * 100))
-                QApplication.processEvents()
-                if dialog.wasCanceled():
-                    return
-        except:
-            self.show_message(title = "Image opening error", message = f"Failed to open image: {image_filename}")
+            image_stack.read_virtual(image_filename_list)
+        except Exception:
+            self.show_message(title = "Image opening error", message = f"Failed to open images: {image_filename_list[0]} and others")
             return
 
         self.image_panel.image_stack = image_stack
-        self.image_panel.image_filename = image_filename
+        self.image_panel.image_filename = image_filename_list[0]
+        self.image_region = None
 
         self.init_widgets()
         self.plugin_panel.notify_plugins_stack_updated(self.image_panel.image_stack)
@@ -180,6 +254,7 @@ class MainWindow (QMainWindow):
     def load_plugin_records (self, records_filename, plugin_name = None):
         self.plugin_panel.load_records(records_filename, plugin_name)
 
+    @perf.timed("save_records")
     def save_plugin_records (self, records_filename, plugin_name = None):
         settings = {'image_properties': self.archive_image_properties(), 
                     'viewer_settings': self.archive_viewer_settings()}
@@ -253,6 +328,14 @@ class MainWindow (QMainWindow):
         self.ui.gview_image.verticalScrollBar().setValue(settings.get('v_scroll', 0))
         self.ui.gview_image.horizontalScrollBar().setValue(settings.get('h_scroll', 0))
 
+        # records are in the coordinates of the drift-corrected view
+        image_properties = self.plugin_panel.plugin_records_dict().get('image_properties', {})
+        try:
+            self.image_panel.set_drift_table(image_properties.get('drift_table', None))
+        except Exception as exception:
+            self.image_panel.set_drift_table(None)
+            logger.warning(f"Drift table not restored. {exception}")
+
         self.update_image_view()
 
     def archive_viewer_settings (self):
@@ -271,24 +354,46 @@ class MainWindow (QMainWindow):
     def archive_image_properties (self):
         settings = {'image_filename': self.image_panel.image_filename}
         settings = settings | self.image_panel.image_stack.archive_properties()
+        if self.image_region is not None:
+            # coordinates of records are relative to the region
+            settings['image_region'] = self.image_region
+        if self.image_panel.current_drift_table() is not None:
+            # coordinates of records are in the reference frame
+            settings['drift_table'] = self.image_panel.current_drift_table().tolist()
         return settings
 
     def update_window_title (self):
         title = self.app_name
         if self.image_panel.image_filename is not None:
             title = f"{title} - {Path(self.image_panel.image_filename).name}"
+            if self.image_region is not None:
+                title = f"{title} (region)"
         self.setWindowTitle(title)
 
+    @perf.timed("update_image_view")
     def update_image_view (self):
         self.image_panel.channel = self.lut_panel.current_channel()
         self.image_panel.composite = self.lut_panel.is_composite()
         self.image_panel.lut_grayscale = self.lut_panel.is_lut_grayscale()
 
-        self.lut_panel.update_lut_range_if_auto(self.image_panel.current_image())
-        self.lut_panel.update_lut_view(self.image_panel.current_image())
+        self.lut_panel.update_lut_range_if_auto(self.image_panel.current_pixel_values())
+        self.lut_panel.update_lut_view(self.image_panel.current_pixel_values())
 
-        item_list = self.plugin_panel.current_instance.list_scene_items(self.image_panel.image_stack, self.image_panel.current_index())
+        with perf.timer("list_scene_items"):
+            item_list = self.plugin_panel.current_instance.list_scene_items(self.image_panel.image_stack, self.image_panel.current_index())
         self.image_panel.update_image_scene(lut_list = self.lut_panel.lut_list, item_list = item_list)
+        self.image_panel.playback.view_changed()
+
+    @perf.timed("present_frame")
+    def present_playback_frame (self):
+        # LUT ranges and the histogram were handled by the playback engine
+        with perf.timer("list_scene_items"):
+            item_list = self.plugin_panel.current_instance.list_scene_items(self.image_panel.image_stack, self.image_panel.current_index())
+        self.image_panel.update_image_scene(lut_list = self.lut_panel.lut_list, item_list = item_list, \
+                                            pixmap = self.image_panel.frame_pixmap)
+
+    def show_perf_overlay (self, show = True):
+        self.ui.action_perf_overlay.setChecked(show)
 
     def zoom_best (self):
         self.zoom_panel.zoom_best((self.image_panel.image_stack.width, self.image_panel.image_stack.height), \
@@ -314,6 +419,48 @@ class MainWindow (QMainWindow):
         self.plugin_panel.notify_plugin_focus_recovery()
         self.activateWindow()
 
+    def slot_open_virtual_stack (self):
+        dialog = QFileDialog(self)
+        dialog.setWindowTitle("Select images to concatenate along T.")
+        dialog.setFileMode(QFileDialog.ExistingFiles)
+        dialog.setNameFilters(["{0} ({1})".format(key, " ".join(value)) for key, value in self.image_types.items() if key == "TIFF Image"])
+        dialog.setViewMode(QFileDialog.List)
+
+        if dialog.exec() and len(dialog.selectedFiles()) > 0:
+            filenames = sorted(dialog.selectedFiles(), key = virtual.natural_key)
+            if self.image_panel.image_filename is None:
+                self.load_virtual_stack(filenames)
+            else:
+                self.signal_open_new_image.emit([filenames])
+
+    def slot_open_region (self):
+        dialog = QFileDialog(self)
+        dialog.setWindowTitle("Select an image to open a region.")
+        dialog.setFileMode(QFileDialog.ExistingFile)
+        dialog.setNameFilters(["{0} ({1})".format(key, " ".join(value)) for key, value in self.image_types.items()])
+        dialog.setViewMode(QFileDialog.List)
+
+        if dialog.exec() and len(dialog.selectedFiles()) > 0:
+            image_filename = dialog.selectedFiles()[0]
+            try:
+                header_dict = stack.Stack().read_header(image_filename, keep_s_axis = True)
+            except Exception:
+                self.show_message(title = "Image opening error", message = f"Failed to open image: {image_filename}")
+                return
+
+            region_dialog = regiondialog.RegionDialog(header_dict, Path(image_filename).name, self)
+            if region_dialog.exec():
+                image_region = region_dialog.region()
+                if all([item is None for item in image_region.values()]):
+                    image_region = None
+                if self.image_panel.image_filename is None and self.is_loading() == False:
+                    self.load_image(image_filename, image_region = image_region)
+                else:
+                    self.signal_open_new_image.emit([(image_filename, image_region)])
+
+        self.plugin_panel.notify_plugin_focus_recovery()
+        self.activateWindow()
+
     def slot_load_plugin_records (self):
         if self.image_panel.image_filename is None:
             self.show_message(title = "Records loading error", message = "Open image before loading records.")
@@ -393,24 +540,113 @@ class MainWindow (QMainWindow):
         QApplication.aboutQt()
         self.plugin_panel.notify_plugin_focus_recovery()
 
+    def slot_perf_overlay_toggled (self, checked):
+        if self.perf_overlay is None:
+            from ui import perfoverlay
+            self.perf_overlay = perfoverlay.PerfOverlay(self.ui.gview_image.viewport())
+        self.perf_overlay.set_active(checked)
+
+    def slot_estimate_drift (self, rigid = False):
+        # frames are drawn shifted (and rotated) by the drift table; pixels are not resampled
+        if self.is_loading():
+            self.show_message(title = "Drift correction", message = "Wait until the image is loaded.")
+            return
+
+        # records are in the coordinates of the current view, which is moved by the registration
+        if self.plugin_panel.has_records():
+            mbox = QMessageBox()
+            mbox.setWindowTitle("Drift correction")
+            mbox.setText("Records are drawn in the current coordinates and will not follow the registered frames. Continue?")
+            mbox.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
+            mbox.setDefaultButton(QMessageBox.No)
+            if mbox.exec() != QMessageBox.Yes:
+                return
+
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            with perf.timer("estimate_drift"):
+                drift_table = self.image_panel.image_stack.estimate_drift(channel = self.lut_panel.current_channel(), rigid = rigid)
+        finally:
+            QApplication.restoreOverrideCursor()
+        self.image_panel.set_drift_table(drift_table)
+        logger.info(f"Drift estimated. Max shift: {abs(drift_table[:, 0:2]).max():.1f} pixels")
+
+        self.update_image_view()
+
+    def slot_clear_drift (self):
+        self.image_panel.set_drift_table(None)
+        self.update_image_view()
+
+    def slot_first_planes_loaded (self, image_stack, lut_list):
+        if self.image_loader is None or self.image_loader.is_canceled():
+            return
+        self.set_image_stack(image_stack, self.image_loader.image_filename, lut_list, \
+                             image_region = self.image_loader.image_region)
+        self.refresh_time = time.perf_counter()
+
+        # records opened with the image are applied to the new stack
+        if self.plugin_panel.plugin_records_filename() is not None:
+            self.restore_settings()
+
+    def slot_load_progress (self, decoded, total):
+        if self.load_dialog is not None and self.load_dialog.wasCanceled() == False:
+            self.load_dialog.setValue(int(decoded / total * 100))
+        if time.perf_counter() - self.refresh_time > self.refresh_interval:
+            self.refresh_loaded_planes()
+
+    def slot_image_loaded (self, image_stack, lut_list):
+        image_filename = self.image_loader.image_filename
+        self.finish_loading()
+        if self.stack_cache is not None and self.image_region is None:
+            self.stack_cache.put(image_filename, image_stack)
+
+        self.lut_panel.update_auto_luts(lut_list)
+        self.refresh_loaded_planes()
+        logger.debug(f"Image loaded: {image_filename}")
+
+    def slot_load_failed (self, message):
+        image_filename = self.image_loader.image_filename
+        self.finish_loading()
+        self.set_image_stack(self.empty_stack(), None)
+        self.show_message(title = "Image opening error", message = f"Failed to open image: {image_filename}")
+
+    def slot_load_canceled (self):
+        # a partially loaded stack is not kept
+        self.finish_loading()
+        self.set_image_stack(self.empty_stack(), None)
+
+    def slot_playback_frame_ready (self):
+        self.present_playback_frame()
+
     def slot_update_image_view (self):
         self.update_image_view()
         self.ui.gview_image.setFocus()
 
     def slot_reset_current_lut_range (self):
-        self.lut_panel.reset_current_lut_range(self.image_panel.image_stack.image_array)
+        self.lut_panel.reset_current_lut_range(self.image_panel.image_stack.statistics.selection(channel = self.lut_panel.current_channel()))
         self.update_image_view()
 
     def slot_restore_image_settings (self):
         self.restore_settings(self.plugin_panel.plugin_records_dict().get('viewer_settings', {}))
 
+    def slot_projection_mode_changed (self, mode):
+        self.image_panel.set_projection_mode(mode)
+        self.update_image_view()
+
     def slot_scene_mouse_pressed (self, event):
+        # plugins work in the XY coordinates
+        if self.image_panel.is_orthogonal_view():
+            return
         self.plugin_panel.current_instance.mouse_pressed(event, self.image_panel.image_stack, self.image_panel.current_index())
 
     def slot_scene_mouse_moved (self, event):
+        if self.image_panel.is_orthogonal_view():
+            return
         self.plugin_panel.current_instance.mouse_moved(event, self.image_panel.image_stack, self.image_panel.current_index())
 
     def slot_scene_mouse_released (self, event):
+        if self.image_panel.is_orthogonal_view():
+            return
         self.plugin_panel.current_instance.mouse_released(event, self.image_panel.image_stack, self.image_panel.current_index())
 
     def slot_scene_wheel_moved (self, event):
@@ -471,6 +707,10 @@ class MainWindow (QMainWindow):
 
     def closeEvent (self, event):
         if self.clear_all_plugin_records_modified_flag():
+            if self.image_loader is not None:
+                self.image_loader.cancel()
+            self.image_panel.playback.shutdown()
+            self.image_panel.shutdown_projections()
             event.accept()
         else:
             event.ignore()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+
+from PySide6.QtCore import Qt, QTimer
+from PySide6.QtWidgets import QLabel
+from PySide6.QtGui import QFont
+from image import perf
+
+class PerfOverlay (QLabel):
+    def __init__ (self, parent = None, interval_ms = 500):
+        super().__init__(parent)
+        self.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.setFont(QFont("monospace", 8))
+        self.setStyleSheet("QLabel { background-color: rgba(0, 0, 0, 160); color: white; padding: 4px; }")
+        self.setAlignment(Qt.AlignLeft | Qt.AlignTop)
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(interval_ms)
+        self.timer.timeout.connect(self.slot_timer_timeout)
+
+    def set_active (self, active):
+        if active:
+            perf.instrument.enable(True)
+            self.slot_timer_timeout()
+            self.timer.start()
+            self.show()
+        else:
+            self.timer.stop()
+            self.hide()
+
+    def slot_timer_timeout (self):
+        self.setText(perf.instrument.summary_text())
+        self.adjustSize()
+        self.move(4, 4)
+        self.raise_()
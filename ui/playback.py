@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+import copy, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from PySide6.QtCore import Qt, QObject, QTimer
+from image import perf
+from ui import framebuffer
+
+logger = getLogger(__name__)
+
+default_render_ahead = 4
+
+class FpsMeter:
+    # frames actually shown per second over the last frames
+    def __init__ (self, frame_count = 30):
+        self.time_list = deque(maxlen = frame_count)
+
+    def tick (self):
+        self.time_list.append(time.perf_counter())
+
+    def fps (self):
+        if len(self.time_list) < 2 or self.time_list[-1] == self.time_list[0]:
+            return 0.0
+        return (len(self.time_list) - 1) / (self.time_list[-1] - self.time_list[0])
+
+    def reset (self):
+        self.time_list.clear()
+
+class PlaybackEngine (QObject):
+    # frame n (counted from the start, T = n % t_count) is due at start_time + n / fps.
+    # frames are rendered ahead on a worker; frames not ready in time are dropped, not queued.
+    def __init__ (self, image_panel, render_ahead = default_render_ahead, parent = None):
+        super().__init__(parent)
+        self.image_panel = image_panel
+        self.fps = 10
+        self.playing = False
+        self.fps_meter = FpsMeter()
+        self.executor = ThreadPoolExecutor(max_workers = 1)
+        self.future_dict = {}
+        self.settings = None
+        self.moving_slider = False
+
+        # a buffer pool per frame in flight (frame n uses pool n % len)
+        self.pool_list = [framebuffer.FrameBufferPool(max_buffers = 2) for _ in range(render_ahead + 1)]
+
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.slot_timer_timeout)
+
+    def is_playing (self):
+        return self.playing
+
+    def start (self):
+        self.playing = True
+        self.fps_meter.reset()
+        self.restart()
+        self.timer.start(max(1, int(1000 / self.fps / 2)))
+        logger.debug(f"Playback started: {self.fps} fps, render ahead: {self.settings is not None}")
+
+    def stop (self):
+        self.playing = False
+        self.timer.stop()
+        self.drop_frames()
+        self.fps_meter.reset()
+        self.image_panel.ui.label_fps.setText("fps")
+
+    def view_changed (self):
+        # frames rendered with old settings are dropped; the slider moved by the engine is not a change
+        if self.playing and self.moving_slider == False:
+            self.restart()
+
+    def set_fps (self, fps):
+        self.fps = max(1, fps)
+        if self.playing:
+            self.restart()
+            self.timer.setInterval(max(1, int(1000 / self.fps / 2)))
+
+    def restart (self):
+        # called when the view changes while playing (LUTs, channel, Z, or the time slider)
+        self.drop_frames()
+        self.start_frame = self.image_panel.ui.slider_time.value()
+        self.start_time = time.perf_counter()
+        self.presented_frame = self.start_frame
+        self.settings = self.render_settings()
+
+    def drop_frames (self):
+        for future in self.future_dict.values():
+            future.cancel()
+        self.future_dict = {}
+
+    def render_settings (self):
+        # planes drawn without tiles or projections are rendered ahead; otherwise the slider is moved
+        panel = self.image_panel
+        if panel.tiled or panel.projection_mode != 'none' or panel.lut_list is None:
+            return None
+        auto_cutoff = panel.ui.dspin_auto_cutoff.value() if panel.ui.check_auto_lut.isChecked() else None
+        statistics = panel.image_stack.statistics if panel.image_stack.statistics.is_computed() else None
+        return {'image_array': panel.image_stack.image_array,
+                'statistics': statistics,
+                'z_index': panel.ui.slider_zstack.value(),
+                'channel': panel.channel,
+                'composite': panel.composite,
+                'lut_grayscale': panel.lut_grayscale,
+                'lut_list': [copy.copy(image_lut) for image_lut in panel.lut_list],
+                'auto_cutoff': auto_cutoff}
+
+    def render (self, frame, settings):
+        with perf.timer("render_ahead"):
+            image_array = settings['image_array']
+            t_index, z_index, channel = frame % image_array.shape[0], settings['z_index'], settings['channel']
+            plane_func = lambda index: image_array[t_index, index, z_index]
+
+            # same as LutPanel.update_lut_range_if_auto, applied to a copy
+            lut_list = settings['lut_list']
+            if settings['auto_cutoff'] is not None:
+                lut_list = list(lut_list)
+                lut_list[channel] = copy.copy(lut_list[channel])
+                statistics = settings['statistics']
+                pixel_values = plane_func(channel) if statistics is None else \
+                               statistics.selection(channel = channel, t_index = t_index, z_index = z_index)
+                lut_list[channel].set_range_by_image(pixel_values, settings['auto_cutoff'])
+
+            return framebuffer.render_frame(self.pool_list[frame % len(self.pool_list)], lut_list, plane_func, \
+                                            channel = channel, composite = settings['composite'], \
+                                            lut_grayscale = settings['lut_grayscale'])
+
+    def due_frame (self):
+        return self.start_frame + int((time.perf_counter() - self.start_time) * self.fps)
+
+    def slot_timer_timeout (self):
+        due_frame = self.due_frame()
+        t_count = self.image_panel.image_stack.t_count
+
+        if self.settings is None:
+            # rendered in the GUI thread; frames passed while drawing are skipped
+            if due_frame > self.presented_frame:
+                perf.count("frames_dropped", due_frame - self.presented_frame - 1)
+                self.presented_frame = due_frame
+                self.fps_meter.tick()
+                self.moving_slider = True
+                self.image_panel.ui.slider_time.setValue(due_frame % t_count)
+                self.moving_slider = False
+                self.update_fps_label()
+            return
+
+        # the newest frame that is ready and due; older ones are dropped
+        ready_list = [frame for frame, future in self.future_dict.items() \
+                      if frame <= due_frame and future.done() and future.cancelled() == False]
+        if len(ready_list) > 0:
+            frame = max(ready_list)
+            frame_buffer = self.future_dict[frame].result()
+            self.presented_frame = frame
+            self.fps_meter.tick()
+            self.image_panel.present_frame(frame % t_count, frame_buffer)
+            self.update_fps_label()
+
+        # frames shown or passed are dropped (a frame being rendered is kept and shown late)
+        for frame in list(self.future_dict.keys()):
+            future = self.future_dict[frame]
+            if frame <= self.presented_frame or (frame < due_frame and future.cancel()):
+                future.cancel()
+                del self.future_dict[frame]
+                if frame != self.presented_frame:
+                    perf.count("frames_dropped")
+
+        # render ahead from the next due frame; a pool is not shared by frames in flight
+        busy_pools = {frame % len(self.pool_list) for frame in self.future_dict}
+        frame = max(due_frame, self.presented_frame) + 1
+        while len(self.future_dict) < len(self.pool_list) - 1:
+            if frame not in self.future_dict and frame % len(self.pool_list) not in busy_pools:
+                self.future_dict[frame] = self.executor.submit(self.render, frame, self.settings)
+                busy_pools.add(frame % len(self.pool_list))
+            frame += 1
+
+    def update_fps_label (self):
+        self.image_panel.ui.label_fps.setText(f"fps ({self.fps_meter.fps():.1f})")
+
+    def shutdown (self):
+        self.stop()
+        self.executor.shutdown(wait = False, cancel_futures = True)
@@ -2,11 +2,11 @@
 
 import json
 from pathlib import Path
-from importlib import import_module
 from logging import getLogger
 from PySide6.QtGui import QAction, QActionGroup, QFontMetrics, QCursor
 from PySide6.QtCore import Qt, QObject, Signal
 from PySide6.QtWidgets import QSizePolicy, QLayout, QMessageBox
+from plugin import registry
 
 logger = getLogger(__name__)
 
@@ -27,20 +27,18 @@ class PluginPanel (QObject):
         super().__init__(parent)
         self.ui = ui
 
+        # instances are created when first selected
         self.plugin_instance_dict = {}
-
-        self.plugin_package = 'plugin'
-        self.default_plugin = 'base'
-        self.plugin_folder = str(Path(__file__).parent.parent.joinpath(self.plugin_package))
-        logger.debug(f"Plugin folder {self.plugin_folder}")
+        self.plugin_registry = registry.get_registry()
 
         self.default_instance = None
         self.current_instance = None
+        self.stack_reference = None
 
         self.load_plugins()
-        logger.debug(f"Plugins loaded {self.plugin_instance_dict}.")
+        logger.debug(f"Plugins listed {self.plugin_registry.plugin_names()}.")
 
-        plugin_name = list(self.plugin_instance_dict.values())[0].plugin_name
+        plugin_name = self.plugin_registry.plugin_names()[0]
         self.switch_plugin(plugin_name)
         logger.debug(f"Plugin switched to {plugin_name}.")
 
@@ -48,45 +46,12 @@ class PluginPanel (QObject):
         logger.debug("Plugin panel signal connected.")
 
     def load_plugins (self):
-        load_failed = []
-
         self.actgroup_plugin = QActionGroup(self.ui.menu_plugin)
-
-        instance_list = []
-        module_name_list = [x.stem for x in Path(self.plugin_folder).iterdir() if not x.name.startswith("_")]
-        for module_name in module_name_list:
-            try:
-                module = import_module(name = '{0}.{1}'.format(self.plugin_package, module_name))
-                if module.priority < 0:
-                    continue
-                instance = getattr(module, module.class_name)()
-            except:
-                load_failed.append(str(module_name))
-
-            # good module
-            instance.priority = module.priority
-            instance.plugin_name = module.plugin_name
-            instance_list.append(instance)
-
-        # make sure to load at least one plugin
-        module = import_module(name = f"{self.plugin_package}.{self.default_plugin}")
-        instance = getattr(module, module.class_name)()
-        instance.priority = 0
-        instance.plugin_name = module.plugin_name
-        logger.debug(f"Default plugin loaded: {module}")
-
-        self.default_instance = getattr(module, module.class_name)()
-        if len(instance_list) == 0:
-            instance_list = [self.default_instance]
-
-        # sort instances by priority values
-        logger.debug(f"Initial plugin instance list: {instance_list}")
-        instance_list = sorted(instance_list, key = lambda x: x.priority) 
-        logger.debug(f"Sorted plugin instance list: {instance_list}")
+        plugin_names = self.plugin_registry.plugin_names()
 
         # menu
-        for instance in instance_list:
-            action = QAction(instance.plugin_name, self.ui.menu_plugin, checkable = True, checked = False)
+        for plugin_name in plugin_names:
+            action = QAction(plugin_name, self.ui.menu_plugin, checkable = True, checked = False)
             self.ui.menu_plugin.addAction(action)
             self.actgroup_plugin.addAction(action)
         self.actgroup_plugin.setExclusive(True)
@@ -94,14 +59,41 @@ class PluginPanel (QObject):
         # combobox
         self.ui.combo_plugin_name.blockSignals(True)
         self.ui.combo_plugin_name.clear()
-        self.ui.combo_plugin_name.addItems([x.plugin_name for x in instance_list])
+        self.ui.combo_plugin_name.addItems(plugin_names)
         self.ui.combo_plugin_name.blockSignals(False)
 
-        # store plugin instances to a list
-        self.plugin_instance_dict = {x.plugin_name: x for x in instance_list}
+    def create_plugin_instance (self, entry):
+        instance = self.plugin_registry.create_instance(entry)
+        if self.stack_reference is not None:
+            instance.update_stack_reference(self.stack_reference)
+        return instance
+
+    def load_default_instance (self):
+        if self.default_instance is None:
+            self.default_instance = self.create_plugin_instance(self.plugin_registry.default_entry)
+            logger.debug(f"Default plugin loaded: {self.default_instance}")
+        return self.default_instance
+
+    def load_plugin_instance (self, plugin_name):
+        if plugin_name in self.plugin_instance_dict:
+            return self.plugin_instance_dict[plugin_name]
+        elif plugin_name == self.plugin_registry.default_entry['plugin_name']:
+            return self.load_default_instance()
+
+        entry = self.plugin_registry.find_entry(plugin_name)
+        if entry is None:
+            logger.warning(f"Unknown plugin: {plugin_name}. Using the default plugin.")
+            return self.load_default_instance()
+
+        try:
+            instance = self.create_plugin_instance(entry)
+        except Exception as exception:
+            logger.error(f"Failed to load plugin: {plugin_name}. {exception}")
+            self.show_message("Plugin error", f"Failed to load: {plugin_name}")
+            return self.load_default_instance()
 
-        if len(load_failed) > 0:
-            self.show_message(f"Plugin error", "Failed to load: {', '.join(load_failed)}")
+        self.plugin_instance_dict[plugin_name] = instance
+        return instance
 
     def connect_signals_to_slots(self):
         self.actgroup_plugin.triggered.connect(self.slot_switch_plugin_by_action)
@@ -125,7 +117,7 @@ class PluginPanel (QObject):
             logger.debug(f"Signals of the current instance {self.current_instance} disconnected.")
 
         # connect a new class
-        self.current_instance = self.plugin_instance_dict.get(plugin_name, self.default_instance)
+        self.current_instance = self.select_plugin_instance(plugin_name)
         logger.debug(f"New current instance {self.current_instance} set to the variable.")
 
         self.update_labels()
@@ -194,7 +186,7 @@ class PluginPanel (QObject):
         if plugin_name is None:
             plugin_instance = self.current_instance
         else:
-            plugin_instance = self.plugin_instance_dict.get(plugin_name, self.default_instance)
+            plugin_instance = self.load_plugin_instance(plugin_name)
 
         return plugin_instance
 
@@ -247,12 +239,21 @@ class PluginPanel (QObject):
         plugin_instance = self.select_plugin_instance(plugin_name)
         return plugin_instance.is_records_modified()
 
+    def has_records (self, plugin_name = None):
+        plugin_instance = self.select_plugin_instance(plugin_name)
+        return plugin_instance.has_records()
+
     def records_filename_filter_list (self, plugin_name = None):
         plugin_instance = self.select_plugin_instance(plugin_name)
         return [f"{key} ({" ".join(value)})" for key, value in plugin_instance.file_types.items()]
 
     def notify_plugins_stack_updated (self, stack):
-        for instance in self.plugin_instance_dict.values():
+        self.stack_reference = stack
+        # the default instance is not in the dict
+        instance_list = list(self.plugin_instance_dict.values())
+        if self.default_instance is not None:
+            instance_list.append(self.default_instance)
+        for instance in instance_list:
             instance.update_stack_reference(stack)
 
     def notify_plugin_focus_recovery (self):
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+from logging import getLogger
+from PySide6.QtWidgets import QDialog, QDialogButtonBox, QVBoxLayout, QHBoxLayout, QLabel, QSpinBox, QCheckBox
+
+logger = getLogger(__name__)
+
+class RegionDialog (QDialog):
+    # T, Z, Y and X ranges and channels of a file to be loaded (see Stack.read_image)
+    def __init__ (self, header_dict, image_name = None, parent = None):
+        super().__init__(parent)
+        self.header_dict = header_dict
+        self.setWindowTitle("Open Region" if image_name is None else f"Open Region - {image_name}")
+        self.vlayout = QVBoxLayout(self)
+        self.vlayout.addWidget(QLabel("Only the region is read from the file."))
+
+        self.spin_dict = {}
+        for axis, label, count in [('T', "Time:", header_dict['t_count']), ('Z', "Z-stack:", header_dict['z_count']),
+                                   ('Y', "Y:", header_dict['height']), ('X', "X:", header_dict['width'])]:
+            self.add_range_widgets(axis, label, count)
+
+        hlayout = QHBoxLayout()
+        hlayout.addWidget(QLabel("Channels:"))
+        self.check_channel_list = []
+        for channel in range(header_dict['c_count']):
+            check_channel = QCheckBox(str(channel))
+            check_channel.setChecked(True)
+            hlayout.addWidget(check_channel)
+            self.check_channel_list.append(check_channel)
+        hlayout.addStretch()
+        self.vlayout.addLayout(hlayout)
+
+        self.button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        self.button_box.accepted.connect(self.accept)
+        self.button_box.rejected.connect(self.reject)
+        self.vlayout.addWidget(self.button_box)
+
+    def add_range_widgets (self, axis, label, count):
+        # start and stop (exclusive) in pixels or frames
+        hlayout = QHBoxLayout()
+        hlayout.addWidget(QLabel(label))
+        spin_start = QSpinBox()
+        spin_start.setRange(0, count - 1)
+        spin_start.setValue(0)
+        hlayout.addWidget(spin_start)
+        hlayout.addWidget(QLabel("to"))
+        spin_stop = QSpinBox()
+        spin_stop.setRange(1, count)
+        spin_stop.setValue(count)
+        hlayout.addWidget(spin_stop)
+        hlayout.addWidget(QLabel(f"(of {count})"))
+        self.vlayout.addLayout(hlayout)
+
+        spin_start.valueChanged.connect(lambda value: spin_stop.setValue(max(spin_stop.value(), value + 1)))
+        spin_stop.valueChanged.connect(lambda value: spin_start.setValue(min(spin_start.value(), value - 1)))
+        self.spin_dict[axis] = (spin_start, spin_stop, count)
+
+    def axis_range (self, axis):
+        spin_start, spin_stop, count = self.spin_dict[axis]
+        if spin_start.value() == 0 and spin_stop.value() == count:
+            return None
+        return (spin_start.value(), spin_stop.value())
+
+    def region (self):
+        # keyword arguments of Stack.read_image; None is the whole axis
+        c_list = [channel for channel, check_channel in enumerate(self.check_channel_list) if check_channel.isChecked()]
+        return {'t_range': self.axis_range('T'),
+                'z_range': self.axis_range('Z'),
+                'c_list': None if len(c_list) == len(self.check_channel_list) else c_list,
+                'y_range': self.axis_range('Y'),
+                'x_range': self.axis_range('X')}
+
+    def accept (self):
+        if len([item for item in self.check_channel_list if item.isChecked()]) == 0:
+            self.check_channel_list[0].setChecked(True)
+            return
+        super().accept()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+from logging import getLogger
+from PySide6.QtCore import Qt, QObject
+from PySide6.QtGui import QGuiApplication
+from ui import mainwindow
+from image import cache
+
+logger = getLogger(__name__)
+
+class WindowManager (QObject):
+    def __init__ (self, window_size = None, perf_overlay = False, parent = None):
+        super().__init__(parent)
+        self.window_list = []
+        self.window_size = window_size
+        self.perf_overlay = perf_overlay
+        self.stack_cache = cache.StackCache()
+        self.window_x, self.window_y = self.next_window_position(0, 0)
+
+    def next_window_position (self, x, y):
+        screen_size = QGuiApplication.primaryScreen().size()
+        delta = int(screen_size.width() * 0.02)
+        next_x = (x + delta) % (screen_size.width() // 2)
+        next_y = (y + delta) % (screen_size.height() // 2)
+        return next_x, next_y
+
+    def set_window_position (self, x, y):
+        self.window_x, self.window_y = x, y
+
+    def open_window (self, image_filename = None, records_filename = None, plugin_name = None, image_region = None):
+        # This function may throw an exception
+        window = mainwindow.MainWindow(plugin_name = plugin_name,
+                                       image_filename = image_filename,
+                                       records_filename = records_filename,
+                                       stack_cache = self.stack_cache,
+                                       image_region = image_region)
+        window.setAttribute(Qt.WA_DeleteOnClose)
+        window.signal_open_new_image.connect(self.slot_open_new_image)
+        window.destroyed.connect(lambda: self.remove_window(window))
+        self.window_list.append(window)
+
+        if self.window_size is None:
+            window.resize_best()
+        else:
+            window.resize(*self.window_size)
+
+        window.move(self.window_x, self.window_y)
+        self.window_x, self.window_y = self.next_window_position(self.window_x, self.window_y)
+
+        window.show()
+        if self.perf_overlay:
+            window.show_perf_overlay()
+
+        # gview_image doesn't know the actual size until the main window is shown
+        if records_filename is None:
+            window.zoom_best()
+        else:
+            window.restore_settings()
+
+        logger.debug(f"Window opened: {image_filename}. Windows: {len(self.window_list)}")
+        return window
+
+    def slot_open_new_image (self, image_list):
+        if image_list is None or len(image_list) == 0:
+            image_list = [None]
+
+        # a list in image_list is opened as a virtual stack, and a tuple as (filename, region)
+        for image_filename in image_list:
+            try:
+                if isinstance(image_filename, tuple):
+                    self.open_window(image_filename = image_filename[0], image_region = image_filename[1])
+                else:
+                    self.open_window(image_filename = image_filename)
+            except Exception:
+                logger.error(f"Failed or canceled to load: {image_filename}")
+
+    def remove_window (self, window):
+        self.window_list = [x for x in self.window_list if x is not window]
+        logger.debug(f"Window closed. Windows: {len(self.window_list)}")